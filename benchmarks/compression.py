@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Bytes on the wire vs. CPU time for compressing the large responses, at several gzip levels.
+
+$ python benchmarks/compression.py [students] [attempts per student] [repeats]
+
+Bodies are built from a populated data store as the views stream them: /session_data, /raw_errors and the CSV export,
+then passed chunk by chunk through orthobox.compression.CompressionMiddleware. Reports compressed size, ratio and
+compression time (best of repeats) per level; level 0 is the uncompressed response.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import time
+import random
+
+from tempfile import mkdtemp
+
+os.environ.setdefault('LMDB_DATADIR', mkdtemp())    # Keep orthobox's own environment out of the way
+
+from orthobox.evaluation import _normalize_errors
+from orthobox.compression import CompressionMiddleware
+from orthobox.data_store import (_MOODLE_DB, _USERS_DB, _USER_SESSIONS_DB, _DATA_DB, _METADATA_DB, _SESSION_INDEX_DB,
+                                 _POKEY, _PASS, _FAIL, _key, _prefix, _store, _new_user, unit_of_work,
+                                 iter_session_json, iter_raw_errors, iter_session_table)
+from orthobox.rest_views import _json_object, _json_array
+from orthobox.lti_views import _iter_csv
+
+_CONTEXT_ID = 'c' * 40
+_LEVELS = (1, 3, 6, 9)
+
+
+def _populate(students, attempts, rng):
+    for student in range(students):
+        with unit_of_work(write=True):
+            moodle_uid, uid = '{0:040x}'.format(student), '{0:032x}'.format(student)
+            _store(_MOODLE_DB, moodle_uid, {'uid': uid, 'username': 'Student {0}'.format(student)})
+            _store(_USERS_DB, _key(_CONTEXT_ID, uid), _new_user(moodle_uid))
+            for trial in range(1, attempts + 1):
+                session_id = '{0:016x}{1:016x}'.format(student, trial)
+                _USER_SESSIONS_DB.append(_prefix(_CONTEXT_ID, uid, _POKEY), session_id)
+                endtime, raw_errors = 0, list()
+                for _ in range(rng.randint(5, 60)):
+                    endtime += rng.randint(5, 9000)
+                    raw_errors.append({'endtime': endtime, 'duration': rng.randint(1, 400)})
+                data = {'version': 1, 'version_string': _POKEY, 'starttime': 1400000000000 + trial * 86400000,
+                        'duration': rng.randint(60, 600), 'raw_errors': raw_errors,
+                        'errors': _normalize_errors(raw_errors), 'pokes': [{}] * rng.randint(0, 12)}
+                _store(_DATA_DB, session_id, {'uid': uid, 'video_url': '', 'data': data})
+                _store(_METADATA_DB, session_id, {'uid': uid, 'context': _CONTEXT_ID, 'activity_string': _POKEY,
+                                                  'result': _PASS if rng.random() < 0.3 else _FAIL, 'trial': trial})
+                _store(_SESSION_INDEX_DB, _key(_CONTEXT_ID, _POKEY, session_id),
+                       {'uid': uid, 'errors': len(data['errors'])})
+
+
+def _bodies():
+    """
+    (label, content type, [chunk, ...]) for each response, chunked as streamed.
+    """
+    session_data = list(_json_object((session_id, session) for _, session_id, session in iter_session_json()))
+    raw_errors = list(_json_array(row for _, rows in iter_raw_errors() for row in rows))
+    table = [chunk.encode('utf-8') if not isinstance(chunk, bytes) else chunk
+             for chunk in _iter_csv(iter_session_table(_CONTEXT_ID, _POKEY, False))]
+    return (('/session_data', 'application/json', session_data), ('/raw_errors', 'application/json', raw_errors),
+            ('csv_export', 'text/csv', table))
+
+
+def _compress(chunks, content_type, level):
+    def app(environ, start_response):
+        start_response(str('200 OK'), [(str('Content-Type'), str(content_type))])
+        return chunks
+
+    environ = {'REQUEST_METHOD': str('GET'), 'HTTP_ACCEPT_ENCODING': str('gzip')}
+    middleware = CompressionMiddleware(app, level=level) if level else app
+    return sum(len(chunk) for chunk in middleware(environ, lambda status, headers, exc_info=None: None))
+
+
+def main(argv=sys.argv):
+    students = int(argv[1]) if len(argv) > 1 else 100
+    attempts = int(argv[2]) if len(argv) > 2 else 20
+    repeats = int(argv[3]) if len(argv) > 3 else 3
+    _populate(students, attempts, random.Random(42))
+    print("{0} students x {1} attempts, best of {2}".format(students, attempts, repeats))
+    for label, content_type, chunks in _bodies():
+        size = sum(len(chunk) for chunk in chunks)
+        print("{0} ({1} chunks)".format(label, len(chunks)))
+        for level in (0,) + _LEVELS:
+            times = list()
+            for _ in range(repeats):
+                start = time.time()
+                compressed = _compress(chunks, content_type, level)
+                times.append(time.time() - start)
+            best = min(times)
+            print("    level {0}: {1:10d} bytes {2:6.1%} {3:9.1f} ms {4:8.1f} MB/s".format(
+                level, compressed, compressed / size, best * 1000, size / best / 1e6 if best else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
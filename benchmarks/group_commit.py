@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Uploads/sec for concurrent result uploads: per-put commits vs. one unit of work per upload vs. group commit.
+
+$ python benchmarks/group_commit.py [threads] [uploads per thread]
+
+Each upload mimics generate_results: write the session data, read-modify-write the user & metadata records and
+delete the session credentials, against a synced (fsync per commit) lmdb environment in a temp directory.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+
+from tempfile import mkdtemp
+
+os.environ.setdefault('LMDB_DATADIR', mkdtemp())    # Keep orthobox's own environment out of the way
+
+import lmdb
+
+from orthobox.lmdb_wrapper import LMDB_Dict, GroupCommitWriter, transaction
+
+_RAW_ERRORS = [{'endtime': 1000 * i, 'duration': 120 + i % 300} for i in range(400)]
+
+
+def _upload(dbs, session_id):
+    sessions, data, users, metadata = dbs
+    data[session_id] = json.dumps({'uid': 'uid', 'data': {'raw_errors': _RAW_ERRORS, 'errors': _RAW_ERRORS[:20]}})
+    user = json.loads(users['user'])
+    user['grade'] = (user['grade'] + 1) % 3
+    users['user'] = json.dumps(user)
+    session = json.loads(metadata[session_id])
+    session['result'] = 'pass'
+    metadata[session_id] = json.dumps(session)
+    del sessions[session_id]
+
+
+def _run(mode, threads, uploads, window, max_batch):
+    path = mkdtemp()
+    env = lmdb.open(path, map_size=2 ** 30, max_dbs=4)
+    writer = GroupCommitWriter(env, window=window, max_batch=max_batch) if mode == 'group commit' else None
+    dbs = tuple(LMDB_Dict(env, name, writer=writer) for name in ('sessions', 'data', 'users', 'metadata'))
+    dbs[2]['user'] = json.dumps({'grade': 0})
+    for i in range(threads * uploads):
+        dbs[0]['s{0}'.format(i)] = '{}'
+        dbs[3]['s{0}'.format(i)] = '{}'
+
+    def worker(offset):
+        for i in range(offset, offset + uploads):
+            session_id = 's{0}'.format(i)
+            if mode == 'per-put commits':
+                _upload(dbs, session_id)
+            elif mode == 'unit of work':
+                with transaction(env, write=True):
+                    _upload(dbs, session_id)
+            else:
+                writer.call(_upload, dbs, session_id)
+
+    workers = [threading.Thread(target=worker, args=(n * uploads,)) for n in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    env.close()
+    shutil.rmtree(path)
+    return threads * uploads / elapsed
+
+
+def main(argv=sys.argv):
+    threads = int(argv[1]) if len(argv) > 1 else 16
+    uploads = int(argv[2]) if len(argv) > 2 else 50
+    print("{0} threads x {1} uploads".format(threads, uploads))
+    for mode in ('per-put commits', 'unit of work'):
+        print("{0:>32}: {1:8.1f} uploads/sec".format(mode, _run(mode, threads, uploads, None, None)))
+    for window in (0.001, 0.005, 0.02):
+        for max_batch in (16, 64):
+            rate = _run('group commit', threads, uploads, window, max_batch)
+            label = "group commit {0:g}ms/{1}".format(window * 1000, max_batch)
+            print("{0:>32}: {1:8.1f} uploads/sec".format(label, rate))
+
+
+if __name__ == '__main__':
+    main()
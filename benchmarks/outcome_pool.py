@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Grade posts/sec to a local stand-in outcome service, with & without the pool of keep-alive outcome sessions.
+
+$ python benchmarks/outcome_pool.py [threads] [posts per thread] [service latency, seconds]
+
+Each post is a signed replaceResult, as sent by the grade outbox workers. Also reports the TCP connections the
+stand-in accepted.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+from collections import defaultdict
+from tempfile import mkdtemp
+
+os.environ.setdefault('LMDB_DATADIR', mkdtemp())    # Keep orthobox's own environment out of the way
+
+from orthobox.outcome_request import OutcomeRequestOAuthlib, SessionPool
+from orthobox.scripts.outcome_stub import make_server
+
+
+def _run(pool, threads, posts, latency):
+    server = make_server(argparse.Namespace(host='127.0.0.1', port=0, latency=latency, jitter=0, error_rate=0,
+                                            quiet=True))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{0}/outcome'.format(server.server_port)
+    OutcomeRequestOAuthlib.session_pool = pool
+
+    def worker(n):
+        for i in range(posts):
+            opts = defaultdict(lambda: None)
+            opts.update({'consumer_key': 'key', 'consumer_secret': 'secret', 'lis_outcome_service_url': url,
+                         'lis_result_sourcedid': 'sourcedid-{0}-{1}'.format(n, i)})
+            request = OutcomeRequestOAuthlib(opts=opts)
+            request.message_identifier = 'message-{0}-{1}'.format(n, i)
+            assert request.post_replace_result(0.33).is_success()
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.time()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    elapsed = time.time() - start
+    if pool is not None:
+        pool.close()
+    server.shutdown()
+    server.server_close()
+    return threads * posts / elapsed, server.connections
+
+
+def main(argv=sys.argv):
+    threads = int(argv[1]) if len(argv) > 1 else 4
+    posts = int(argv[2]) if len(argv) > 2 else 250
+    latency = float(argv[3]) if len(argv) > 3 else 0.0
+    print("{0} threads x {1} posts, {2:g}s service latency".format(threads, posts, latency))
+    for label, pool in (('new session per post', None), ('session pool', SessionPool())):
+        rate, connections = _run(pool, threads, posts, latency)
+        print("{0:>24}: {1:8.1f} posts/sec, {2} connections".format(label, rate, connections))
+
+
+if __name__ == '__main__':
+    main()
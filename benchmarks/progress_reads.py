@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Read time of the instructor progress page for one course: a transaction per lookup vs. batched reads in one.
+
+$ python benchmarks/progress_reads.py [students] [attempts per student] [repeats]
+
+Only the data_store reads are timed, not rendering; each mode keeps what the page would render. Modes:
+    per-session reads: moodle ids per student, data & metadata per session, as before progress summaries
+    per-user reads: moodle ids & progress summary per student
+    batched: get_ids_from_moodle_uids & get_progress_summaries in one unit of work, as /progress_graphs
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import time
+import random
+
+from tempfile import mkdtemp
+
+os.environ.setdefault('LMDB_DATADIR', mkdtemp())    # Keep orthobox's own environment out of the way
+
+from orthobox.evaluation import _normalize_errors
+from orthobox.data_store import (_MOODLE_DB, _USERS_DB, _USER_SESSIONS_DB, _DATA_DB, _METADATA_DB, _POKEY, _PASS,
+                                 _FAIL, _key, _prefix, _store, _new_user, unit_of_work, store_progress,
+                                 get_users_by_context_id, get_user_data_by_context_id, get_ids_from_moodle_uid,
+                                 get_ids_from_moodle_uids, get_session_data, get_metadata,
+                                 get_progress_summary, get_progress_summaries)
+
+_CONTEXT_ID = 'c' * 40
+
+
+def _populate(students, attempts, rng):
+    for student in range(students):
+        with unit_of_work(write=True):
+            moodle_uid, uid = '{0:040x}'.format(student), '{0:032x}'.format(student)
+            _store(_MOODLE_DB, moodle_uid, {'uid': uid, 'username': 'Student {0}'.format(student)})
+            _store(_USERS_DB, _key(_CONTEXT_ID, uid), _new_user(moodle_uid))
+            for trial in range(1, attempts + 1):
+                session_id = '{0:016x}{1:016x}'.format(student, trial)
+                _USER_SESSIONS_DB.append(_prefix(_CONTEXT_ID, uid, _POKEY), session_id)
+                endtime, raw_errors = 0, list()
+                for _ in range(rng.randint(50, 600)):
+                    endtime += rng.randint(5, 900)
+                    raw_errors.append({'endtime': endtime, 'duration': rng.randint(1, 400)})
+                data = {'version': 1, 'version_string': _POKEY, 'starttime': 1400000000000, 'duration': 120,
+                        'raw_errors': raw_errors, 'errors': _normalize_errors(raw_errors)}
+                result = _PASS if rng.random() < 0.3 else _FAIL
+                _store(_DATA_DB, session_id, {'uid': uid, 'video_url': '', 'data': data})
+                _store(_METADATA_DB, session_id, {'uid': uid, 'context': _CONTEXT_ID, 'activity_string': _POKEY,
+                                                  'result': result, 'trial': trial})
+                store_progress(session_id, data, result)
+
+
+def _per_session_reads():
+    page = list()
+    for uid, user in get_user_data_by_context_id(_CONTEXT_ID).items():
+        durations = list()
+        for session_id in user[_POKEY]['sessions']:
+            durations.append((get_session_data(session_id)['duration'], get_metadata(session_id)['result']))
+        page.append((get_ids_from_moodle_uid(user['moodle_uid']), durations))
+    return page
+
+
+def _per_user_reads():
+    page = list()
+    for uid, user in get_users_by_context_id(_CONTEXT_ID).items():
+        page.append((get_ids_from_moodle_uid(user['moodle_uid']), get_progress_summary(uid, _CONTEXT_ID, _POKEY)))
+    return page
+
+
+def _batched():
+    with unit_of_work():
+        users = list(get_users_by_context_id(_CONTEXT_ID).items())
+        moodle_ids = get_ids_from_moodle_uids([user['moodle_uid'] for _, user in users])
+        summaries = get_progress_summaries([uid for uid, _ in users], _CONTEXT_ID, _POKEY)
+    return list(zip(moodle_ids, summaries))
+
+
+def main(argv=sys.argv):
+    students = int(argv[1]) if len(argv) > 1 else 300
+    attempts = int(argv[2]) if len(argv) > 2 else 20
+    repeats = int(argv[3]) if len(argv) > 3 else 5
+    _populate(students, attempts, random.Random(42))
+    print("{0} students x {1} attempts, best of {2}".format(students, attempts, repeats))
+    for label, read in (('per-session reads', _per_session_reads), ('per-user reads', _per_user_reads),
+                        ('batched', _batched)):
+        times = list()
+        for _ in range(repeats):
+            start = time.time()
+            read()
+            times.append(time.time() - start)
+        print("{0:>24}: {1:10.1f} ms/page".format(label, min(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
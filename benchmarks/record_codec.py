@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk size and encode/decode time of data records under each orthobox.record_codec codec.
+
+$ python benchmarks/record_codec.py [sessions]
+
+The corpus mimics stored uploads: Pokey & Peggy sessions with a few hundred to a few thousand raw error contacts,
+their normalized errors, drops and pokes.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import time
+import random
+import shutil
+
+from tempfile import mkdtemp
+
+os.environ.setdefault('LMDB_DATADIR', mkdtemp())    # Keep orthobox's own environment out of the way
+
+import lmdb
+
+from orthobox.record_codec import CODECS
+from orthobox.evaluation import _normalize_errors
+
+
+def _session(rng):
+    box = rng.choice((1, 2))
+    duration = rng.randint(60000, 300000)
+    endtime, raw_errors = 0, list()
+    for _ in range(int(rng.lognormvariate(5.5, 0.8))):
+        endtime += rng.randint(5, 900)
+        raw_errors.append({'endtime': endtime, 'duration': rng.randint(1, 400)})
+    data = {'version': box,
+            'version_string': 'pokey' if box == 1 else 'peggy',
+            'starttime': 1400000000000 + rng.randint(0, 10 ** 10),
+            'duration': duration // 1000,
+            'raw_errors': raw_errors,
+            'errors': _normalize_errors(raw_errors),
+            'drops': [{'endtime': rng.randint(0, duration)} for _ in range(rng.randint(0, 6) * (box == 2))],
+            'pokes': [{'endtime': rng.randint(0, duration)} for _ in range(rng.randint(5, 12) * (box == 1))]}
+    return {'uid': '{0:032x}'.format(rng.getrandbits(128)),
+            'video_url': 'https://s3.amazonaws.com/orthoboxes-video/x.mp4',
+            'data': data}
+
+
+def _measure(codec, corpus):
+    start = time.time()
+    encoded = [codec.dumps(record) for record in corpus]
+    encode_time = time.time() - start
+
+    path = mkdtemp()
+    env = lmdb.open(path, map_size=2 ** 32)
+    with env.begin(write=True) as txn:
+        for i, value in enumerate(encoded):
+            txn.put('{0:032x}'.format(i).encode('ascii'), value)
+    on_disk = (env.info()['last_pgno'] + 1) * env.stat()['psize']
+
+    start = time.time()
+    with env.begin(buffers=True) as txn:
+        for _, value in txn.cursor():
+            codec.loads(value)
+    decode_time = time.time() - start
+    env.close()
+    shutil.rmtree(path)
+    return sum(map(len, encoded)), on_disk, encode_time, decode_time
+
+
+def main(argv=sys.argv):
+    sessions = int(argv[1]) if len(argv) > 1 else 2000
+    rng = random.Random(42)
+    corpus = [_session(rng) for _ in range(sessions)]
+    events = sum(len(r['data']['raw_errors']) for r in corpus)
+    print("{0} sessions, {1} raw error events".format(sessions, events))
+    print("{0:>12} {1:>12} {2:>12} {3:>10} {4:>10}".format('codec', 'bytes', 'on disk', 'encode s', 'decode s'))
+    for name in ('json', 'binary', 'binary-zlib'):
+        size, on_disk, encode_time, decode_time = _measure(CODECS[name], corpus)
+        print("{0:>12} {1:>12} {2:>12} {3:>10.3f} {4:>10.3f}".format(name, size, on_disk, encode_time, decode_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,6 @@ Main entry point
 """
 from pyramid.config import Configurator
 
-from orthobox import data_store; del data_store    # Instantiate DB
-
 def _custom_config(config):
     # TODO: See if traversal & cornice will play nicely enough
     config.include("cornice")
@@ -15,10 +13,16 @@ def _custom_config(config):
     config.add_route('lti_launch', 'launch')
     config.add_route('lti_progress', 'progress')
     config.add_route('lti_csv_export', 'csv_export')
+    config.add_route('lti_grade_resync', 'grade_resync')
     config.scan("orthobox.lti_views")
     return config
 
 def main(global_config, **settings):
+    # Importing these instantiates the DB, done here so importing orthobox (eg. the tests) leaves LMDB_DATADIR open
+    from orthobox.grade_outbox import OUTBOX
+    from orthobox.rest_views import NOTIFIER
     config = Configurator(settings=settings)
     config = _custom_config(config)
+    OUTBOX.start()  # Grade passback workers
+    NOTIFIER.start()    # Result notification for waiting pages, on its own port
     return config.make_wsgi_app()
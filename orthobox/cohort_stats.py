@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Running class statistics of one course context & activity, updated as each session's results are stored.
+
+Kept as counts & sums plus fixed-bin histograms of session duration, error duration and attempts to mastery (the
+trial at which a user's grade first reached 100%), so adding a session is O(1) and two sets of statistics merge by
+adding them up. Quantiles are read off the histograms, interpolating within a bin, so they're exact to a bin width;
+values past the last bin are clamped to the largest seen.
+
+Records are plain JSON, see data_store cohort_stats. summarize() gives what /cohort_stats serves.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+_DURATION_BINS = (10, 60)   # Width & number of bins, plus one for everything past them: seconds
+_ERROR_DURATION_BINS = (100, 50)    # ms
+_ATTEMPT_BINS = (1, 30)     # trials
+
+_QUANTILES = (('p25', 0.25), ('median', 0.5), ('p75', 0.75), ('p90', 0.9))
+
+
+def empty_stats():
+    return {'sessions': 0, 'results': dict(), 'errors': 0,
+            'duration': _histogram(*_DURATION_BINS),
+            'error_duration': _histogram(*_ERROR_DURATION_BINS),
+            'attempts_to_mastery': _histogram(*_ATTEMPT_BINS)}
+
+
+def add_session(stats, result, duration, error_durations):
+    """
+    Count a session evaluated as result, duration seconds long with normalized errors error_durations ms long.
+    """
+    stats['sessions'] += 1
+    stats['results'][result] = stats['results'].get(result, 0) + 1
+    stats['errors'] += len(error_durations)
+    _add(stats['duration'], duration)
+    for error_duration in error_durations:
+        _add(stats['error_duration'], error_duration)
+
+
+def add_mastery(stats, attempts):
+    """
+    Count a user reaching full grade for the first time at trial attempts.
+    """
+    _add(stats['attempts_to_mastery'], attempts)
+
+
+def merge(stats, other):
+    """
+    Add other's counts to stats, for statistics over several contexts. Histograms must have the same bins.
+    """
+    stats['sessions'] += other['sessions']
+    stats['errors'] += other['errors']
+    for result, count in other['results'].items():
+        stats['results'][result] = stats['results'].get(result, 0) + count
+    for name in ('duration', 'error_duration', 'attempts_to_mastery'):
+        histogram, adding = stats[name], other[name]
+        if histogram['width'] != adding['width'] or len(histogram['bins']) != len(adding['bins']):
+            raise ValueError("Can't merge {0} histograms with different bins".format(name))
+        histogram['count'] += adding['count']
+        histogram['sum'] += adding['sum']
+        histogram['bins'] = [a + b for a, b in zip(histogram['bins'], adding['bins'])]
+        for bound, pick in (('min', min), ('max', max)):
+            values = [value for value in (histogram[bound], adding[bound]) if value is not None]
+            histogram[bound] = pick(values) if values else None
+    return stats
+
+
+def summarize(stats):
+    """
+    Class-level figures: {'sessions', 'results', 'pass_rate', 'errors_per_session', 'duration', 'error_duration',
+    'mastered', 'attempts_to_mastery'}, each histogram as {'count', 'mean', 'min', 'max', 'p25', 'median', 'p75',
+    'p90', 'width', 'bins'}.
+    """
+    sessions = stats['sessions']
+    return {'sessions': sessions,
+            'results': stats['results'],
+            'pass_rate': stats['results'].get('pass', 0) / sessions if sessions else None,
+            'errors_per_session': stats['errors'] / sessions if sessions else None,
+            'duration': _summarize(stats['duration']),
+            'error_duration': _summarize(stats['error_duration']),
+            'mastered': stats['attempts_to_mastery']['count'],
+            'attempts_to_mastery': _summarize(stats['attempts_to_mastery'])}
+
+
+def _histogram(width, bins):
+    return {'width': width, 'bins': [0] * (bins + 1), 'count': 0, 'sum': 0, 'min': None, 'max': None}
+
+
+def _add(histogram, value):
+    histogram['bins'][max(0, min(int(value // histogram['width']), len(histogram['bins']) - 1))] += 1
+    histogram['count'] += 1
+    histogram['sum'] += value
+    histogram['min'] = value if histogram['min'] is None else min(histogram['min'], value)
+    histogram['max'] = value if histogram['max'] is None else max(histogram['max'], value)
+
+
+def _summarize(histogram):
+    count = histogram['count']
+    summary = {'count': count, 'mean': histogram['sum'] / count if count else None, 'min': histogram['min'],
+               'max': histogram['max'], 'width': histogram['width'], 'bins': histogram['bins']}
+    for name, q in _QUANTILES:
+        summary[name] = _quantile(histogram, q) if count else None
+    return summary
+
+
+def _quantile(histogram, q):
+    """
+    The q quantile, interpolated linearly within its bin and clamped to the values seen.
+    """
+    width, target, seen = histogram['width'], q * histogram['count'], 0
+    for i, count in enumerate(histogram['bins']):
+        if count and seen + count >= target:
+            value = (i + (target - seen) / count) * width
+            return min(max(value, histogram['min']), histogram['max'])
+        seen += count
+    return histogram['max']
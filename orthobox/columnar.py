@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export of uploaded sessions as NumPy arrays, for analysis without parsing the JSON or CSV exports.
+
+One row per uploaded session in SESSION_COLUMNS, plus each session's events flattened end to end per EVENT_FIELDS: the
+errors of session i are '<events>.<field>'[offsets[i]:offsets[i + 1]] with offsets = '<events>.offsets' (one longer
+than the sessions), see session_events. Event values are float64, NaN where an event lacks the field; missing
+session values are -1, NaN or empty. Text columns are byte strings as wide as their longest value, so nothing is
+truncated.
+
+Written as either:
+npz: a zip of .npy files, deflate compressed, for downloading. np.load reads each column on first access.
+npy: a directory of .npy files, which load_columns memory maps, so opening is instant whatever the size and only the
+     pages read are loaded.
+
+Columns are built _CHUNK sessions at a time and appended to a file per column, so memory use doesn't grow with the
+number of sessions.
+
+Needs numpy, not required by the application: pip install orthobox[numpy]
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import shutil
+import zipfile
+import tempfile
+
+from numbers import Real
+from itertools import islice
+
+import numpy as np
+
+from orthobox.data_store import iter_sessions, get_metadata_many
+
+FORMATS = ('npz', 'npy')
+
+SESSION_COLUMNS = (('session_id', 'S'), ('uid', 'S'), ('context', 'S'), ('box_type', 'S'), ('trial', 'i8'),
+                   ('starttime', 'i8'), ('duration', 'i8'), ('result', 'S'), ('grade', 'f8'),
+                   ('n_errors', 'i8'), ('n_raw_errors', 'i8'), ('n_drops', 'i8'), ('n_pokes', 'i8'))
+
+EVENT_FIELDS = (('errors', ('endtime', 'duration', 'error_count')),
+                ('raw_errors', ('endtime', 'duration')),
+                ('drops', ('endtime',)),
+                ('pokes', ('endtime',)))
+
+_CHUNK = 1024   # Sessions per chunk of columns
+_COPY_BUFFER = 1024 * 1024
+_MISSING = {'i': -1, 'f': float('nan'), 'S': b''}
+
+
+def export_columns(path, format='npz', context_id=None, box_type=None, chunk=_CHUNK):
+    """
+    Write every uploaded session, or only those in context_id and/or box_type, to path in format. Returns the number
+    of sessions written. path is replaced once complete.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown format {0}, expected one of {1}".format(format, ', '.join(FORMATS)))
+    workdir = tempfile.mkdtemp(prefix='.columns-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        count, columns = _write_columns(workdir, context_id, box_type, chunk)
+        output = os.path.join(workdir, 'output')
+        if format == 'npz':
+            with open(output, 'wb') as archive:
+                _write_npz(archive, columns)
+        else:
+            os.mkdir(output)
+            for name, column in columns:
+                column.finish(os.path.join(output, name + '.npy'))
+        _replace(output, path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return count
+
+
+def write_npz(archive, context_id=None, box_type=None, chunk=_CHUNK):
+    """
+    export_columns in npz format to archive, a seekable file object, eg. for a response body. Returns the number of
+    sessions written.
+    """
+    workdir = tempfile.mkdtemp(prefix='orthobox-columns-')
+    try:
+        count, columns = _write_columns(workdir, context_id, box_type, chunk)
+        _write_npz(archive, columns)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return count
+
+
+def load_columns(path):
+    """
+    {name: array} from an export. Arrays of an npy directory are memory mapped read-only; those of an npz archive
+    are decompressed as they're looked up.
+    """
+    if os.path.isdir(path):
+        return dict((name[:-len('.npy')], np.load(os.path.join(path, name), mmap_mode='r'))
+                    for name in os.listdir(path) if name.endswith('.npy'))
+    return np.load(path)
+
+
+def session_events(columns, events, i):
+    """
+    {field: array} of the events ('errors', 'raw_errors', 'drops' or 'pokes') of the i'th session in columns.
+    """
+    offsets = columns[events + '.offsets']
+    start, end = offsets[i], offsets[i + 1]
+    return dict((field, columns['{0}.{1}'.format(events, field)][start:end]) for field in dict(EVENT_FIELDS)[events])
+
+
+def _write_columns(workdir, context_id, box_type, chunk):
+    """
+    Build every column in workdir. Returns (number of sessions, [(name, _ColumnFile), ...]).
+    """
+    columns = [(name, _ColumnFile(workdir, name, dtype)) for name, dtype in SESSION_COLUMNS]
+    offsets = list()
+    for events, fields in EVENT_FIELDS:
+        offset_column = _ColumnFile(workdir, events + '.offsets', 'i8')
+        offset_column.append(np.zeros(1, dtype='i8'))
+        offsets.append((events, fields, offset_column))
+        columns.append((events + '.offsets', offset_column))
+        columns.extend(('{0}.{1}'.format(events, field), _ColumnFile(workdir, '{0}.{1}'.format(events, field), 'f8'))
+                       for field in fields)
+    by_name = dict(columns)
+
+    count, totals = 0, dict.fromkeys(dict(EVENT_FIELDS), 0)
+    sessions = ((session_id, session) for _, session_id, session in iter_sessions(context_id=context_id,
+                                                                                   box_type=box_type)
+                if session.get('data'))
+    while True:
+        batch = list(islice(sessions, chunk))
+        if not batch:
+            break
+        metadata = [record or {} for record in get_metadata_many([session_id for session_id, _ in batch])]
+        rows = [_session_row(session_id, session, record) for (session_id, session), record in zip(batch, metadata)]
+        for i, (name, dtype) in enumerate(SESSION_COLUMNS):
+            by_name[name].append(np.array([row[i] for row in rows], dtype=dtype))
+        for events, fields, offset_column in offsets:
+            lists = [session['data'].get(events) or [] for _, session in batch]
+            offset_column.append(totals[events] + np.cumsum([len(items) for items in lists], dtype='i8'))
+            totals[events] += sum(len(items) for items in lists)
+            flat = [item for items in lists for item in items]
+            for field in fields:
+                by_name['{0}.{1}'.format(events, field)].append(
+                    np.array([_event_value(item, events, field) for item in flat], dtype='f8'))
+        count += len(batch)
+    return count, columns
+
+
+def _session_row(session_id, session, metadata):
+    """
+    Values of SESSION_COLUMNS for a session, missing ones as _MISSING.
+    """
+    data = session['data']
+    values = (session_id, session.get('uid'), metadata.get('context'), data.get('version_string'),
+              metadata.get('trial'), data.get('starttime'), data.get('duration'), metadata.get('result'),
+              metadata.get('grade'), len(data.get('errors') or []), len(data.get('raw_errors') or []),
+              len(data.get('drops') or []), len(data.get('pokes') or []))
+    return [_MISSING[np.dtype(dtype).kind] if value is None else _bytes(value)
+            for value, (_, dtype) in zip(values, SESSION_COLUMNS)]
+
+
+def _event_value(event, events, field):
+    if not isinstance(event, dict):
+        return float('nan')
+    if events == 'raw_errors' and field == 'duration':  # Raw errors may give their length as 'len'
+        value = event.get('duration', event.get('len'))
+    else:
+        value = event.get(field)
+    return value if isinstance(value, Real) and not isinstance(value, bool) else float('nan')
+
+
+def _bytes(value):
+    return value.encode('utf-8') if isinstance(value, type('')) else value
+
+
+def _write_npz(archive, columns):
+    """
+    Zip each finished column into archive, streamed from disk.
+    """
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as npz:
+        for name, column in columns:
+            npy = column.path + '.npy'
+            column.finish(npy)
+            npz.write(npy, str(name + '.npy'))
+            os.remove(npy)
+
+
+def _replace(output, path):
+    """
+    Move output to path, replacing any earlier export there.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path) and os.path.isdir(output):
+        os.remove(path)
+    os.rename(output, path)
+
+
+class _ColumnFile(object):
+    """
+    One column, appended to a file of raw values chunk by chunk, made into a .npy file by finish.
+
+    A byte string column ('S') is sized to the longest value appended: values written so far are rewritten wider
+    when a longer one comes along, which happens at most once per byte of the final width.
+    """
+    def __init__(self, workdir, name, dtype):
+        self.path = os.path.join(workdir, name)
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind == 'S':
+            self.dtype = np.dtype((np.bytes_, max(self.dtype.itemsize, 1)))
+        self.length = 0
+        self.file = open(self.path, 'wb')
+
+    def append(self, values):
+        if self.dtype.kind == 'S' and values.dtype.itemsize > self.dtype.itemsize:
+            self._widen(values.dtype)
+        values.astype(self.dtype, copy=False).tofile(self.file)
+        self.length += len(values)
+
+    def _widen(self, dtype):
+        """
+        Rewrite the values so far as dtype, a wider byte string.
+        """
+        self.file.close()
+        narrow = self.path + '.narrow'
+        os.rename(self.path, narrow)
+        count = max(_COPY_BUFFER // self.dtype.itemsize, 1)
+        with open(narrow, 'rb') as raw, open(self.path, 'wb') as wide:
+            for _ in range(0, self.length, count):
+                np.fromfile(raw, dtype=self.dtype, count=count).astype(dtype).tofile(wide)
+        os.remove(narrow)
+        self.dtype = dtype
+        self.file = open(self.path, 'ab')
+
+    def finish(self, path):
+        """
+        Write the column as a .npy file at path and remove the raw values.
+        """
+        self.file.close()
+        with open(path, 'wb') as npy, open(self.path, 'rb') as raw:
+            np.lib.format.write_array_header_1_0(npy, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                       'fortran_order': False, 'shape': (self.length,)})
+            shutil.copyfileobj(raw, npy, _COPY_BUFFER)
+        os.remove(self.path)
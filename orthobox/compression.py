@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI middleware compressing text responses with gzip or deflate, as negotiated by Accept-Encoding.
+
+Bodies are compressed chunk by chunk as the application's app_iter yields them, so streamed exports stay streamed.
+Responses are sent as they are if they are small (a Content-Length under min_size, or a body ending before min_size
+bytes), already encoded, not a compressible content type, or answering HEAD. Compressed responses get Vary:
+Accept-Encoding and their ETag tagged with the encoding, which is stripped from If-None-Match on the way in so
+conditional requests still match the application's ETags. A 304 answering a tagged If-None-Match is tagged to match.
+
+In a paste pipeline, see orthobox.ini:
+
+    [filter:compress]
+    use = egg:orthobox#compress
+    level = 6
+    min_size = 1024
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import re
+import zlib
+
+_LEVEL = 6
+_MIN_SIZE = 1024
+_TYPES = ('text/html', 'text/plain', 'text/csv', 'text/css', 'text/xml', 'application/json', 'application/x-ndjson',
+          'application/javascript', 'application/xml')
+
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}   # HTTP deflate is zlib wrapped
+_ETAG_SUFFIX = re.compile(r'-(?:gzip|deflate)"')
+
+
+class CompressionMiddleware(object):
+    def __init__(self, app, level=_LEVEL, min_size=_MIN_SIZE, types=_TYPES):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.types = frozenset(types)
+
+    def __call__(self, environ, start_response):
+        encoding = _negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            environ['HTTP_IF_NONE_MATCH'] = _ETAG_SUFFIX.sub('"', if_none_match)
+
+        response = list()
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]     # Nothing is sent before the app returns, so just replace
+            return _no_write
+
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = response    # Pyramid starts the response before returning app_iter
+        if status[:3] == '304' and if_none_match != environ['HTTP_IF_NONE_MATCH']:   # Validating a compressed copy
+            headers = _tag_etags(headers, encoding)
+        return self._respond(app_iter, start_response, encoding, status, headers, exc_info)
+
+    def _respond(self, app_iter, start_response, encoding, status, headers, exc_info):
+        if not self._compressible(status, headers):
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        # Read up to min_size bytes, to tell small streamed bodies from large ones
+        chunks = iter(app_iter)
+        head, size = list(), 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.min_size:
+                break
+        else:
+            start_response(status, headers, exc_info)
+            return _close_after(head, app_iter)
+
+        headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+        headers = _tag_etags(_add_vary(headers), encoding)
+        headers.append((str('Content-Encoding'), str(encoding)))
+        start_response(status, headers, exc_info)
+        return self._compress(head, chunks, app_iter, encoding)
+
+    def _compressible(self, status, headers):
+        if status[:3] in ('204', '206', '304'):
+            return False
+        content_type = content_length = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'content-type':
+                content_type = value.split(';', 1)[0].strip().lower()
+            elif name == 'content-length':
+                content_length = value
+        if content_type not in self.types:
+            return False
+        return content_length is None or int(content_length) >= self.min_size
+
+    def _compress(self, head, chunks, app_iter, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+        try:
+            for chunk in head:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            for chunk in chunks:
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def _negotiate(accept_encoding):
+    """
+    'gzip', 'deflate' or None from an Accept-Encoding header, preferring gzip at equal quality.
+    """
+    qualities = dict()
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            qualities[coding] = q
+    best, best_q = None, 0.0
+    for coding in ('gzip', 'deflate'):
+        q = qualities.get(coding, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def _add_vary(headers):
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if 'accept-encoding' not in value.lower():
+                headers[i] = (name, str('{0}, Accept-Encoding'.format(value)))
+            return headers
+    return headers + [(str('Vary'), str('Accept-Encoding'))]
+
+
+def _tag_etags(headers, encoding):
+    return [(name, _tag_etag(value, encoding) if name.lower() == 'etag' else value) for name, value in headers]
+
+
+def _tag_etag(etag, encoding):
+    if etag.endswith('"'):
+        return str('{0}-{1}"'.format(etag[:-1], encoding))
+    return etag
+
+
+def _close_after(head, app_iter):
+    try:
+        for chunk in head:
+            yield chunk
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def _no_write(data):
+    raise NotImplementedError("Compressed responses must be returned as app_iter, not written")
+
+
+def filter_app_factory(app, global_conf, level=_LEVEL, min_size=_MIN_SIZE, types=None):
+    """
+    Paste filter: egg:orthobox#compress, with optional level, min_size & whitespace separated types.
+    """
+    return CompressionMiddleware(app, int(level), int(min_size), types.split() if types else _TYPES)
@@ -4,9 +4,13 @@ Use lmdb as backend.
 
 Database schema:
 
-1 lmdb environment, 7 databases: sessions, data, metadata, users, moodle, oauth, unregistered_oauth
+1 lmdb environment, 20 databases: sessions, data, metadata, users, user_sessions, outcomes, moodle, oauth,
+                                  unregistered_oauth, session_index, progress, outbox, outbox_schedule, criteria,
+                                  cohort_stats, meta, nonces_0, nonces_1, nonces_2, nonces_periods
 DB keys: utf-8 encoded text
-DB values: utf-8 encoded JSON
+DB values: records serialized by each LMDB_Dict's codec, utf-8 encoded JSON unless configured otherwise (see
+           orthobox.record_codec), except oauth & unregistered_oauth & outbox_schedule & meta & nonces_* which hold
+           plain utf-8 text
 
 uid = uuid4().hex
 session_id = uuid4().hex
@@ -37,15 +41,28 @@ metadata = {
                  'result': <pass/fail/incomplete status>,
                  'grade': <completion percentage after session, eg. 0%, 33%, 66%, 100%>,
                  'version_string': <activity version string>,
-                 'return_url': <lti spec 'launch_presentation_return_url'>}
+                 'trial': <1-indexed attempt number of the user at activity_string>,
+                 'return_url': <lti spec 'launch_presentation_return_url'>,
+                 'evaluated': <true once results are uploaded & stored>,
+                 'revision': <incremented on every write, stamps pages showing the session>}
 }
 
 users = {
-    context_id: {uid: {'moodle_uid': moodle_uid,
+    'context_id:uid': {'moodle_uid': moodle_uid,
                        'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>},
+                                 'mastered': <trial at which grade first reached 100%, if it has>},
                        'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>}}}
+                                 'mastered': <trial at which grade first reached 100%, if it has>}}
+}
+
+user_sessions = {   # Append-only, in launch order
+    'context_id:uid:box_type:<8 digit sequence>': session_id
+}
+
+outcomes = {    # From the latest launch as an outcome service, for re-posting grades
+    'context_id:uid:box_type': {'oauth_consumer_key': oauth_consumer_key,
+                                'lis_outcome_service_url': lis_outcome_service_url,
+                                'lis_result_sourcedid': lis_result_sourcedid}
 }
 
 moodle = {
@@ -61,36 +78,149 @@ unregistered_oauth = {
     oauth_consumer_key: oauth_consumer_secret
 }
 Note: Keys are created in unregistered, then moved to oauth once associated with moodle_resource_id
+
+session_index = {
+    'context_id:box_type:session_id': {'uid': uid, 'errors': <number of normalized errors uploaded>}
+}
+Note: Secondary index of data by context, box_type follows the uploaded version_string. Exports range scan a prefix.
+
+progress = {     # Progress page graphs, updated as each session is evaluated. Points are ordered by trial.
+    'context_id:uid:box_type': {'not_passing': [[trial, duration], ...],
+                                'passing': [[trial, duration], ...],
+                                'all_errors': [[trial, end time, start time], ...],
+                                'drops': [[trial, drop time], ...],
+                                'hover_data': [[number of errors for not_passing, ...], [... for passing],
+                                               [error length, ...], [drop time, ...]],
+                                'revision': <incremented on every write>}
+}
+
+outbox = {   # Grade passback queue, delivered by orthobox.grade_outbox. One pending grade per outcome.
+    target: {'session_id': session_id,
+             'grade': grade,
+             'params': tool_provider.params,
+             'enqueued': <time queued>,
+             'attempts': <delivery attempts so far>,
+             'due': <outbox_schedule key>,
+             'token': <claim token of the delivery in flight, or null>,
+             'leased_until': <time the delivery in flight is given up on, or null>,
+             'error': <last delivery error>}
+    'failed:target': <as above, for grades given up on after the last attempt>
+}
+Note: target = sha1(lis_outcome_service_url + lis_result_sourcedid), a newer grade for an outcome replaces the old.
+
+outbox_schedule = {
+    '<due time, 15 digit ms>:target': ''
+}
+Note: Pending outbox entries in delivery order.
+
+criteria = {   # Evaluation criteria set through /configure, see orthobox.evaluation.get_criteria
+    'context_id:box_type': {criterion: value, ...}
+    'default:box_type': <as above, for contexts without their own>
+}
+
+cohort_stats = {   # Class statistics, updated as each session is evaluated, see orthobox.cohort_stats
+    'context_id:box_type': {'sessions': <number evaluated>,
+                            'results': {result: <number of sessions>, ...},
+                            'errors': <number of normalized errors>,
+                            'duration': <histogram of session durations, seconds>,
+                            'error_duration': <histogram of normalized error durations, ms>,
+                            'attempts_to_mastery': <histogram of users' 'mastered' trials>}
+}
+Note: box_type follows the uploaded version_string. Rebuilt from data & metadata by rebuild_cohort_stats.
+
+meta = {
+    'schema_version': <int, see _SCHEMA_VERSION>,
+    'credentials_generation': <int, bumped when oauth, unregistered_oauth or moodle resource credentials change>,
+    'criteria_generation': <int, bumped when criteria change>,
+    'graph_secret': <key signing progress graph tokens, created on first use>
+}
+
+nonces_<slot> = {   # OAuth nonces first seen in one hour, see orthobox.nonce_store.LMDBNonceStore
+    oauth_nonce: <time first seen>
+}
+
+nonces_periods = {
+    slot: <hour held by nonces_<slot>, time // 3600>
+}
+Note: Only used with OAUTH_NONCE_STORE=lmdb, the default.
 """
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
 import lmdb
-import json
 import time
 
+from hashlib import sha1
+
 from os import environ
 from uuid import uuid4
 
-from orthobox.lmdb_wrapper import LMDB_Dict
+from repoze.lru import ExpiringLRUCache
+
+from orthobox.lmdb_wrapper import LMDB_Dict, GroupCommitWriter, transaction
+from orthobox.record_codec import CODECS
+from orthobox.nonce_store import MemoryNonceStore, LMDBNonceStore
+from orthobox.cohort_stats import empty_stats, add_session, add_mastery
 
 _10_GB = 10737418240  # Size of address-space for mmap, largest capacity for environment, not a memory requirement.
 
 _LMDB_DATADIR = environ.get('LMDB_DATADIR', 'lmdb_data')
-_LMDB_ENV = lmdb.open(_LMDB_DATADIR, map_size=_10_GB, max_dbs=7)
-
-_SESSIONS_DB = LMDB_Dict(_LMDB_ENV, 'sessions')
-_DATA_DB = LMDB_Dict(_LMDB_ENV, 'data')
-_USERS_DB = LMDB_Dict(_LMDB_ENV, 'users')
-_METADATA_DB = LMDB_Dict(_LMDB_ENV, 'metadata')
-_MOODLE_DB = LMDB_Dict(_LMDB_ENV, 'moodle')
-_OAUTH_DB = LMDB_Dict(_LMDB_ENV, 'oauth')
-_UNREGISTERED_OAUTH = LMDB_Dict(_LMDB_ENV, 'unregistered_oauth')
-
-_DATABASES = (_SESSIONS_DB, _DATA_DB, _USERS_DB, _METADATA_DB, _MOODLE_DB, _UNREGISTERED_OAUTH, _OAUTH_DB)
-
-_encode = json.dumps
-_decode = json.loads
+_MAX_DBS = 20
+_LMDB_ENV = lmdb.open(_LMDB_DATADIR, map_size=_10_GB, max_dbs=_MAX_DBS)
+
+# Optional group commit of concurrent writes, enabled by setting a batching window. See GroupCommitWriter.
+_GROUP_COMMIT_WINDOW_MS = environ.get('LMDB_GROUP_COMMIT_WINDOW_MS')
+_GROUP_COMMIT_MAX_BATCH = int(environ.get('LMDB_GROUP_COMMIT_MAX_BATCH', 64))
+_WRITER = GroupCommitWriter(_LMDB_ENV, window=float(_GROUP_COMMIT_WINDOW_MS) / 1000,
+                            max_batch=_GROUP_COMMIT_MAX_BATCH) if _GROUP_COMMIT_WINDOW_MS else None
+
+# Codec for new data records: 'json', 'binary' or 'binary-zlib'. Records in any of these formats remain readable.
+_DATA_CODEC = CODECS[environ.get('LMDB_DATA_CODEC', 'json')]
+
+_SESSIONS_DB = LMDB_Dict(_LMDB_ENV, 'sessions', writer=_WRITER)
+_DATA_DB = LMDB_Dict(_LMDB_ENV, 'data', writer=_WRITER, codec=_DATA_CODEC)
+_USERS_DB = LMDB_Dict(_LMDB_ENV, 'users', writer=_WRITER)
+_USER_SESSIONS_DB = LMDB_Dict(_LMDB_ENV, 'user_sessions', writer=_WRITER)
+_OUTCOMES_DB = LMDB_Dict(_LMDB_ENV, 'outcomes', writer=_WRITER)
+_METADATA_DB = LMDB_Dict(_LMDB_ENV, 'metadata', writer=_WRITER)
+_MOODLE_DB = LMDB_Dict(_LMDB_ENV, 'moodle', writer=_WRITER)
+_OAUTH_DB = LMDB_Dict(_LMDB_ENV, 'oauth', writer=_WRITER)
+_UNREGISTERED_OAUTH = LMDB_Dict(_LMDB_ENV, 'unregistered_oauth', writer=_WRITER)
+_SESSION_INDEX_DB = LMDB_Dict(_LMDB_ENV, 'session_index', writer=_WRITER)
+_PROGRESS_DB = LMDB_Dict(_LMDB_ENV, 'progress', writer=_WRITER)
+_OUTBOX_DB = LMDB_Dict(_LMDB_ENV, 'outbox', writer=_WRITER)
+_OUTBOX_SCHEDULE_DB = LMDB_Dict(_LMDB_ENV, 'outbox_schedule', writer=_WRITER)
+_CRITERIA_DB = LMDB_Dict(_LMDB_ENV, 'criteria', writer=_WRITER)
+_COHORT_STATS_DB = LMDB_Dict(_LMDB_ENV, 'cohort_stats', writer=_WRITER)
+_META_DB = LMDB_Dict(_LMDB_ENV, 'meta', writer=_WRITER)
+
+_DATABASES = (_SESSIONS_DB, _DATA_DB, _USERS_DB, _USER_SESSIONS_DB, _OUTCOMES_DB, _METADATA_DB, _MOODLE_DB,
+              _UNREGISTERED_OAUTH, _OAUTH_DB, _SESSION_INDEX_DB, _PROGRESS_DB, _OUTBOX_DB, _OUTBOX_SCHEDULE_DB,
+              _CRITERIA_DB, _COHORT_STATS_DB, _META_DB)
+
+# OAuth nonces: 'lmdb' shares them between every process on _LMDB_DATADIR, 'memory' keeps them per process.
+_NONCE_STORE = environ.get('OAUTH_NONCE_STORE', 'lmdb')
+_NONCE_MAX = int(environ.get('OAUTH_NONCE_MAX', 100000))
+# Read-through cache of consumer secrets & resource credentials, dropped by every process when the generation changes.
+# The generation is kept in memory, set by this process's writes and re-read every OAUTH_GENERATION_TTL seconds for
+# other processes' writes, or on a cache miss.
+_CREDENTIALS_CACHE_SIZE = int(environ.get('OAUTH_CACHE_SIZE', 1024))
+_CREDENTIALS_CACHE_TTL = float(environ.get('OAUTH_CACHE_TTL', 300))
+_CREDENTIALS_CACHE = ExpiringLRUCache(_CREDENTIALS_CACHE_SIZE, default_timeout=_CREDENTIALS_CACHE_TTL)
+_CREDENTIALS_GENERATION = 'credentials_generation'
+_CREDENTIALS_GENERATION_TTL = float(environ.get('OAUTH_GENERATION_TTL', 5))
+_CREDENTIALS_GENERATION_SEEN = {'generation': None, 'until': 0}
+_CRITERIA_GENERATION = 'criteria_generation'
+_COHORT_STATS_UPDATES = 'cohort_stats_updates'  # Counts store_cohort_stats, so a rebuild can tell it raced one
+_REBUILD_ATTEMPTS = 3
+_DEFAULT_CONTEXT = 'default'    # criteria key of the defaults, context ids are sha1 hex
+
+_NONCES = (LMDBNonceStore(_LMDB_ENV, max_nonces=_NONCE_MAX, writer=_WRITER) if _NONCE_STORE == 'lmdb' else
+           MemoryNonceStore(max_nonces=_NONCE_MAX))
+
+_SCHEMA_VERSION = 7
+
+_SCAN_CHUNK = 256     # Records read per transaction by streaming exports
 
 _VIDEO_URL = "https://s3.amazonaws.com/orthoboxes-video/{session_id}.mp4"
 
@@ -107,39 +237,170 @@ _BOX_VERSION = {1: _POKEY, 2: _PEGGY}
 _ACTIVITY_NAME = {_PEGGY: "Object Manipulation",
                   _POKEY: "Triangulation"}
 
+_OUTCOME_PARAMS = ('oauth_consumer_key', 'lis_outcome_service_url', 'lis_result_sourcedid')
+
+
+def _load(db, key, *default):
+    """
+    Record for key in db, decoded by the db's codec. KeyError if missing and no default given.
+    """
+    return db.load(key, *default)
+
+
+def _store(db, key, record):
+    return db.dump(key, record)
+
+
+def _store_revision(db, key, record):
+    """
+    _store record with its 'revision' incremented, for records whose pages are cached by revision.
+    """
+    record['revision'] = record.get('revision', 0) + 1
+    return _store(db, key, record)
+
+
+def unit_of_work(write=False):
+    """
+    Share one transaction across every database for the duration of a with block, eg. one LTI launch or upload:
+
+        with unit_of_work(write=True):
+            store_activity_data(session_id, data)
+            store_result(session_id, result, grade)
+
+    Commits once on exit, nothing is written if the block raises.
+    """
+    return transaction(_LMDB_ENV, write=write)
+
+
+def atomically(function, *args, **kwargs):
+    """
+    Run function(*args, **kwargs) as one write unit of work and return its result. With group commit enabled it runs
+    on the writer thread, batched with other requests' units; the caller blocks until it is durable either way.
+    """
+    if _WRITER is not None:
+        return _WRITER.call(function, *args, **kwargs)
+    with unit_of_work(write=True):
+        return function(*args, **kwargs)
+
+
+def nonce_first_seen(nonce, now):
+    """
+    Returns when OAuth nonce was first seen, recording it as seen now if new. NonceStoreFull once OAUTH_NONCE_MAX
+    nonces are held.
+    """
+    return _NONCES.first_seen(nonce, now)
+
+
+def _cached_credentials(cache_key, load):
+    """
+    load() through _CREDENTIALS_CACHE. Entries are tagged with the credentials generation they were read at, so a
+    change by this process misses every entry read before it at once, a change by another within
+    _CREDENTIALS_GENERATION_TTL. Hits don't touch LMDB. Misses (None) aren't cached.
+    """
+    cached = _CREDENTIALS_CACHE.get(cache_key)
+    if cached is not None and cached[0] == _credentials_generation():
+        return cached[1]
+    generation = _credentials_generation(refresh=True)  # Reading LMDB anyway
+    value = load()
+    if value is not None:
+        _CREDENTIALS_CACHE.put(cache_key, (generation, value))
+    return value
+
+
+def _credentials_generation(refresh=False):
+    """
+    The credentials generation as this process last read or set it, read from _META_DB if refresh or it's older than
+    _CREDENTIALS_GENERATION_TTL.
+    """
+    seen = _CREDENTIALS_GENERATION_SEEN
+    now = time.time()
+    if refresh or now >= seen['until']:
+        seen.update(generation=_META_DB.get(_CREDENTIALS_GENERATION, '0'), until=now + _CREDENTIALS_GENERATION_TTL)
+    return seen['generation']
+
+
+def _bump_credentials_generation():
+    # Random rather than counted, so a bump rolled back after being seen in memory can't match a later one
+    generation = uuid4().hex
+    _META_DB[_CREDENTIALS_GENERATION] = generation
+    _CREDENTIALS_GENERATION_SEEN.update(generation=generation, until=time.time() + _CREDENTIALS_GENERATION_TTL)
+
 
 def new_oauth_creds():
     # TODO: Authentication so this can be run automatically
     key = uuid4().hex
     secret = uuid4().hex
-    _UNREGISTERED_OAUTH[key] = secret
+    atomically(_new_oauth_creds, key, secret)
     return key, secret
 
 
+def _new_oauth_creds(key, secret):
+    _UNREGISTERED_OAUTH[key] = secret
+    _bump_credentials_generation()
+
+
+def criteria_generation():
+    """
+    Returns the criteria generation, bumped by every store_criteria, for caching anything derived from criteria.
+    """
+    return int(_META_DB.get(_CRITERIA_GENERATION, '0'))
+
+
+def load_criteria(context_id, box_type):
+    """
+    Returns the criteria stored for context_id at box_type, else those stored as the default, else None.
+    """
+    criteria = _CRITERIA_DB.load_many([_key(context_id or _DEFAULT_CONTEXT, box_type),
+                                       _key(_DEFAULT_CONTEXT, box_type)])
+    return criteria[0] or criteria[1]
+
+
+def iter_criteria():
+    """
+    Yields (context_id, box_type, criteria) for every stored set of criteria, context_id None for the defaults.
+    """
+    for key, criteria in _CRITERIA_DB.iterprefix(''):
+        context_id, box_type = key.split(':')
+        yield None if context_id == _DEFAULT_CONTEXT else context_id, box_type, criteria
+
+
+def store_criteria(context_id, box_type, criteria):
+    """
+    Store criteria for context_id at box_type, or as the default for contexts without their own if context_id is None.
+    """
+    atomically(_store_criteria, context_id, box_type, criteria)
+
+
+def _store_criteria(context_id, box_type, criteria):
+    _store(_CRITERIA_DB, _key(context_id or _DEFAULT_CONTEXT, box_type), criteria)
+    _META_DB[_CRITERIA_GENERATION] = str(criteria_generation() + 1)
+
+
 def get_oauth_creds(key):
     # TODO: Throw an exception if key is unknown
-    secret = _OAUTH_DB.get(key)
-    if secret is None:
-        secret = _UNREGISTERED_OAUTH.get(key)
-    return secret
+    return _cached_credentials('oauth:' + key, lambda: _OAUTH_DB.get(key) or _UNREGISTERED_OAUTH.get(key))
 
 
 def store_session_params(session_id, params):
-    _SESSIONS_DB[session_id] = _encode({'upload_token': uuid4().hex,
-                                        'tool_provider_params': params})
+    _store(_SESSIONS_DB, session_id, {'upload_token': uuid4().hex,
+                                      'tool_provider_params': params})
 
 
 def verify_resource_oauth(moodle_resource_id, tool_provider):
-    resource = _MOODLE_DB.get(moodle_resource_id)
-    if resource:    # Resource has been used before
-        cred_dict = _decode(resource)
+    cred_dict = _cached_credentials('resource:' + moodle_resource_id,
+                                    lambda: _load(_MOODLE_DB, moodle_resource_id, None))
+    if cred_dict:    # Resource has been used before
         assert tool_provider.consumer_key == cred_dict.get('consumer_key') and \
                tool_provider.consumer_secret == cred_dict.get('consumer_secret'), \
             "Invalid OAuth credentials for resource"
     else:   # New resource_id, 'register' credentials with it
-        key = tool_provider.consumer_key
-        _OAUTH_DB[key] = secret = _UNREGISTERED_OAUTH.pop(key)
-        _MOODLE_DB[moodle_resource_id] = _encode({'consumer_key': key, 'consumer_secret': secret})
+        atomically(_register_resource_oauth, moodle_resource_id, tool_provider.consumer_key)
+
+
+def _register_resource_oauth(moodle_resource_id, key):
+    _OAUTH_DB[key] = secret = _UNREGISTERED_OAUTH.pop(key)
+    _store(_MOODLE_DB, moodle_resource_id, {'consumer_key': key, 'consumer_secret': secret})
+    _bump_credentials_generation()
 
 
 def authorize_user(moodle_uid, context_id, tool_provider):
@@ -150,23 +411,24 @@ def authorize_user(moodle_uid, context_id, tool_provider):
     #   moodle_uid: {'uid': uid, 'username': username}
     #   moodle_resource_id: {'consumer_key': oauth_consumer_key, 'consumer_secret': oauth_shared_secret}
     # }
-    moodle_ids = _decode(_MOODLE_DB.setdefault(moodle_uid, _encode(
-            {'uid': uuid4().hex, 'username': tool_provider.custom_params.get('lis_person_name_full')})))
+    moodle_ids = _load(_MOODLE_DB, moodle_uid, None)
+    if moodle_ids is None:
+        moodle_ids = {'uid': uuid4().hex, 'username': tool_provider.custom_params.get('lis_person_name_full')}
+        _store(_MOODLE_DB, moodle_uid, moodle_ids)
     uid = moodle_ids['uid']
 
     # _USERS_DB = {
-    #   context_id: {uid: {'moodle_uid': moodle_uid,
-    #                      'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-    #                                'sessions': <list of session_ids>},
-    #                      'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-    #                                'sessions': <list of session_ids>}}}
+    #   'context_id:uid': {'moodle_uid': moodle_uid,
+    #                      'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>},
+    #                      'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>}}
     # }
-    context = _decode(_USERS_DB.get(context_id, 'null'))  # 'null' is JSON for None.
-    if context is None:
-        context = dict()
-    user = context.get(uid)
+    user_key = _key(context_id, uid)
+    user = _load(_USERS_DB, user_key, None)
     if user is None:
-         user = _new_user(moodle_uid)
+        user = _new_user(moodle_uid)
+        _store(_USERS_DB, user_key, user)
+
+    assert activity_string in user, "Unknown activity"
 
     # FIXME: Throw an actual exception
     # FIXME: Crude hack because of poor communication
@@ -174,12 +436,15 @@ def authorize_user(moodle_uid, context_id, tool_provider):
 
     session_id = uuid4().hex
 
-    user[activity_string]['sessions'].append(session_id)
-    context[uid] = user
-    _USERS_DB[context_id] = _encode(context)
+    # _USER_SESSIONS_DB = {
+    #   'context_id:uid:box_type:<8 digit sequence>': session_id
+    # }
+    sequence_key = _USER_SESSIONS_DB.append(_prefix(context_id, uid, activity_string), session_id)
+
+    _store_outcome_params(context_id, uid, activity_string, tool_provider.params)
 
     video_url = _VIDEO_URL.format(session_id=session_id)
-    _DATA_DB[session_id] = _encode({'uid': uid, 'video_url': video_url})
+    _store(_DATA_DB, session_id, {'uid': uid, 'video_url': video_url})
 
     # Generate metadata for session
     # _METADATA_DB = {
@@ -190,7 +455,9 @@ def authorize_user(moodle_uid, context_id, tool_provider):
     #                'video_url': <identifier (URL) for video>,
     #                'result': <pass/fail/incomplete status>,
     #                'grade': <completion percentage>,
-    #                'return_url': <lti spec 'launch_presentation_return_url'>}
+    #                'trial': <1-indexed attempt number>,
+    #                'return_url': <lti spec 'launch_presentation_return_url'>,
+    #                'evaluated': <true once results are stored>}
     # }
     metadata = {'uid': uid,
                 'context': context_id,
@@ -199,36 +466,110 @@ def authorize_user(moodle_uid, context_id, tool_provider):
                 'video_url': video_url,
                 'result': _INCOMPLETE,
                 'grade': 0.0,
-                'return_url': tool_provider.launch_presentation_return_url}
+                'trial': int(sequence_key.rsplit(':', 1)[1]) + 1,
+                'return_url': tool_provider.launch_presentation_return_url,
+                'evaluated': False}
+
+    _store_revision(_METADATA_DB, session_id, metadata)
 
-    _METADATA_DB[session_id] = _encode(metadata)
+    _store(_SESSION_INDEX_DB, _key(context_id, activity_string, session_id), {'uid': uid})
 
     return session_id
 
 
+def _store_outcome_params(context_id, uid, box_type, params):
+    """
+    _OUTCOMES_DB = {
+        'context_id:uid:box_type': {'oauth_consumer_key': oauth_consumer_key,
+                                    'lis_outcome_service_url': lis_outcome_service_url,
+                                    'lis_result_sourcedid': lis_result_sourcedid}
+    }
+    """
+    if all(params.get(name) for name in _OUTCOME_PARAMS):     # Launched as an outcome service
+        _store(_OUTCOMES_DB, _key(context_id, uid, box_type), dict((name, params[name]) for name in _OUTCOME_PARAMS))
+
+
+def get_course_outcomes(context_id, box_types=None):
+    """
+    Returns [{'uid', 'username', 'box_type', 'grade', 'params'}, ...] for each user in context_id and each of
+    box_types (default all), params being the outcome service params of their latest launch, None if never launched
+    as one.
+    """
+    box_types = box_types or sorted(_ACTIVITY_NAME)
+    with unit_of_work():
+        users = list(get_users_by_context_id(context_id).items())
+        moodle_ids = get_ids_from_moodle_uids([user['moodle_uid'] for _, user in users])
+        keys = [(uid, box_type) for uid, _ in users for box_type in box_types]
+        params = _OUTCOMES_DB.load_many([_key(context_id, uid, box_type) for uid, box_type in keys])
+    usernames = dict((uid, ids['username']) for (uid, _), ids in zip(users, moodle_ids))
+    grades = dict(users)
+    return [{'uid': uid, 'username': usernames[uid], 'box_type': box_type, 'grade': grades[uid][box_type]['grade'],
+             'params': outcome} for (uid, box_type), outcome in zip(keys, params)]
+
+
 def get_ids_from_moodle_uid(moodle_uid):
-    return _decode(_MOODLE_DB[moodle_uid])
+    return _load(_MOODLE_DB, moodle_uid)
+
+
+def get_ids_from_moodle_uids(moodle_uids):
+    """
+    get_ids_from_moodle_uid for each of moodle_uids, in order, read in one transaction.
+    """
+    moodle_ids = _MOODLE_DB.load_many(moodle_uids)
+    if None in moodle_ids:
+        raise KeyError(moodle_uids[moodle_ids.index(None)])
+    return moodle_ids
 
 
 def get_session_data(session_id):
-    return _decode(_DATA_DB[session_id]).get('data', {})
+    return _load(_DATA_DB, session_id).get('data', {})
+
+
+def get_sessions(session_ids):
+    """
+    Returns [(get_session_data, get_metadata), ...] for each of session_ids, in order, read in one transaction.
+    """
+    with unit_of_work():
+        sessions = _DATA_DB.load_many(session_ids, {})
+        metadata = _METADATA_DB.load_many(session_ids)
+    if None in metadata:
+        raise KeyError(session_ids[metadata.index(None)])
+    return [(session.get('data', {}), session_metadata) for session, session_metadata in zip(sessions, metadata)]
 
 
 def get_user_data_by_context_id(context_id):
     """
+    Returns {uid: user} for every user in context_id, each box_type also listing 'sessions' in launch order.
+
     _USERS_DB = {
-    context_id: {uid: {'moodle_uid': moodle_uid,
-                       'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>},
-                       'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>}}}
+        'context_id:uid': {'moodle_uid': moodle_uid,
+                           'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>},
+                           'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>}}
     }
     """
-    return _decode(_USERS_DB[context_id])
+    users = dict()
+    for key, user in _USERS_DB.iterprefix(_prefix(context_id)):
+        users[key.rsplit(':', 1)[1]] = _no_sessions(user)
+    for uid, box_type, session_ids in _iter_user_sessions(_prefix(context_id)):
+        users[uid][box_type]['sessions'] = session_ids
+    return users
+
+
+def get_users_by_context_id(context_id):
+    """
+    Returns {uid: user} for every user in context_id, without session lists.
+    """
+    return dict((key.rsplit(':', 1)[1], user) for key, user in _USERS_DB.iterprefix(_prefix(context_id)))
 
 
 def get_user_data_by_uid(uid, context_id):
-    return _decode(_USERS_DB[context_id]).get(uid, dict())
+    user = _load(_USERS_DB, _key(context_id, uid), None)
+    if user is None:
+        return dict()
+    user = _no_sessions(user)
+    for _, box_type, session_ids in _iter_user_sessions(_prefix(context_id, uid)):
+        user[box_type]['sessions'] = session_ids
+    return user
 
 
 def get_grade(uid, context_id, box_type):
@@ -236,29 +577,45 @@ def get_grade(uid, context_id, box_type):
     Returns grade for particular activity.
 
     _USERS_DB = {
-    context_id: {uid: {'moodle_uid': moodle_uid,
-                       'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>},
-                       'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>}}}
+        'context_id:uid': {'moodle_uid': moodle_uid,
+                           'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>},
+                           'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>}}
     }
     """
-    return _decode(_USERS_DB[context_id])[uid][box_type]['grade']
+    return _load(_USERS_DB, _key(context_id, uid))[box_type]['grade']
 
 
 def store_grade(uid, context_id, box_type, grade):
     """
     _USERS_DB = {
-    context_id: {uid: {'moodle_uid': moodle_uid,
-                       'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>},
-                       'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                 'sessions': <list of session_ids>}}}
+        'context_id:uid': {'moodle_uid': moodle_uid,
+                           'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>},
+                           'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>}}
     }
     """
-    context = _decode(_USERS_DB[context_id])
-    context[uid][box_type]['grade'] = grade
-    _USERS_DB[context_id] = _encode(context)
+    user_key = _key(context_id, uid)
+    user = _load(_USERS_DB, user_key)
+    user[box_type]['grade'] = grade
+    _store(_USERS_DB, user_key, user)
+
+
+def get_grades(user_activities):
+    """
+    Grades for each of user_activities, (context_id, uid, box_type), in order and read in one transaction. None for
+    unknown users.
+    """
+    users = _USERS_DB.load_many([_key(context_id, uid) for context_id, uid, _ in user_activities])
+    return [user[box_type]['grade'] if user else None for user, (_, _, box_type) in zip(users, user_activities)]
+
+
+def store_reevaluated_grade(uid, context_id, box_type, grade, previous):
+    """
+    store_grade, unless the grade is no longer previous, eg. after an upload since it was read. Returns whether stored.
+    """
+    if get_grade(uid, context_id, box_type) != previous:
+        return False
+    store_grade(uid, context_id, box_type, grade)
+    return True
 
 
 def get_ids_for_session(session_id):
@@ -276,7 +633,7 @@ def get_ids_for_session(session_id):
                  'return_url': <lti spec 'launch_presentation_return_url'>}
     }
     """
-    session = _decode(_METADATA_DB[session_id])
+    session = _load(_METADATA_DB, session_id)
     return session['uid'], session['context']
 
 
@@ -287,7 +644,23 @@ def get_upload_token(session_id):
                  'tool_provider_params': tool_provider.params}
     }
     """
-    return _decode(_SESSIONS_DB[session_id])['upload_token']
+    return _load(_SESSIONS_DB, session_id)['upload_token']
+
+
+def iter_user_sessions():
+    """
+    Yields (context_id, uid, box_type, session_id) for every launch in user_sessions key order, so each user's sessions
+    at each activity in launch order. Read _SCAN_CHUNK at a time.
+    """
+    after = None
+    while True:
+        items = _USER_SESSIONS_DB.scan('', after, _SCAN_CHUNK)
+        for key, session_id in items:
+            context_id, uid, box_type, _ = key.split(':')
+            yield context_id, uid, box_type, session_id
+        if len(items) < _SCAN_CHUNK:
+            return
+        after = items[-1][0]
 
 
 def get_session_params(session_id):
@@ -297,7 +670,7 @@ def get_session_params(session_id):
                  'tool_provider_params': tool_provider.params}
     }
     """
-    return _decode(_SESSIONS_DB[session_id])['tool_provider_params']
+    return _load(_SESSIONS_DB, session_id)['tool_provider_params']
 
 
 def store_activity_data(session_id, json_data):
@@ -309,9 +682,41 @@ def store_activity_data(session_id, json_data):
                  'video_url': <identifier (URL) for video>,
                  'data': <raw JSON received>}
     """
-    session = _decode(_DATA_DB[session_id])
+    session = _load(_DATA_DB, session_id)
     session['data'] = json_data
-    _DATA_DB[session_id] = _encode(session)
+    _store(_DATA_DB, session_id, session)
+
+    # Re-file the index entry under the box type actually reported by the upload
+    metadata = _load(_METADATA_DB, session_id)
+    box_type = json_data.get('version_string')
+    if box_type != metadata['activity_string']:
+        try:
+            del _SESSION_INDEX_DB[_key(metadata['context'], metadata['activity_string'], session_id)]
+        except KeyError:
+            pass
+    _store(_SESSION_INDEX_DB, _key(metadata['context'], box_type, session_id),
+           {'uid': session['uid'], 'errors': len(json_data.get('errors', []))})
+
+
+def store_normalized_errors(session_id, errors):
+    """
+    Replace the normalized errors of session_id's upload, eg. re-derived at another cutoff, updating its session_index
+    error count, results page & progress graph points. Its result & grade are left as they were evaluated.
+    """
+    session = _load(_DATA_DB, session_id)
+    data = session['data']
+    data['errors'] = errors
+    _store(_DATA_DB, session_id, session)
+
+    metadata = _load(_METADATA_DB, session_id)
+    index_key = _key(metadata['context'], data.get('version_string'), session_id)
+    entry = _load(_SESSION_INDEX_DB, index_key, None)
+    if entry is not None:
+        entry['errors'] = len(errors)
+        _store(_SESSION_INDEX_DB, index_key, entry)
+    _store_revision(_METADATA_DB, session_id, metadata)
+    if metadata.get('evaluated'):
+        store_progress(session_id, data, metadata['result'])
 
 
 def get_result_data(session_id):
@@ -323,11 +728,50 @@ def get_result_data(session_id):
                  'video_url': <identifier (URL) for video>,
                  'data': <raw JSON received>}
     """
-    return _decode(_DATA_DB[session_id])['data']
+    return _load(_DATA_DB, session_id)['data']
 
 
-def dump_session_data():
-    return dict(_DATA_DB)
+def iter_sessions(after=None, context_id=None, box_type=None, raw=False):
+    """
+    Yields (key, session_id, _DATA_DB record) in key order, resuming after key when given.
+
+    Unfiltered, scans _DATA_DB itself and key is the session_id. Filtered by context_id and/or box_type, scans
+    session_index and key is the index key. Records are read _SCAN_CHUNK at a time, one read transaction per chunk, so
+    consumers may take as long as they like between items. raw=True yields records as stored bytes.
+    """
+    if context_id is None and box_type is None:
+        while True:
+            items = _DATA_DB.scan('', after, _SCAN_CHUNK, raw=raw)
+            for session_id, session in items:
+                yield session_id, session_id, session
+            if len(items) < _SCAN_CHUNK:
+                return
+            after = items[-1][0]
+    prefix = '' if context_id is None else _prefix(context_id) if box_type is None else _prefix(context_id, box_type)
+    while True:
+        with unit_of_work():
+            entries = _SESSION_INDEX_DB.scan(prefix, after, _SCAN_CHUNK)
+            sessions = list()
+            for key, _ in entries:
+                _, session_box_type, session_id = key.split(':')
+                if box_type is not None and session_box_type != box_type:
+                    continue
+                session = _DATA_DB.raw(session_id) if raw else _load(_DATA_DB, session_id, None)
+                if session is not None:
+                    sessions.append((key, session_id, session))
+        for session in sessions:
+            yield session
+        if len(entries) < _SCAN_CHUNK:
+            return
+        after = entries[-1][0]
+
+
+def iter_session_json(after=None, context_id=None, box_type=None):
+    """
+    iter_sessions yielding records as JSON text, stored records passed through without decoding.
+    """
+    for key, session_id, session in iter_sessions(after, context_id, box_type, raw=True):
+        yield key, session_id, _DATA_DB.codec.to_json(session)  # Identity for JSON records
 
 
 def get_metadata(session_id):
@@ -344,7 +788,7 @@ def get_metadata(session_id):
                      'return_url': <lti spec 'launch_presentation_return_url'>}
     }
     """
-    return _decode(_METADATA_DB[session_id])
+    return _load(_METADATA_DB, session_id)
 
 
 def store_result(session_id, result, grade):
@@ -361,10 +805,227 @@ def store_result(session_id, result, grade):
                      'return_url': <lti spec 'launch_presentation_return_url'>}
     }
     """
-    session = _decode(_METADATA_DB[session_id])
+    session = _load(_METADATA_DB, session_id)
     session['result'] = result
     session['grade'] = grade
-    _METADATA_DB[session_id] = _encode(session)
+    session['evaluated'] = True
+    _store_revision(_METADATA_DB, session_id, session)
+
+
+def get_metadata_many(session_ids):
+    """
+    get_metadata for each of session_ids, in order and read in one transaction. None for unknown sessions.
+    """
+    return _METADATA_DB.load_many(session_ids)
+
+
+def store_reevaluated_result(session_id, result, grade, revision):
+    """
+    store_result & store_progress for a session evaluated again, unless its metadata changed since it was read at
+    revision. Returns whether stored.
+    """
+    if _load(_METADATA_DB, session_id)['revision'] != revision:
+        return False
+    store_result(session_id, result, grade)
+    store_progress(session_id, get_result_data(session_id), result)
+    return True
+
+
+def get_progress_summary(uid, context_id, box_type):
+    """
+    Returns the progress graph summary of uid at box_type, see _PROGRESS_DB. Empty if no sessions were evaluated.
+    """
+    return _load(_PROGRESS_DB, _key(context_id, uid, box_type), None) or _empty_summary()
+
+
+def get_graph_secret():
+    """
+    Returns the key for signing progress graph tokens, see rest_views.progress_graphs.
+    """
+    secret = _META_DB.get('graph_secret')
+    if secret is None:  # Another process may get there first, whichever secret is stored first is kept
+        secret = atomically(_META_DB.setdefault, 'graph_secret', uuid4().hex + uuid4().hex)
+    return secret
+
+
+def get_progress_summaries(uids, context_id, box_type):
+    """
+    get_progress_summary for each of uids, in order, read in one transaction.
+    """
+    summaries = _PROGRESS_DB.load_many([_key(context_id, uid, box_type) for uid in uids])
+    return [summary or _empty_summary() for summary in summaries]
+
+
+def store_progress(session_id, data, result):
+    """
+    Add the evaluated session to its user's progress summary, replacing any earlier points for the same trial.
+    """
+    metadata = _load(_METADATA_DB, session_id)
+    key = _key(metadata['context'], metadata['uid'], metadata['activity_string'])
+    summary = _load(_PROGRESS_DB, key, None) or _empty_summary()
+    _merge_summary(summary, _summarize_session(metadata['trial'], data, result))
+    _store_revision(_PROGRESS_DB, key, summary)
+
+
+def get_cohort_stats(context_id, box_type):
+    """
+    Class statistics of context_id at box_type, see _COHORT_STATS_DB. Empty if no sessions were evaluated.
+    """
+    return _load(_COHORT_STATS_DB, _key(context_id, box_type), None) or empty_stats()
+
+
+def iter_cohort_stats():
+    """
+    Yields (context_id, box_type, statistics) for every context & activity with evaluated sessions.
+    """
+    for key, stats in _iter_chunks(_COHORT_STATS_DB, ''):
+        context_id, box_type = key.split(':')
+        yield context_id, box_type, stats
+
+
+def store_cohort_stats(session_id, data, result, grade):
+    """
+    Add the session, evaluated as result leaving its user at grade, to its context's class statistics. A user's first
+    full grade is counted towards attempts to mastery.
+    """
+    metadata = _load(_METADATA_DB, session_id)
+    context_id, uid, box_type = metadata['context'], metadata['uid'], data.get('version_string')
+    key = _key(context_id, box_type)
+    stats = _load(_COHORT_STATS_DB, key, None) or empty_stats()
+    add_session(stats, result, data.get('duration', 0), [error['duration'] for error in data.get('errors', [])])
+    if grade >= 1.0:
+        user_key = _key(context_id, uid)
+        user = _load(_USERS_DB, user_key)
+        if user[box_type].get('mastered') is None:
+            user[box_type]['mastered'] = metadata['trial']
+            _store(_USERS_DB, user_key, user)
+            add_mastery(stats, metadata['trial'])
+    _store(_COHORT_STATS_DB, key, stats)
+    _META_DB[_COHORT_STATS_UPDATES] = str(int(_META_DB.get(_COHORT_STATS_UPDATES, '0')) + 1)
+
+
+def rebuild_cohort_stats():
+    """
+    Recompute every context's class statistics & users' mastered trials from data & metadata, eg. after
+    orthobox_reevaluate or orthobox_normalize_errors changed stored results. Returns the number of sessions counted.
+
+    Sessions are counted in memory from read transactions of _SCAN_CHUNK each, then the results are written in one
+    short write transaction, so uploads aren't held up by the scan. If an upload added to the statistics meanwhile the
+    rebuild starts over, and after _REBUILD_ATTEMPTS the last one scans inside the write transaction.
+    """
+    for _ in range(_REBUILD_ATTEMPTS):
+        updates = _META_DB.get(_COHORT_STATS_UPDATES, '0')
+        statistics, mastered, counted = _count_cohort_stats()
+        if atomically(_store_cohort_stats_rebuild, statistics, mastered, updates):
+            return counted
+    return atomically(_rebuild_cohort_stats)
+
+
+def _rebuild_cohort_stats():
+    statistics, mastered, counted = _count_cohort_stats()
+    _store_cohort_stats_rebuild(statistics, mastered)
+    return counted
+
+
+def _count_cohort_stats():
+    """
+    Returns ({context_id:box_type: class statistics}, {(context_id, uid, box_type): mastered trial}, sessions counted)
+    from every evaluated session.
+    """
+    statistics, mastered, counted, after = dict(), dict(), 0, None
+    while True:
+        with unit_of_work():
+            items = _METADATA_DB.scan('', after, _SCAN_CHUNK)
+            sessions = _DATA_DB.load_many([session_id for session_id, _ in items], {})
+        for (session_id, metadata), session in zip(items, sessions):
+            data = session.get('data')
+            if not metadata.get('evaluated') or not data:
+                continue
+            context_id, box_type = metadata['context'], data.get('version_string')
+            stats = statistics.setdefault(_key(context_id, box_type), empty_stats())
+            add_session(stats, metadata['result'], data.get('duration', 0),
+                        [error['duration'] for error in data.get('errors', [])])
+            counted += 1
+            if metadata['grade'] >= 1.0:
+                user_activity = (context_id, metadata['uid'], box_type)
+                mastered[user_activity] = min(mastered.get(user_activity, metadata['trial']), metadata['trial'])
+        if len(items) < _SCAN_CHUNK:
+            break
+        after = items[-1][0]
+    for (context_id, _, box_type), trial in mastered.items():
+        add_mastery(statistics[_key(context_id, box_type)], trial)
+    return statistics, mastered, counted
+
+
+def _store_cohort_stats_rebuild(statistics, mastered, updates=None):
+    """
+    Replace every context's class statistics & users' mastered trials. Returns False without writing anything if
+    updates is given and store_cohort_stats has run since it was read.
+    """
+    if updates is not None and _META_DB.get(_COHORT_STATS_UPDATES, '0') != updates:
+        return False
+    for user_key, user in list(_USERS_DB.iterprefix('')):
+        context_id, uid = user_key.split(':')
+        previous = [user.get(box_type, {}).get('mastered') for box_type in (_POKEY, _PEGGY)]
+        for box_type in (_POKEY, _PEGGY):
+            trial = mastered.get((context_id, uid, box_type))
+            if trial is not None:
+                user[box_type]['mastered'] = trial
+            elif box_type in user:
+                user[box_type].pop('mastered', None)
+        if previous != [user.get(box_type, {}).get('mastered') for box_type in (_POKEY, _PEGGY)]:
+            _store(_USERS_DB, user_key, user)
+
+    for key, _ in list(_COHORT_STATS_DB.iterprefix('')):
+        del _COHORT_STATS_DB[key]
+    for key, stats in statistics.items():
+        _store(_COHORT_STATS_DB, key, stats)
+    return True
+
+
+def _empty_summary():
+    return {'not_passing': list(), 'passing': list(), 'all_errors': list(), 'drops': list(),
+            'hover_data': [list(), list(), list(), list()], 'revision': 0}
+
+
+def _summarize_session(trial, data, result):
+    """
+    Progress summary holding only the session with uploaded data at trial, evaluated as result.
+    """
+    summary = _empty_summary()
+    hover_data = summary['hover_data']
+    for error in data['errors']:
+        end = error['endtime']
+        duration = error['duration']
+        summary['all_errors'].append([trial, end / 1000, (end - duration) / 1000])
+        hover_data[2].append(duration / 1000)
+
+    for drop in data.get('drops', []):
+        drop_time = drop['endtime'] / 1000
+        summary['drops'].append([trial, drop_time])
+        hover_data[3].append(drop_time)
+
+    if result == _PASS:
+        summary['passing'].append([trial, data['duration']])
+        hover_data[1].append(len(data['errors']))
+    else:
+        summary['not_passing'].append([trial, data['duration']])
+        hover_data[0].append(len(data['errors']))
+    return summary
+
+
+def _merge_summary(summary, session):
+    """
+    Merge session, the summary of a single trial, into summary in place, keeping points in trial order.
+    """
+    trial = (session['passing'] or session['not_passing'])[0][0]
+    for hover, points in enumerate(('not_passing', 'passing', 'all_errors', 'drops')):
+        merged = [(point, value) for point, value in zip(summary[points], summary['hover_data'][hover])
+                  if point[0] != trial]
+        merged.extend(zip(session[points], session['hover_data'][hover]))
+        merged.sort(key=lambda item: item[0][0])   # Stable, events within a trial keep their order
+        summary[points] = [point for point, _ in merged]
+        summary['hover_data'][hover] = [value for _, value in merged]
 
 
 def delete_session_credentials(session_id):
@@ -376,6 +1037,94 @@ def delete_session_credentials(session_id):
     del _SESSIONS_DB[session_id]
 
 
+def enqueue_grade(session_id, grade, params):
+    """
+    Queue grade for passback to the outcome service in tool provider params, see orthobox.grade_outbox.
+
+    Replaces any grade still pending for the same outcome, so only the latest is sent. If the older grade is being
+    delivered, the new one waits for that delivery to settle rather than racing it to the LMS.
+    """
+    outcome = params['lis_outcome_service_url'] + '\n' + params['lis_result_sourcedid']
+    target = sha1(outcome.encode('utf-8')).hexdigest()
+    now = time.time()
+    due = now
+    pending = _load(_OUTBOX_DB, target, None)
+    if pending is not None:
+        del _OUTBOX_SCHEDULE_DB[pending['due']]
+        due = max(now, pending['leased_until'] or now)
+    _schedule_grade(target, {'session_id': session_id, 'grade': grade, 'params': params, 'enqueued': now,
+                             'attempts': 0, 'token': None, 'leased_until': None, 'error': None}, due)
+
+
+def claim_grades(limit, lease):
+    """
+    Returns up to limit [(target, outbox record), ...] due for delivery, each leased to the caller for lease seconds:
+    rescheduled so no one else claims it before then, or retried by whoever does if the caller never settles it.
+    """
+    return atomically(_claim_grades, limit, lease)
+
+
+def _claim_grades(limit, lease):
+    now = time.time()
+    now_key = _due_key(now)
+    claimed = list()
+    for key, _ in _OUTBOX_SCHEDULE_DB.scan('', limit=limit, raw=True):
+        due, target = key.split(':')
+        if due > now_key:
+            break
+        record = _load(_OUTBOX_DB, target)
+        del _OUTBOX_SCHEDULE_DB[key]
+        record['attempts'] += 1
+        record['token'] = uuid4().hex
+        record['leased_until'] = now + lease
+        _schedule_grade(target, record, now + lease)
+        claimed.append((target, record))
+    return claimed
+
+
+def settle_grade(target, token, error=None, retry_in=None):
+    """
+    Settle the delivery of a grade claimed with token: done if error is None, else retried in retry_in seconds, or
+    moved to 'failed:target' if retry_in is None.
+    """
+    atomically(_settle_grade, target, token, error, retry_in)
+
+
+def _settle_grade(target, token, error, retry_in):
+    record = _load(_OUTBOX_DB, target, None)
+    if record is None or record['token'] not in (token, None):  # Gone, or a newer grade is already in flight
+        return
+    del _OUTBOX_SCHEDULE_DB[record['due']]
+    if record['token'] is None:    # Superseded during delivery, the newer grade can go now
+        _schedule_grade(target, record, time.time())
+    elif error is None:
+        del _OUTBOX_DB[target]
+    else:
+        record.update({'token': None, 'leased_until': None, 'error': error})
+        if retry_in is not None:
+            _schedule_grade(target, record, time.time() + retry_in)
+        else:
+            del _OUTBOX_DB[target]
+            _store(_OUTBOX_DB, _key('failed', target), record)
+
+
+def outbox_depth():
+    """
+    Returns (number of grades pending delivery, number given up on).
+    """
+    return len(_OUTBOX_SCHEDULE_DB), sum(1 for _ in _OUTBOX_DB.iterprefix(_prefix('failed'), raw=True))
+
+
+def _schedule_grade(target, record, due):
+    record['due'] = key = _key(_due_key(due), target)
+    _OUTBOX_SCHEDULE_DB[key] = ''
+    _store(_OUTBOX_DB, target, record)
+
+
+def _due_key(due):
+    return '{0:015d}'.format(int(due * 1000))
+
+
 def get_box_name(version):
     return _BOX_VERSION[version]
 
@@ -387,22 +1136,29 @@ def activity_display_name(version_string):
 def _new_user(moodle_uid):
     """
     _USERS_DB = {
-        context_id: {uid: {'moodle_uid': moodle_uid,
-                           'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                     'sessions': <list of session_ids>},
-                           'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>,
-                                     'sessions': <list of session_ids>}}}
+        'context_id:uid': {'moodle_uid': moodle_uid,
+                           'pokey': {'grade': <completion percentage: 0%, 33%, 66%, 100%>},
+                           'peggy': {'grade': <completion percentage: 0%, 33%, 66%, 100%>}}
     }
     """
     return {'moodle_uid': moodle_uid,
-            _POKEY: {'grade': 0.0, 'sessions': []},
-            _PEGGY: {'grade': 0.0, 'sessions': []}}
+            _POKEY: {'grade': 0.0},
+            _PEGGY: {'grade': 0.0}}
+
+
+def _no_sessions(user):
+    """
+    Fill in an empty 'sessions' list for each activity of a _USERS_DB record.
+    """
+    for box_type in (_POKEY, _PEGGY):
+        user[box_type]['sessions'] = list()
+    return user
 
 
 def table_encode_user_sessions(context_id, box_type):
     table = list()
     table.append(['user id', 'sessions'])
-    users = _decode(_USERS_DB[context_id])
+    users = get_user_data_by_context_id(context_id)
     for uid, contexts in users.items():
         context = contexts[box_type]
         row = list()
@@ -412,14 +1168,28 @@ def table_encode_user_sessions(context_id, box_type):
     return table
 
 
-def table_encode_session_data(context_id, box_type, stupid=False):
-    table = list()
-    headers = {_PEGGY: ['session id', 'user id', 'timestamp', 'duration', 'number of drops', 'number of errors', 'error durations'],
-               _POKEY: ['session id', 'user id', 'timestamp', 'duration', 'number of errors', 'error durations']}
-    table.append(headers[box_type])
+_SESSION_TABLE_HEADERS = {
+    _PEGGY: ['session id', 'user id', 'timestamp', 'duration', 'number of drops', 'number of errors', 'error durations'],
+    _POKEY: ['session id', 'user id', 'timestamp', 'duration', 'number of errors', 'error durations']}
+
+
+def iter_session_table(context_id, box_type, stupid=False):
+    """
+    Yields the session data table for context_id & box_type one row at a time, header first, reading sessions in
+    chunks so an export never holds the whole table (or a read transaction) while the rows are sent.
+    """
+    header = list(_SESSION_TABLE_HEADERS[box_type])
+    if stupid:
+        header.pop(0)  # No session_id
+        header.pop()  # replace 'error duration'
+        # Error columns are sized up front from the counts kept in the index, without loading any session data
+        max_errors = max([entry.get('errors', 0) for _, entry in _iter_chunks(_SESSION_INDEX_DB,
+                                                                              _prefix(context_id, box_type))] + [2])
+        for i in range(max_errors):
+            header.append("error {0} duration".format(i+1))
+    yield header
     # FIXME: Abstract serialization into separate functions.
-    for session_id, session in _DATA_DB.iteritems():
-        session = _decode(session)
+    for session_id, session in _iter_context_sessions(context_id, box_type):
         data = session.get('data')
         if data is None or data['version_string'] != box_type:
             continue
@@ -436,26 +1206,153 @@ def table_encode_session_data(context_id, box_type, stupid=False):
             row.append(len(data['drops']))
         row.append(len(data['errors']))
         row.extend([error['duration']/1000 for error in data['errors']])
-        table.append(row)
-    if stupid:
-        max_errors = max(map(len, table)) - (5 if box_type == _PEGGY else 4)
-        header = table[0]
-        header.pop(0)  # No session_id
-        header.pop()  # replace 'error duration'
-        for i in range(max_errors):
-            header.append("error {0} duration".format(i+1))
-    return table
+        yield row
 
 
-def dump_raw_errors(context_id=None):
-    table = list()
-    for session_id, session in _DATA_DB.iteritems():
-        session = _decode(session)
+def table_encode_session_data(context_id, box_type, stupid=False):
+    return list(iter_session_table(context_id, box_type, stupid))
+
+
+def iter_raw_errors(after=None, context_id=None, box_type=None):
+    """
+    Yields (key, rows) for each uploaded session, as iter_sessions. rows: [session_id, uid, duration, endtime] per drop
+    (duration -1) and raw error.
+    """
+    for key, session_id, session in iter_sessions(after, context_id, box_type):
         data = session.get('data')
         if data is None:
             continue
+        rows = list()
         for drop in data.get('drops', []):
-            table.append([session_id, session['uid'], -1, drop['endtime']])
+            rows.append([session_id, session['uid'], -1, drop['endtime']])
         for error in data.get('raw_errors', []):
-            table.append([session_id, session['uid'], error['duration'], error['endtime']])
-    return table
+            rows.append([session_id, session['uid'], error['duration'], error['endtime']])
+        yield key, rows
+
+
+def dump_raw_errors(context_id=None):
+    return [row for _, rows in iter_raw_errors(context_id=context_id) for row in rows]
+
+
+def _key(*parts):
+    """
+    Compound key from text parts, eg. 'context_id:uid'.
+    """
+    return ':'.join(parts)
+
+
+def _prefix(*parts):
+    """
+    Prefix matching every compound key that begins with parts, for range scans.
+    """
+    return _key(*parts + ('',))
+
+
+def _iter_user_sessions(prefix):
+    """
+    Yields (uid, box_type, [session_id, ...]) from _USER_SESSIONS_DB for keys starting with prefix.
+    """
+    current, session_ids = None, None
+    for key, session_id in _USER_SESSIONS_DB.iterprefix(prefix):
+        _, uid, box_type, _ = key.split(':')
+        if (uid, box_type) != current:
+            if current is not None:
+                yield current + (session_ids,)
+            current, session_ids = (uid, box_type), list()
+        session_ids.append(session_id)
+    if current is not None:
+        yield current + (session_ids,)
+
+
+def _iter_context_sessions(context_id, box_type=None):
+    """
+    Yields (session_id, _DATA_DB record) for sessions in context_id (and box_type), via prefix scan of the index.
+    """
+    for _, session_id, session in iter_sessions(context_id=context_id, box_type=box_type):
+        yield session_id, session
+
+
+def _iter_chunks(db, prefix):
+    """
+    Yields (key, record) from db for keys starting with prefix, _SCAN_CHUNK records per read transaction.
+    """
+    after = None
+    while True:
+        items = db.scan(prefix, after, _SCAN_CHUNK)
+        for item in items:
+            yield item
+        if len(items) < _SCAN_CHUNK:
+            return
+        after = items[-1][0]
+
+
+def _upgrade_schema():
+    """
+    Bring existing databases up to _SCHEMA_VERSION. Runs in one write transaction, so concurrent workers serialize,
+    except for building the class statistics, done once it's committed by rebuild_cohort_stats.
+
+    1: Build session_index from data & metadata.
+    2: Split users from one record per context into one per (context_id, uid), session lists into user_sessions.
+    3: Count errors into session_index entries.
+    4: Number trials in metadata, build progress summaries.
+    5: Keep outcome service params per user & activity, from sessions not yet uploaded & grades in the outbox.
+    6: Flag evaluated sessions in metadata, stamp metadata & progress summaries with a revision.
+    7: Build cohort_stats & users' mastered trials. Statistics are added to by uploads meanwhile, so if this process
+       dies before rebuilding them they're short until orthobox_rebuild_stats.
+    """
+    with unit_of_work(write=True):
+        version = int(_META_DB.get('schema_version', '0'))
+        if version >= _SCHEMA_VERSION:
+            return
+        if version < 1:
+            for session_id, metadata in list(_METADATA_DB.iterprefix('')):
+                session = _load(_DATA_DB, session_id, {})
+                box_type = session.get('data', {}).get('version_string', metadata.get('activity_string'))
+                _store(_SESSION_INDEX_DB, _key(metadata['context'], box_type, session_id), {'uid': metadata['uid']})
+        if version < 2:
+            contexts = [(key, users) for key, users in _USERS_DB.iterprefix('') if ':' not in key]
+            for context_id, users in contexts:
+                for uid, user in users.items():
+                    for box_type in (_POKEY, _PEGGY):
+                        for session_id in user[box_type].pop('sessions', []):
+                            _USER_SESSIONS_DB.append(_prefix(context_id, uid, box_type), session_id)
+                    _store(_USERS_DB, _key(context_id, uid), user)
+                del _USERS_DB[context_id]
+        if version < 3:
+            for key, entry in list(_SESSION_INDEX_DB.iterprefix('')):
+                session = _load(_DATA_DB, key.rsplit(':', 1)[1], {})
+                entry['errors'] = len(session.get('data', {}).get('errors', []))
+                _store(_SESSION_INDEX_DB, key, entry)
+        if version < 4:
+            for key, session_id in list(_USER_SESSIONS_DB.iterprefix('')):
+                metadata = _load(_METADATA_DB, session_id, None)
+                if metadata is None:
+                    continue
+                metadata['trial'] = int(key.rsplit(':', 1)[1]) + 1
+                _store(_METADATA_DB, session_id, metadata)
+                data = _load(_DATA_DB, session_id, {}).get('data')
+                if data:
+                    store_progress(session_id, data, metadata['result'])
+        if version < 5:
+            launches = list()
+            for session_id, session in _SESSIONS_DB.iterprefix(''):
+                metadata = _load(_METADATA_DB, session_id, None)
+                if metadata is not None:
+                    launches.append((metadata, session['tool_provider_params']))
+            for key, record in _OUTBOX_DB.iterprefix(''):
+                metadata = _load(_METADATA_DB, record['session_id'], None)
+                if metadata is not None:
+                    launches.append((metadata, record['params']))
+            for metadata, params in sorted(launches, key=lambda launch: launch[0]['trial']):   # Latest launch wins
+                _store_outcome_params(metadata['context'], metadata['uid'], metadata['activity_string'], params)
+        if version < 6:
+            for session_id, metadata in list(_METADATA_DB.iterprefix('')):
+                metadata['evaluated'] = 'data' in _load(_DATA_DB, session_id, {})
+                _store_revision(_METADATA_DB, session_id, metadata)
+            for key, summary in list(_PROGRESS_DB.iterprefix('')):
+                _store_revision(_PROGRESS_DB, key, summary)
+        _META_DB['schema_version'] = str(_SCHEMA_VERSION)
+    if version < 7:
+        rebuild_cohort_stats()
+
+_upgrade_schema()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Normalize the raw errors of many sessions at once with NumPy, giving exactly what evaluation._normalize_errors gives.
+
+_normalize_errors merges an error into the one before when it starts within cutoff of the previous raw error's end,
+a condition on neighbouring pairs only. So every session's raw errors are laid end to end in one array, the merge
+condition is evaluated for all neighbours at once, and the runs between breaks are the combined errors: a combined
+error's length is its first raw length plus the time from its first end to its last, its count the run's length.
+
+Sessions whose end times or lengths aren't all integers are handed to _normalize_errors, as float sums taken in a
+different order can round differently.
+
+Most of the cost is reading the raw errors out of their dicts and building the normalized ones, so RawErrors reads a
+batch once for normalizing or counting at any number of cutoffs, eg. while tuning evaluation._ERROR_CUTOFF.
+
+Needs numpy, not required by the application: pip install orthobox[numpy]
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import numpy as np
+
+from orthobox.evaluation import _ERROR_CUTOFF, _normalize_errors, _Error
+
+_INT_LIMIT = 2 ** 52    # Values this large could overflow int64 arithmetic, or compare inexactly with a float cutoff
+
+
+def normalize_errors_batch(raw_errors_lists, cutoff=_ERROR_CUTOFF):
+    """
+    [_normalize_errors(raw_errors, cutoff) for raw_errors in raw_errors_lists], computed in one vectorized pass.
+    """
+    return RawErrors(raw_errors_lists).normalize(cutoff)
+
+
+class RawErrors(object):
+    """
+    The raw errors of a batch of sessions, as arrays. raw_errors_lists holds each session's raw_errors list.
+    """
+    def __init__(self, raw_errors_lists):
+        self.raw_errors_lists = list(raw_errors_lists)
+        uploaded = [i for i, raw_errors in enumerate(self.raw_errors_lists) if raw_errors]
+        ends, lens = self._arrays(uploaded)
+        batch = uploaded
+        if not _exact(ends, lens):  # Find the sessions to leave to _normalize_errors
+            batch = [i for i in uploaded if _exact(*self._arrays([i]))]
+            ends, lens = self._arrays(batch)
+        self.batch = batch  # Indexes of the vectorized sessions
+        self.scalar = sorted(set(uploaded) - set(batch))
+        self.ends, self.lens = ends.astype(np.int64), lens.astype(np.int64)
+        sizes = np.array([len(self.raw_errors_lists[i]) for i in batch], dtype=np.int64)
+        self.offsets = np.cumsum(sizes) - sizes     # Each vectorized session's first raw error
+
+    def normalize(self, cutoff=_ERROR_CUTOFF):
+        """
+        Each session's normalized errors, as _normalize_errors(raw_errors, cutoff).
+        """
+        normalized = [list() for _ in self.raw_errors_lists]
+        for i in self.scalar:
+            normalized[i] = _normalize_errors(self.raw_errors_lists[i], cutoff)
+        sessions, first, last, durations = self._combine(cutoff)
+        for session, last_error, duration, count in zip(sessions.tolist(), (last - self.offsets[sessions]).tolist(),
+                                                        durations.tolist(), (last - first + 1).tolist()):
+            i = self.batch[session]
+            normalized[i].append(_Error(self.raw_errors_lists[i][last_error]['endtime'], duration, count))
+        return normalized
+
+    def counts(self, cutoff=_ERROR_CUTOFF):
+        """
+        Array of each session's number of normalized errors, as len(_normalize_errors(raw_errors, cutoff)).
+        """
+        counts = np.zeros(len(self.raw_errors_lists), dtype=np.int64)
+        for i in self.scalar:
+            counts[i] = len(_normalize_errors(self.raw_errors_lists[i], cutoff))
+        sessions = self._combine(cutoff)[0]
+        np.add.at(counts, np.array(self.batch, dtype=np.int64)[sessions], 1)
+        return counts
+
+    def _combine(self, cutoff):
+        """
+        Combined errors kept at cutoff: arrays of their session (index into batch), first & last raw error (index into
+        ends) and duration.
+        """
+        ends, lens = self.ends, self.lens
+        if not len(ends):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, empty
+        # A combined error starts at each session's first raw error & wherever a raw error isn't merged into the last
+        breaks = np.zeros(len(ends), dtype=bool)
+        breaks[self.offsets] = True
+        breaks[1:] |= ends[1:] - lens[1:] - cutoff > ends[:-1]
+        first = np.flatnonzero(breaks)
+        last = np.append(first[1:], len(ends)) - 1
+        durations = lens[first] + ends[last] - ends[first]
+        kept = durations >= cutoff
+        first, last, durations = first[kept], last[kept], durations[kept]
+        return np.searchsorted(self.offsets, first, side='right') - 1, first, last, durations
+
+    def _arrays(self, sessions):
+        """
+        Arrays of the end times & lengths of the raw errors of the sessions, end to end.
+        """
+        raw_errors = [error for i in sessions for error in self.raw_errors_lists[i]]
+        return (np.array([error['endtime'] for error in raw_errors]),
+                np.array([error.get('len') or error.get('duration') or 1 for error in raw_errors]))
+
+
+def _exact(ends, lens):
+    """
+    Whether int64 arithmetic on ends & lens gives what Python's does.
+    """
+    if not len(ends):
+        return True
+    if ends.dtype.kind != 'i' or lens.dtype.kind != 'i':
+        return False
+    return max(np.abs(ends).max(), np.abs(lens).max()) < _INT_LIMIT
@@ -6,8 +6,10 @@ Evaluation logic and criteria for activities
 from __future__ import division, absolute_import, print_function, unicode_literals
 
 from pyramid.httpexceptions import HTTPNotFound
+from repoze.lru import LRUCache
 
-from orthobox.data_store import (_POKEY, _PEGGY, _PASS, _FAIL, _INCOMPLETE, get_ids_for_session, get_grade, store_grade)
+from orthobox.data_store import (_POKEY, _PEGGY, _PASS, _FAIL, _INCOMPLETE, get_ids_for_session, get_grade, store_grade,
+                                 criteria_generation, load_criteria)
 
 
 _ERROR_CUTOFF = 250
@@ -16,38 +18,85 @@ _REQUIRED_SUCCESSES = 3
 
 _BOX_FUNCTION = {}
 
-# TODO: Session specific evaluation criteria
+# Built-in criteria, for contexts without stored criteria, see get_criteria
 _CRITERIA = {
     _POKEY: {'errors': 0, 'timeout': 248, 'pokes': 9},
     _PEGGY: {'errors': 0, 'timeout': 202, 'drops': 0}
 }
 
+# Compiled evaluators by (context_id, box_type, criteria generation), so uploads don't read criteria records. A change
+# by any process bumps the generation, leaving older entries to fall out of the cache.
+_EVALUATORS = LRUCache(256)
+
 
 def evaluate(session_id, data):
     # TODO: Audit evaluation logic
     # Will every test have errors & duration?
     box_type = data.get('version_string')
-    duration = data['duration']
-    if len(data['errors']) > _CRITERIA[box_type]['errors']:
-        result = _FAIL
-    elif duration > _CRITERIA[box_type]['timeout']:
-        result = _INCOMPLETE
-    else:
-        result = _BOX_FUNCTION[box_type](data)
-
     uid, context_id = get_ids_for_session(session_id)
-    if result is _PASS:     # Add completion credit to grade
-        grade = get_grade(uid, context_id, box_type)
-        grade += 1 / _REQUIRED_SUCCESSES
-        if grade > 1.0:
-            grade = 1.0
-    else:
-        grade = 0
+    result = _evaluator(context_id, box_type)(data)
+
+    grade = _next_grade(get_grade(uid, context_id, box_type), result)
     store_grade(uid, context_id, box_type, grade)
 
     return result, grade
 
 
+def get_criteria(context_id, box_type):
+    """
+    Criteria for box_type in context_id: as stored for the context, else as stored as the default (context_id None),
+    over the built-in _CRITERIA.
+    """
+    return _merge_criteria(box_type, load_criteria(context_id, box_type))
+
+
+def _merge_criteria(box_type, *overrides):
+    """
+    _CRITERIA of box_type updated with each of overrides, {criterion: value} or None, in turn.
+    """
+    criteria = dict(_CRITERIA[box_type])
+    for override in overrides:
+        criteria.update(override or {})
+    return criteria
+
+
+def _evaluator(context_id, box_type):
+    """
+    Compiled evaluator of context_id's criteria at box_type, from _EVALUATORS.
+    """
+    key = (context_id, box_type, criteria_generation())
+    evaluator = _EVALUATORS.get(key)
+    if evaluator is None:
+        evaluator = _compile(box_type, get_criteria(context_id, box_type))
+        _EVALUATORS.put(key, evaluator)
+    return evaluator
+
+
+def _compile(box_type, criteria):
+    """
+    Returns evaluator(data) -> result of uploaded data at box_type under criteria, {criterion: value}.
+    """
+    errors, timeout, box_function = criteria['errors'], criteria['timeout'], _BOX_FUNCTION[box_type]
+
+    def evaluator(data):
+        if len(data['errors']) > errors:
+            return _FAIL
+        elif data['duration'] > timeout:
+            return _INCOMPLETE
+        return box_function(data, criteria)
+    return evaluator
+
+
+def _next_grade(grade, result):
+    """
+    Grade after a session evaluated as result, given the grade before it: passes add completion credit, anything else
+    starts over.
+    """
+    if result == _PASS:
+        return min(grade + 1 / _REQUIRED_SUCCESSES, 1.0)
+    return 0
+
+
 def get_progress_count(grade):
     """
     Returns number of consecutive successes, number of required consecutive successes.
@@ -55,7 +104,11 @@ def get_progress_count(grade):
     return int(round(grade * _REQUIRED_SUCCESSES)), _REQUIRED_SUCCESSES
 
 
-def _normalize_errors(raw_errors):
+def _normalize_errors(raw_errors, cutoff=_ERROR_CUTOFF):
+    """
+    Combine raw error contacts starting within cutoff ms of the previous one's end, keeping those at least cutoff ms
+    long. See orthobox.error_batch for many sessions at once.
+    """
     if not raw_errors:
         return list()
     errors = iter(raw_errors)  # Need to operate non-destructively upon raw_errors
@@ -67,17 +120,17 @@ def _normalize_errors(raw_errors):
     for error in errors:
         new_len = error.get('len') or error.get('duration') or 1
         new_endtime = error['endtime']
-        if new_endtime - new_len - _ERROR_CUTOFF <= endtime:  # Combine errors
+        if new_endtime - new_len - cutoff <= endtime:  # Combine errors
             error_count += 1
             len_ += new_endtime - endtime
             endtime = new_endtime
         else:  # Save current error, move new -> current
-            if len_ >= _ERROR_CUTOFF:
+            if len_ >= cutoff:
                 combined.append(_Error(endtime, len_, error_count))
             endtime, len_ = new_endtime, new_len
             error_count = 1
 
-    if len_ >= _ERROR_CUTOFF:
+    if len_ >= cutoff:
         combined.append(_Error(endtime, len_, error_count))
     return combined
 
@@ -86,9 +139,9 @@ def _Error(endtime, duration, count):
     return {'endtime': endtime, 'duration': duration, 'error_count': count}
 
 
-def _pokey_box(data):
+def _pokey_box(data, criteria):
     # Make sure they actually poked stuff
-    if len(data['pokes']) >= _CRITERIA[_POKEY]['pokes']:
+    if len(data['pokes']) >= criteria['pokes']:
         result = _PASS
     else:
         result = _INCOMPLETE
@@ -97,9 +150,9 @@ def _pokey_box(data):
 _BOX_FUNCTION[_POKEY] = _pokey_box
 
 
-def _peggy_box(data):
+def _peggy_box(data, criteria):
     # Don't drop stuff inside of people
-    if len(data['drops']) > _CRITERIA[_PEGGY]['drops']:
+    if len(data['drops']) > criteria['drops']:
         result = _FAIL
     else:
         result = _PASS
@@ -108,9 +161,8 @@ def _peggy_box(data):
 _BOX_FUNCTION[_PEGGY] = _peggy_box
 
 
-def _select_criteria(request):
-    key = request.matchdict['version_string']
-    value = _CRITERIA.get(key)
-    if value is None:
+def _select_box_type(request):
+    box_type = request.matchdict['version_string']
+    if box_type not in _CRITERIA:
         raise HTTPNotFound('Unknown hardware version')
-    return value
+    return box_type
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Grade passback outbox.
+
+Uploads queue their grade with data_store.enqueue_grade in the same unit of work that stores the result, and return.
+A pool of background threads posts queued grades to the LMS outcome service, retrying failures with exponential
+backoff. The queue lives in LMDB, so grades survive restarts and several processes may share it.
+
+Configuration, by environment variable:
+GRADE_OUTBOX_WORKERS: Delivery threads per process, 0 to leave delivery to other processes. Default 4.
+GRADE_OUTBOX_MAX_ATTEMPTS: Attempts before a grade is given up on (kept as 'failed:target'). Default 12.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import time
+import random
+import logging
+import threading
+
+from os import environ
+from collections import deque
+
+from orthobox.data_store import get_oauth_creds, claim_grades, settle_grade, outbox_depth
+from orthobox.tool_provider import WebObToolProvider
+
+log = logging.getLogger(__name__)
+
+_WORKERS = int(environ.get('GRADE_OUTBOX_WORKERS', 4))
+_MAX_ATTEMPTS = int(environ.get('GRADE_OUTBOX_MAX_ATTEMPTS', 12))
+
+_LEASE = 120    # Seconds a claimed grade is left to its worker, well over the outcome request timeout
+_POLL = 5   # Seconds between checks for retries coming due
+_BACKOFF = 2    # Seconds before the first retry, doubling each attempt
+_MAX_BACKOFF = 60 * 60
+
+_LATENCY_SAMPLES = 1000
+
+
+class DeliveryError(Exception):
+    pass
+
+
+def tool_provider_for(params):
+    key = params['oauth_consumer_key']
+    return WebObToolProvider(key, get_oauth_creds(key), params)
+
+
+def post_grade(session_id, grade, params):
+    """
+    Post grade to the outcome service of the launch that created session_id. DeliveryError unless it succeeded.
+    """
+    outcome_request = tool_provider_for(params).new_request()
+    outcome_request.message_identifier = session_id
+    outcome_response = outcome_request.post_replace_result(round(grade, 2))    # Round to 2 digits for moodle
+
+    if not outcome_response.is_success():
+        raise DeliveryError(outcome_response.response_code, outcome_response.code_major,
+                            outcome_response.description)
+    return outcome_response
+
+
+class GradeOutbox(object):
+    """
+    Pool of delivery threads draining the outbox through post(session_id, grade, params).
+
+    Delivery statistics (stats()) are kept per process.
+    """
+    def __init__(self, post=post_grade, workers=_WORKERS, max_attempts=_MAX_ATTEMPTS, lease=_LEASE, poll=_POLL,
+                 backoff=_BACKOFF, max_backoff=_MAX_BACKOFF):
+        self.post = post
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.poll = poll
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._threads = list()
+        self._stopping = False
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=_LATENCY_SAMPLES)
+        self._counts = {'delivered': 0, 'retried': 0, 'failed': 0}
+
+    def start(self):
+        """
+        Start the delivery threads, once.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='grade-outbox-{0}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Stop the delivery threads once they finish the grade in hand, waiting up to timeout seconds for each. Grades
+        they never settle are retried once their lease runs out.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, list()
+            self._stopping = True
+        self._wake.set()
+        for thread in threads:
+            thread.join(timeout)
+        with self._lock:
+            self._stopping = False
+
+    def wake(self):
+        """
+        Have idle workers look for grades now, eg. after enqueueing one, rather than at their next poll.
+        """
+        self._wake.set()
+
+    def stats(self):
+        """
+        Outbox depth and, for deliveries by this process, counts & delivery latency (seconds from enqueue to
+        successful post) over the last _LATENCY_SAMPLES deliveries.
+        """
+        pending, failed = outbox_depth()
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {'pending': pending, 'failed': failed, 'workers': len(self._threads),
+                     'process': dict(self._counts)}
+        if latencies:
+            stats['latency'] = {'mean': sum(latencies) / len(latencies),
+                                'p50': latencies[len(latencies) // 2],
+                                'p95': latencies[int(len(latencies) * 0.95)],
+                                'max': latencies[-1]}
+        return stats
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                claimed = claim_grades(1, self.lease)
+            except Exception:
+                log.exception("Claiming grades from the outbox failed")
+                claimed = None
+            if not claimed:
+                self._wake.wait(self.poll)
+                self._wake.clear()
+                continue
+            for target, record in claimed:
+                try:
+                    self._deliver(target, record)
+                except Exception:   # The lease runs out and the grade is retried
+                    log.exception("Settling grade for session %s failed", record['session_id'])
+
+    def _deliver(self, target, record):
+        try:
+            self.post(record['session_id'], record['grade'], record['params'])
+        except Exception as e:
+            attempts = record['attempts']
+            if attempts < self.max_attempts:
+                retry_in = min(self.backoff * 2 ** (attempts - 1), self.max_backoff) * random.uniform(0.5, 1.0)
+                log.warning("Grade for session %s failed (attempt %d), retrying in %.0fs: %r", record['session_id'],
+                            attempts, retry_in, e)
+                self._count('retried')
+            else:
+                retry_in = None
+                log.error("Grade for session %s failed (attempt %d), giving up: %r", record['session_id'], attempts, e)
+                self._count('failed')
+            settle_grade(target, record['token'], repr(e), retry_in)
+        else:
+            settle_grade(target, record['token'])
+            with self._lock:
+                self._counts['delivered'] += 1
+                self._latencies.append(time.time() - record['enqueued'])
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+
+OUTBOX = GradeOutbox()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk grade resync: re-post the current grade of every user in a course context to the LMS outcome service.
+
+For when the LMS lost grades, or the outbox gave up on some. Each user & activity's grade is sent with the outcome
+service params of their latest launch; users who never launched an activity as an outcome service are skipped.
+
+queue_grades, for the LTI view, queues them in the grade outbox and returns at once: the outbox workers deliver them
+at their own pace, and a grade queued while another for the same outcome is being delivered waits for it to settle.
+resync_grades posts them directly, concurrently through a bounded pool of threads at no more than a given rate, and
+waits for every response: for orthobox_resync_grades, run offline.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import time
+import logging
+import threading
+
+from uuid import uuid4
+from multiprocessing.pool import ThreadPool
+
+from orthobox.data_store import get_course_outcomes, enqueue_grade, atomically
+from orthobox.grade_outbox import post_grade
+
+log = logging.getLogger(__name__)
+
+_WORKERS = 8
+_RATE = 10.0    # Posts per second, summed over workers
+
+
+class _RateLimiter(object):
+    """
+    Spaces calls to wait() at least 1 / rate seconds apart, across threads.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def queue_grades(context_id, box_types=None):
+    """
+    Queue the grade of every user in context_id, for each of box_types (default all), in the grade outbox. The
+    caller wakes the outbox. Returns {'queued', 'skipped'}
+    """
+    return atomically(_queue_grades, context_id, box_types)
+
+
+def _queue_grades(context_id, box_types):
+    # Grades are read in the same write transaction, so none stored meanwhile is replaced by an older one
+    outcomes = get_course_outcomes(context_id, box_types)
+    queued = 0
+    for outcome in outcomes:
+        if outcome['params'] is not None:
+            enqueue_grade(uuid4().hex, outcome['grade'], outcome['params'])
+            queued += 1
+    return {'queued': queued, 'skipped': len(outcomes) - queued}
+
+
+def resync_grades(context_id, box_types=None, workers=_WORKERS, rate=_RATE, post=post_grade, outcome_url=None):
+    """
+    Post the grade of every user in context_id, for each of box_types (default all), through post(message_id,
+    grade, params). outcome_url, if given, replaces the launches' lis_outcome_service_url, eg. for a stand-in.
+
+    Returns {'users': [{'uid', 'username', 'box_type', 'grade', 'status': 'ok' | 'skipped' | 'error', 'error',
+    'seconds'}, ...], 'posted', 'failed', 'skipped', 'seconds', 'per_second'}
+    """
+    outcomes = get_course_outcomes(context_id, box_types)
+    limiter = _RateLimiter(rate)
+
+    def resync(outcome):
+        report = {'uid': outcome['uid'], 'username': outcome['username'], 'box_type': outcome['box_type'],
+                  'grade': outcome['grade'], 'status': 'skipped', 'error': None, 'seconds': 0}
+        params = outcome['params']
+        if params is None:
+            return report
+        if outcome_url is not None:
+            params = dict(params, lis_outcome_service_url=outcome_url)
+        limiter.wait()
+        start = time.time()
+        try:
+            post(uuid4().hex, outcome['grade'], params)
+        except Exception as e:
+            log.warning("Resyncing %s grade for user %s failed: %r", outcome['box_type'], outcome['uid'], e)
+            report['status'], report['error'] = 'error', repr(e)
+        else:
+            report['status'] = 'ok'
+        report['seconds'] = time.time() - start
+        return report
+
+    start = time.time()
+    pool = ThreadPool(max(1, min(workers, len(outcomes))))
+    try:
+        users = pool.map(resync, outcomes, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - start
+
+    statuses = [user['status'] for user in users]
+    posted = statuses.count('ok')
+    failed = statuses.count('error')
+    return {'users': users, 'posted': posted, 'failed': failed, 'skipped': statuses.count('skipped'),
+            'seconds': seconds, 'per_second': (posted + failed) / seconds if seconds else 0}
@@ -5,18 +5,167 @@ Dict-like wrapper for simple lmdb access.
 from __future__ import division, absolute_import, print_function, unicode_literals
 
 import lmdb
+import threading
+import time
 
 from tempfile import mkdtemp
+from functools import wraps
+from contextlib import contextmanager
 from collections import MutableMapping
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from orthobox.record_codec import JSONCodec
+
+
+_bound = threading.local()
+
+
+@contextmanager
+def transaction(environment, write=False):
+    """
+    Unit of work: bind one transaction on environment to the current thread for the duration of the block.
+
+    Every LMDB_Dict on environment used inside the block joins it instead of opening its own, so the block commits
+    (and fsyncs) once, or aborts as a whole on exception. Nested blocks join the outermost transaction.
+    """
+    outer = getattr(_bound, 'txn', None)
+    if outer is not None and outer.env is environment:
+        if write and not outer.write:
+            raise RuntimeError("Write transaction requested inside a read-only unit of work")
+        yield outer.txn
+        return
+    with environment.begin(write=write) as txn:
+        _bound.txn = _BoundTransaction(environment, txn, write)
+        try:
+            yield txn
+        finally:
+            _bound.txn = outer
+
+
+def _in_transaction(environment):
+    bound = getattr(_bound, 'txn', None)
+    return bound is not None and bound.env is environment
+
+
+class GroupCommitWriter(object):
+    """
+    Group commit: one thread runs write jobs from every request thread, merging up to max_batch of them (or however
+    many arrive within window seconds) into a single write transaction, so a burst of uploads shares one fsync.
+
+    Each job runs in a nested transaction of the batch, so a job that raises is rolled back alone. Callers block in
+    call() until their batch is committed and durable. Jobs hold the writer, keep them free of network I/O.
+    """
+    def __init__(self, environment, window=0.005, max_batch=64):
+        self.env = environment
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run, name='lmdb-group-commit')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call(self, function, *args, **kwargs):
+        """
+        Run function(*args, **kwargs) as a unit of work in the next batch, returns its result once committed.
+        """
+        if _in_transaction(self.env):   # Already inside a unit of work, eg. a job calling LMDB_Dict methods
+            return function(*args, **kwargs)
+        job = _Job(function, args, kwargs)
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with self.env.begin(write=True) as txn:
+                for job in batch:
+                    child = self.env.begin(write=True, parent=txn)
+                    _bound.txn = _BoundTransaction(self.env, child, True)
+                    try:
+                        job.result = job.function(*job.args, **job.kwargs)
+                    except Exception as e:
+                        child.abort()
+                        job.error = e
+                    else:
+                        child.commit()
+                    finally:
+                        _bound.txn = None
+        except Exception as e:  # Batch failed to commit, eg. MapFullError, so nothing in it was written
+            for job in batch:
+                job.error = job.error or e
+        for job in batch:
+            job.done.set()
+
+
+class _Job(object):
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def _writes(method):
+    """
+    Route a write method through the dict's GroupCommitWriter, unless already inside a unit of work.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.writer is not None and not _in_transaction(self.env):
+            return self.writer.call(method, self, *args, **kwargs)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _BoundTransaction(object):
+    def __init__(self, env, txn, write):
+        self.env = env
+        self.txn = txn
+        self.write = write
+
+    def __enter__(self):
+        return self.txn
+
+    def __exit__(self, *_):
+        pass    # Owned by the enclosing unit of work, which commits or aborts
+
+
+_MISSING = object()
 
 
 class LMDB_Dict(MutableMapping):
     """
     A naïve abstraction for lmdb.
+
+    The mapping interface stores text values as-is. load, dump, iterprefix & append work with records, serialized by
+    codec (see orthobox.record_codec, JSON by default).
     """
-    def __init__(self, environment=None, db_name=None, encoding='utf-8'):
+    def __init__(self, environment=None, db_name=None, encoding='utf-8', writer=None, codec=None):
         self.env = environment if isinstance(environment, lmdb.Environment) else lmdb.open(mkdtemp())
         self.encoding = encoding
+        self.writer = writer    # Optional GroupCommitWriter for writes outside a unit of work
+        self.codec = codec or JSONCodec()
         self.db = environment.open_db(self._encode(db_name) if db_name else None)
 
     def _encode(self, text):
@@ -31,61 +180,179 @@ class LMDB_Dict(MutableMapping):
         except AttributeError:
             raise TypeError("Unable to decode", binary)
 
-    def txn(self, write=False):
-        # TODO: prevent multiple write transactions
-        return self.env.begin(db=self.db, write=write)
+    def txn(self, write=False, buffers=False):
+        """
+        Context manager for a transaction: the current unit of work if one is bound to this thread, else a new one.
+
+        buffers=True reads return buffers into the memory map, only valid until the transaction ends.
+        """
+        bound = getattr(_bound, 'txn', None)
+        if bound is not None and bound.env is self.env:
+            if write and not bound.write:
+                raise RuntimeError("Write inside a read-only unit of work")
+            return bound
+        return self.env.begin(db=self.db, write=write, buffers=buffers)
 
     def __len__(self):
         with self.txn() as txn:
-            return txn.stat()['entries']
+            return txn.stat(self.db)['entries']
 
     def __iter__(self):
         with self.txn() as txn:
-            for key in txn.cursor().iternext(values=False):
+            for key in txn.cursor(db=self.db).iternext(values=False):
                 yield self._decode(key)
 
     def __contains__(self, key):
         with self.txn() as txn:
-            return txn.get(self._encode(key)) is not None
+            return txn.get(self._encode(key), db=self.db) is not None
 
     def __getitem__(self, key):
         with self.txn() as txn:
-            value = txn.get(self._encode(key))
+            value = txn.get(self._encode(key), db=self.db)
         if value is None:
             raise KeyError(key)
         return self._decode(value)
 
+    @_writes
     def __setitem__(self, key, value):
         with self.txn(True) as txn:
-            txn.put(self._encode(key), self._encode(value))
+            txn.put(self._encode(key), self._encode(value), db=self.db)
 
+    @_writes
     def __delitem__(self, key):
         with self.txn(True) as txn:
-            if not txn.delete(self._encode(key)):   # Returns False if no key found
+            if not txn.delete(self._encode(key), db=self.db):   # Returns False if no key found
                 raise KeyError(key)
 
+    def load(self, key, default=_MISSING):
+        """
+        Returns the record for key, decoded by the codec. The codec parses one copy of the stored bytes, taken out of
+        the memory map by record_codec._as_bytes. KeyError if missing and no default given.
+        """
+        with self.txn(buffers=True) as txn:
+            value = txn.get(self._encode(key), db=self.db)
+            if value is not None:
+                return self.codec.loads(value)
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def load_many(self, keys, default=None):
+        """
+        Returns the records for keys, in the same order, default for missing ones. Read in one transaction, with the
+        cursor visiting the keys in sorted order so each page along the way is touched once.
+        """
+        encoded = [self._encode(key) for key in keys]
+        records = dict()
+        with self.txn(buffers=True) as txn:
+            cursor = txn.cursor(db=self.db)
+            for key in sorted(set(encoded)):
+                if cursor.set_key(key):
+                    records[key] = self.codec.loads(cursor.value())
+        return [records.get(key, default) for key in encoded]
+
+    @_writes
+    def dump(self, key, record):
+        """
+        Store record for key, serialized by the codec.
+        """
+        with self.txn(True) as txn:
+            txn.put(self._encode(key), self.codec.dumps(record), db=self.db)
+
+    def raw(self, key, default=None):
+        """
+        Returns the stored bytes for key, undecoded.
+        """
+        with self.txn() as txn:
+            return txn.get(self._encode(key), default, db=self.db)
+
+    def iterprefix(self, prefix, reverse=False, raw=False):
+        """
+        Yields (key, record) for every key starting with prefix, in key order, via a cursor range scan.
+
+        raw=True yields records as stored bytes, undecoded.
+        """
+        decode = bytes if raw else self.codec.loads
+        prefix = self._encode(prefix)
+        with self.txn() as txn:
+            cursor = txn.cursor(db=self.db)
+            if reverse:
+                if not _seek_prefix_end(cursor, prefix):
+                    return
+                items = cursor.iterprev()
+            else:
+                if not cursor.set_range(prefix):
+                    return
+                items = cursor.iternext()
+            for key, value in items:
+                if not key.startswith(prefix):
+                    break
+                yield self._decode(key), decode(value)
+
+    def scan(self, prefix, after=None, limit=None, raw=False):
+        """
+        Returns a list of up to limit (key, record) pairs with keys starting with prefix, in key order, beginning after
+        the key after when given.
+
+        Unlike iterprefix the transaction ends before returning, so a long range can be read page by page, resuming
+        from the last key, without holding a reader open while the caller works through each page.
+        """
+        decode = bytes if raw else self.codec.loads
+        encoded = self._encode(prefix)
+        items = list()
+        with self.txn() as txn:
+            cursor = txn.cursor(db=self.db)
+            start = encoded if after is None else self._encode(after)
+            if not cursor.set_range(start):
+                return items
+            if after is not None and cursor.key() == start and not cursor.next():
+                return items
+            for key, value in cursor.iternext():
+                if not key.startswith(encoded) or (limit is not None and len(items) >= limit):
+                    break
+                items.append((self._decode(key), decode(value)))
+        return items
+
+    @_writes
+    def append(self, prefix, record, width=8):
+        """
+        Store record under the next zero-padded sequence number after prefix, returns the new key.
+
+        Keys sort in insertion order, so iterprefix(prefix) replays the records as a list.
+        """
+        encoded = self._encode(prefix)
+        with self.txn(True) as txn:
+            cursor = txn.cursor(db=self.db)
+            sequence = 0
+            if _seek_prefix_end(cursor, encoded) and cursor.key().startswith(encoded):
+                sequence = int(cursor.key()[len(encoded):]) + 1
+            key = '{0}{1:0{2}d}'.format(prefix, sequence, width)
+            txn.put(self._encode(key), self.codec.dumps(record), db=self.db)
+        return key
+
     def keys(self):
         with self.txn() as txn:
-            return tuple(self._decode(key) for key in txn.cursor().iternext(values=False))
+            return tuple(self._decode(key) for key in txn.cursor(db=self.db).iternext(values=False))
 
     def values(self):
         with self.txn() as txn:
-            return tuple(self._decode(value) for value in txn.cursor().iternext(keys=False))
+            return tuple(self._decode(value) for value in txn.cursor(db=self.db).iternext(keys=False))
 
     def items(self):
         with self.txn() as txn:
-            return tuple((map(self._decode, item)) for item in txn.cursor().iternext())
+            return tuple((map(self._decode, item)) for item in txn.cursor(db=self.db).iternext())
 
     def get(self, key, default=None):
         with self.txn() as txn:
-            result = txn.get(self._encode(key), default)
+            result = txn.get(self._encode(key), default, db=self.db)
             if result is not default:
                 return self._decode(result)
             return default
 
+    @_writes
     def pop(self, key, default=None):
         with self.txn(True) as txn:
-            result = txn.pop(self._encode(key))
+            result = txn.pop(self._encode(key), db=self.db)
         if result is not None:
             return self._decode(result)
         if default is not None:
@@ -93,9 +360,10 @@ class LMDB_Dict(MutableMapping):
         # Nothing removed, no default
         raise KeyError(key)
 
+    @_writes
     def popitem(self):
         with self.txn(True) as txn:
-            cursor = txn.cursor()
+            cursor = txn.cursor(db=self.db)
             result = cursor.first()
             if not result:
                 raise KeyError("Empty database")
@@ -103,14 +371,28 @@ class LMDB_Dict(MutableMapping):
             cursor.delete()
             return tuple(map(self._decode, (key, value)))
 
+    @_writes
     def clear(self):
         with self.txn(True) as txn:
             txn.drop(self.db, delete=False)
 
+    @_writes
     def setdefault(self, key, default=None):
         with self.txn(True) as txn:
-            result = txn.get(self._encode(key))
+            result = txn.get(self._encode(key), db=self.db)
             if result is not None:
                 return self._decode(result)
-            txn.put(self._encode(key), self._encode(default or ''))
+            txn.put(self._encode(key), self._encode(default or ''), db=self.db)
             return default
+
+
+def _seek_prefix_end(cursor, prefix):
+    """
+    Position cursor on the last key sorting at or before the keys starting with prefix. False if there is none.
+    """
+    if not prefix:
+        return cursor.last()
+    following = bytes(prefix[:-1] + bytearray([bytearray(prefix)[-1] + 1]))
+    if cursor.set_range(following):
+        return cursor.prev()
+    return cursor.last()
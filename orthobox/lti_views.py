@@ -15,31 +15,31 @@ import csv
 from oauth2 import Error as OAuthError
 from pyramid.view import view_config
 from pyramid.renderers import render_to_response
-from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.httpexceptions import HTTPUnauthorized, HTTPServiceUnavailable
 
 from orthobox.tool_provider import WebObToolProvider
-from orthobox.rest_views import _url_params
+from orthobox.rest_views import _url_params, graph_token
 from orthobox.evaluation import get_progress_count
+from orthobox.grade_resync import queue_grades
+from orthobox.grade_outbox import OUTBOX
+from orthobox.nonce_store import NonceStoreFull
 from orthobox.data_store import (get_upload_token, verify_resource_oauth, authorize_user, store_session_params,
-                                 get_oauth_creds, activity_display_name, get_session_data, get_metadata, _PASS,
-                                 get_user_data_by_uid, get_ids_from_moodle_uid, get_user_data_by_context_id,
-                                 get_box_name, table_encode_session_data)
+                                 get_oauth_creds, activity_display_name, get_grade, get_progress_summary,
+                                 get_ids_from_moodle_uid, get_box_name, iter_session_table, atomically,
+                                 nonce_first_seen)
 
 
 @view_config(route_name='lti_launch')
 def lti_launch(request):
-    tool_provider = _authorize_tool_provider(request)
+    tool_provider = _authorize_tool_provider(request)   # Signature & nonce, before taking the writer
 
-    try:
-        session_id = _new_session(tool_provider)
-    except AssertionError as e:
-        raise HTTPUnauthorized(e.message)
+    session_id, upload_token = atomically(_launch, tool_provider)
 
     params = _url_params(session_id)
     params['session_id'] = session_id
     params['username'] = tool_provider.username(default="lovely")
     params['activity'] = activity_display_name(tool_provider.get_custom_param('box_version'))
-    params['upload_token'] = get_upload_token(session_id)
+    params['upload_token'] = upload_token
     return render_to_response("templates/begin.pt", params, request)
 
 
@@ -59,18 +59,18 @@ def lti_progress(request):
     except AssertionError as e:
         raise HTTPUnauthorized(e.message)
 
-    params = list()
+    if 'Instructor' in tool_provider.roles:     # Page shell, graphs are fetched as they scroll into view
+        return render_to_response("templates/progress_shell.pt",
+                                  {'activity': activity_display_name(activity), 'activity_string': activity,
+                                   'token': graph_token(context_id, activity)}, request)
+
     MoodleID = namedtuple('MoodleID', 'uid, username')
-    if 'Instructor' in tool_provider.roles:
-        users = get_user_data_by_context_id(context_id)
-        for uid, user_data in users.items():
-            moodle_id = MoodleID(**get_ids_from_moodle_uid(user_data['moodle_uid']))
-            params.append(_gather_template_data(moodle_id, user_data[activity], activity))
-    else:
-        moodle_id = MoodleID(**get_ids_from_moodle_uid(moodle_uid))
-        activity_data = get_user_data_by_uid(moodle_id.uid, context_id)[activity]
-        params.append(_gather_template_data(moodle_id, activity_data, activity))
-    return render_to_response("templates/progress.pt", {'params': params}, request)
+    moodle_id = MoodleID(**get_ids_from_moodle_uid(moodle_uid))
+    grade = get_grade(moodle_id.uid, context_id, activity)
+    summary = get_progress_summary(moodle_id.uid, context_id, activity)
+    # Reached by a signed LTI POST, never revalidated, so no ETag: see rest_views get_progress_graph for those
+    return render_to_response("templates/progress.pt",
+                              {'params': [_gather_template_data(moodle_id, grade, summary, activity)]}, request)
 
 
 @view_config(route_name='lti_csv_export', renderer='csv')
@@ -90,7 +90,32 @@ def lti_csv_export(request):
     box_type = tool_provider.get_custom_param('box_version')
     simple = True if tool_provider.get_custom_param('simple') == 'true' else False
 
-    return table_encode_session_data(context_id, box_type, simple)
+    return iter_session_table(context_id, box_type, simple)
+
+
+@view_config(route_name='lti_grade_resync', renderer='json')
+def lti_grade_resync(request):
+    """
+    Re-send every grade in the launching course to its outcome service, for the launch's activity or all of them.
+    Grades are queued in the grade outbox and delivered in the background; returns {'queued', 'skipped'} at once.
+    """
+    tool_provider = _authorize_tool_provider(request)
+
+    instance_id = tool_provider.tool_consumer_instance_guid
+    moodle_resource_id = _hash(instance_id, 'resource_link_id=' + tool_provider.resource_link_id)
+
+    try:
+        verify_resource_oauth(moodle_resource_id, tool_provider)
+        assert 'Instructor' in tool_provider.roles
+    except AssertionError as e:
+        raise HTTPUnauthorized(e.message)
+
+    context_id = _hash(instance_id, 'context_id=' + tool_provider.context_id)
+    box_type = tool_provider.get_custom_param('box_version')
+
+    queued = queue_grades(context_id, [box_type] if box_type else None)
+    OUTBOX.wake()
+    return queued
 
 
 class CSV_Renderer(object):  # Totally stolen from stackoverflow
@@ -98,71 +123,56 @@ class CSV_Renderer(object):  # Totally stolen from stackoverflow
         pass
 
     def __call__(self, value, system):
-        fout = StringIO.StringIO()
-        writer = csv.writer(fout)
-
-        writer.writerows(value)
-
         response = system['request'].response
-        response.context_type = 'text/csv'
+        response.content_type = str('text/csv')
         response.content_disposition = 'attachment;filename="export.csv"'
+        response.app_iter = _iter_csv(value)
 
-        return fout.getvalue()
+        return None  # Leaves the body to app_iter, rows are written as the server sends them
 
 
-def _gather_template_data(moodle_id, activity_data, activity):
-    not_passing, passing, all_errors, drops, hover_data = _build_graph_data(activity_data['sessions'])
+def _iter_csv(rows, chunk_rows=100):
+    """
+    Yields CSV text for rows, chunk_rows rows at a time.
+    """
+    fout = StringIO.StringIO()
+    writer = csv.writer(fout)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            yield fout.getvalue()
+            fout.seek(0)
+            fout.truncate()
+    yield fout.getvalue()
+
+
+def _gather_template_data(moodle_id, grade, summary, activity):
+    """
+    Template parameters for one user's progress graph, from their precomputed summary (see get_progress_summary).
+    """
     activity_name = activity_display_name(activity)
     return {'uid': moodle_id.uid,
-            'not_passing': not_passing,
-            'passing': passing,
-            'all_errors': all_errors,
-            'drops': drops,
-            'hover_data': hover_data,
+            'not_passing': summary['not_passing'],
+            'passing': summary['passing'],
+            'all_errors': summary['all_errors'],
+            'drops': summary['drops'],
+            'hover_data': summary['hover_data'],
             'username': moodle_id.username,
             'activity': activity_name,
             'activity_string': activity,
-            'attempts': len(not_passing) + len(passing),
-            'completion': '{0} of {1}'.format(*get_progress_count(activity_data['grade']))}
-
-
-def _build_graph_data(session_ids):
-    passing = list()
-    not_passing = list()
-    all_errors = list()  # each element: [trial #, end time, start time]
-    drops = list()
-    # [number of errors for not_passing, # of errors for passing, error length, drop time]
-    hover_data = [list(), list(), list(), list()]
-    for i, session_id in enumerate(session_ids):
-        # TODO: Ignore 'blank' sessions
-        i += 1  # 1-indexed for display purposes. PS: Namespaces rock
-
-        data = get_session_data(session_id)
-        if not data:
-            continue
-
-        error_count = 0
-        for error in data['errors']:
-            end = error['endtime']
-            duration = error['duration']
-            all_errors.append([i, end / 1000, (end - duration) / 1000])
-            hover_data[2].append(duration / 1000)
-            error_count += 1
-
-        for drop in data.get('drops', []):
-            drop_time = drop['endtime'] / 1000
-            drops.append([i, drop_time])
-            hover_data[3].append(drop_time)
-
-        metadata = get_metadata(session_id)
-        if metadata['result'] == _PASS:
-            passing.append([i, data['duration']])
-            hover_data[1].append(error_count)
-        else:
-            not_passing.append([i, data['duration']])
-            hover_data[0].append(error_count)
-
-    return not_passing, passing, all_errors, drops, hover_data
+            'attempts': len(summary['not_passing']) + len(summary['passing']),
+            'completion': '{0} of {1}'.format(*get_progress_count(grade))}
+
+
+def _launch(tool_provider):
+    """
+    Register the resource & user and create the session as one unit of work. Returns (session_id, upload_token).
+    """
+    try:
+        session_id = _new_session(tool_provider)
+    except AssertionError as e:
+        raise HTTPUnauthorized(e.message)
+    return session_id, get_upload_token(session_id)
 
 
 def _new_session(tool_provider):
@@ -220,14 +230,12 @@ def _authorize_tool_provider(request):
     return tool_provider
 
 
-_OAuth_creds = {}
-
-
 def _validate_nonce(nonce, now):
-    timestamp = _OAuth_creds.get(nonce)
-    if timestamp is None:
-        _OAuth_creds[nonce] = now
-    elif now - timestamp > 60 * 60:
+    try:
+        timestamp = nonce_first_seen(nonce, now)
+    except NonceStoreFull:
+        raise HTTPServiceUnavailable("Too many OAuth nonces to check")
+    if now - timestamp > 60 * 60:
         raise HTTPUnauthorized("OAuth nonce timeout")
 
 
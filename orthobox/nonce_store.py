@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+OAuth nonce stores: when was a nonce first seen, forgetting nonces a whole bucket at a time.
+
+Nonces are kept in a ring of buckets, each holding the nonces first seen in one window (an hour by default). When the
+ring comes round to a bucket it is emptied in one go, so a nonce is remembered for at least (buckets - 1) windows
+with no per-key sweeps. That must outlast the OAuth timestamp check, after which a replayed request is refused anyway.
+
+Both stores hold at most max_nonces, refusing new nonces with NonceStoreFull rather than forgetting live ones.
+MemoryNonceStore is per process, LMDBNonceStore is shared by every process using the same LMDB environment.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import threading
+
+from orthobox.lmdb_wrapper import LMDB_Dict, transaction, _in_transaction
+
+_WINDOW = 60 * 60
+_BUCKETS = 3
+_MAX_NONCES = 100000
+
+
+class NonceStoreFull(Exception):
+    pass
+
+
+class MemoryNonceStore(object):
+    """
+    Nonces in a ring of dicts, for a single process.
+    """
+    def __init__(self, window=_WINDOW, buckets=_BUCKETS, max_nonces=_MAX_NONCES):
+        self.window = window
+        self.max_nonces = max_nonces
+        self._periods = [None] * buckets
+        self._buckets = [dict() for _ in range(buckets)]
+        self._lock = threading.Lock()
+
+    def first_seen(self, nonce, now):
+        """
+        Returns when nonce was first seen, recording it as seen now if it is new. NonceStoreFull if the store is.
+        """
+        period = int(now // self.window)
+        with self._lock:
+            live = [bucket for bucket, bucket_period in zip(self._buckets, self._periods)
+                    if bucket_period is not None and bucket_period > period - len(self._buckets)]
+            for bucket in live:
+                timestamp = bucket.get(nonce)
+                if timestamp is not None:
+                    return timestamp
+            slot = period % len(self._buckets)
+            if self._periods[slot] != period:   # The ring came round, forget the oldest window
+                self._buckets[slot] = dict()
+                self._periods[slot] = period
+            if sum(len(bucket) for bucket in live) >= self.max_nonces:
+                raise NonceStoreFull(self.max_nonces)
+            self._buckets[slot][nonce] = now
+        return now
+
+
+class LMDBNonceStore(object):
+    """
+    Nonces in a ring of LMDB databases, '<name>_0' ... '<name>_<buckets - 1>', with the window each holds in
+    '<name>_periods'. Takes buckets + 1 of the environment's max_dbs.
+
+    Lookups & inserts are single key reads & writes; a bucket coming round is emptied with one drop. Joins the unit
+    of work bound to the current thread, if any, else commits through writer (a GroupCommitWriter) when given.
+    """
+    def __init__(self, environment, name='nonces', window=_WINDOW, buckets=_BUCKETS, max_nonces=_MAX_NONCES,
+                 writer=None):
+        self.env = environment
+        self.window = window
+        self.max_nonces = max_nonces
+        self.writer = writer
+        self._buckets = [LMDB_Dict(environment, '{0}_{1}'.format(name, slot)) for slot in range(buckets)]
+        self._periods = LMDB_Dict(environment, '{0}_periods'.format(name))
+
+    def first_seen(self, nonce, now):
+        """
+        Returns when nonce was first seen, recording it as seen now if it is new. NonceStoreFull if the store is.
+        """
+        if self.writer is not None and not _in_transaction(self.env):
+            return self.writer.call(self._first_seen, nonce, now)
+        with transaction(self.env, write=True):
+            return self._first_seen(nonce, now)
+
+    def _first_seen(self, nonce, now):
+        period = int(now // self.window)
+        periods = [self._periods.get(str(slot)) for slot in range(len(self._buckets))]
+        live = [bucket for bucket, bucket_period in zip(self._buckets, periods)
+                if bucket_period is not None and int(bucket_period) > period - len(self._buckets)]
+        for bucket in live:
+            timestamp = bucket.get(nonce)
+            if timestamp is not None:
+                return int(timestamp)
+        slot = period % len(self._buckets)
+        if periods[slot] != str(period):    # The ring came round, forget the oldest window
+            self._buckets[slot].clear()
+            self._periods[str(slot)] = str(period)
+        if sum(len(bucket) for bucket in live) >= self.max_nonces:
+            raise NonceStoreFull(self.max_nonces)
+        self._buckets[slot][nonce] = str(now)
+        return now
@@ -5,29 +5,124 @@ Subclassing to replace failing OAuth functionality.
 
 from __future__ import absolute_import
 
+import time
+import threading
+
+from contextlib import contextmanager
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
 from lxml import etree
 
 from ims_lti_py import OutcomeRequest, OutcomeResponse
 from orthobox.body_hash_oauth1 import BodyHashOAuth1Session
 
+_TIMEOUT = 30   # Seconds to wait on the outcome service
+
+_POOL_MAX_IDLE = 32     # Idle sessions kept across all outcome services
+_POOL_IDLE_TIMEOUT = 60     # Seconds an idle session (and its connection) is kept
+
+
+class SessionPool(object):
+    """
+    Keep-alive BodyHashOAuth1Sessions, reused across outcome requests to the same outcome service host with the same
+    consumer key, so posts share TCP & TLS connections instead of opening new ones.
+
+    Each session is used by one thread at a time. At most max_idle idle sessions are kept, least recently used closed
+    first, and any idle for idle_timeout seconds are closed. Requests are still signed one by one, as they are sent.
+    """
+    def __init__(self, max_idle=_POOL_MAX_IDLE, idle_timeout=_POOL_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = list()     # [(last used, (scheme, host, consumer key), secret, session), ...], oldest first
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self, url, consumer_key, consumer_secret):
+        """
+        Check out a session for posting to url, returned to the pool afterwards unless the block raised.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc, consumer_key)
+        session = self._checkout(key, consumer_secret)
+        try:
+            yield session
+        except Exception:
+            session.close()     # Connection in an unknown state
+            raise
+        self._checkin(key, consumer_secret, session)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, list()
+        for _, _, _, session in idle:
+            session.close()
+
+    def _checkout(self, key, consumer_secret):
+        session = None
+        with self._lock:
+            expired = self._expire()
+            for i in range(len(self._idle) - 1, -1, -1):   # Most recently used first, its connection is warmest
+                _, idle_key, secret, idle_session = self._idle[i]
+                if idle_key == key and secret == consumer_secret:
+                    session = idle_session
+                    del self._idle[i]
+                    break
+        for _, _, _, idle_session in expired:
+            idle_session.close()
+        return session or BodyHashOAuth1Session(key[2], consumer_secret)
+
+    def _checkin(self, key, consumer_secret, session):
+        with self._lock:
+            self._idle.append((time.time(), key, consumer_secret, session))
+            expired = self._expire()
+            if len(self._idle) > self.max_idle:
+                expired.extend(self._idle[:len(self._idle) - self.max_idle])
+                del self._idle[:len(self._idle) - self.max_idle]
+        for _, _, _, idle_session in expired:
+            idle_session.close()
+
+    def _expire(self):
+        """
+        Remove & return idle sessions past idle_timeout. Call holding the lock, close them after releasing it.
+        """
+        cutoff = time.time() - self.idle_timeout
+        count = 0
+        while count < len(self._idle) and self._idle[count][0] < cutoff:
+            count += 1
+        expired = self._idle[:count]
+        del self._idle[:count]
+        return expired
+
+
+SESSION_POOL = SessionPool()
+
 
 class OutcomeRequestOAuthlib(OutcomeRequest):
 
+    session_pool = SESSION_POOL     # None for a new session (and connection) per request
+
     def post_outcome_request(self):
         """
         POST an OAuth signed request to the Tool Consumer.
         """
-        session = BodyHashOAuth1Session(self.consumer_key, self.consumer_secret)
-
         body = self.generate_request_xml()
         headers = {'Content-Type': 'application/xml'}
 
-        response = session.post(self.lis_outcome_service_url, data=body, headers=headers)
+        if self.session_pool is None:
+            session = BodyHashOAuth1Session(self.consumer_key, self.consumer_secret)
+            response = session.post(self.lis_outcome_service_url, data=body, headers=headers, timeout=_TIMEOUT)
+        else:
+            with self.session_pool.session(self.lis_outcome_service_url, self.consumer_key,
+                                           self.consumer_secret) as session:
+                response = session.post(self.lis_outcome_service_url, data=body, headers=headers, timeout=_TIMEOUT)
 
         outcome_response = OutcomeResponse()
         outcome_response.post_response = response
         outcome_response.response_code = response.status_code
-        outcome_response.process_xml(response.text)
+        outcome_response.process_xml(response.content)    # Bytes, lxml refuses text with an encoding declaration
 
         self.outcome_response = outcome_response
         return outcome_response
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Conditional GET & rendered page cache for templates showing stored records.
+
+A page's strong ETag is a hash of its template and a stamp, the revisions of the records it shows along with any
+other values rendered. Requests already holding the current ETag get 304 Not Modified without reading the records or
+rendering; otherwise bodies are rendered once per (template, ETag) and served from an LRU cache after that.
+
+Only GET & HEAD are answered 304, so this is for pages browsers refresh, not ones reached by a signed LTI POST.
+tag_response gives a renderer view's response, eg. JSON the instructor progress page fetches, the same ETags.
+
+Configuration, by environment variable:
+PAGE_CACHE_SIZE: Rendered pages kept per process. Default 128.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+from os import environ
+from hashlib import sha1
+
+from repoze.lru import LRUCache
+from pyramid.renderers import render_to_response
+from pyramid.response import Response
+from pyramid.httpexceptions import HTTPNotModified
+
+_PAGE_CACHE_SIZE = int(environ.get('PAGE_CACHE_SIZE', 128))
+_PAGES = LRUCache(_PAGE_CACHE_SIZE)
+
+
+def _etag(template, stamp):
+    h = sha1(template.encode('utf-8'))
+    for part in stamp:
+        h.update('\n{0}'.format(part).encode('utf-8'))
+    return h.hexdigest()
+
+
+def tag_response(response, name, stamp):
+    """
+    Tag response, eg. request.response of a renderer view, with the ETag for name & stamp as render_page does. WebOb
+    answers a GET or HEAD already holding it with 304 once the body is rendered.
+    """
+    response.etag = _etag(name, stamp)
+    response.cache_control = 'private, no-cache'
+    response.conditional_response = True
+
+
+def render_page(template, stamp, params, request):
+    """
+    render_to_response(template, params(), request), tagged with an ETag for stamp, a sequence of values that changes
+    whenever the page would. params is only called if the page isn't cached.
+    """
+    etag = _etag(template, stamp)
+    if request.method in ('GET', 'HEAD') and etag in request.if_none_match:
+        response = HTTPNotModified()
+    else:
+        page = _PAGES.get((template, etag))
+        if page is None:
+            rendered = render_to_response(template, params(), request)
+            page = rendered.body, rendered.content_type, rendered.charset
+            _PAGES.put((template, etag), page)
+        body, content_type, charset = page
+        response = Response(body=body, content_type=content_type, charset=charset)
+    response.etag = etag
+    response.cache_control = 'private, no-cache'    # Revalidate every time, the page changes on upload
+    return response
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Codecs for records stored through LMDB_Dict.load/dump.
+
+JSONCodec: utf-8 encoded JSON text, the original storage format.
+
+BinaryCodec: compact tagged binary, version byte first. JSON text never starts with a byte below 0x09, so records
+written before the switch are still read as JSON. Lists of flat, all-numeric dicts sharing the same keys (the
+'raw_errors', 'errors', 'drops' and 'pokes' event arrays) are stored column-wise as packed int64/float64 arrays,
+optionally zlib compressed.
+
+Binary format, version 1:
+
+    record = b'\\x01' value
+    value  = b'N' | b'T' | b'F'                             None, True, False
+           | b'i' int64 | b'I' text | b'd' float64           int (I: out of int64 range, as decimal text), float
+           | b's' text | b'l' count value*                   text, list
+           | b'm' count (text value)*                        dict
+           | b'r' columns | b'R' length zlib(columns)        list of numeric records, raw or compressed
+    columns = count nfields (text (b'q' | b'd'))* packed    packed: count int64 or float64 per field, field after field
+    text   = length utf-8 bytes
+    count, length, nfields = varint
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import json
+import zlib
+import struct
+
+from numbers import Integral, Real
+
+try:
+    text_type = unicode
+    _INT_TYPES = frozenset((int, long))
+except NameError:   # Python 3
+    text_type = str
+    _INT_TYPES = frozenset((int,))
+_FLOAT_TYPES = frozenset((float,))
+
+_VERSION_1 = b'\x01'
+
+_INT64 = struct.Struct(str('<q'))
+_FLOAT64 = struct.Struct(str('<d'))
+_INT64_RANGE = (-2 ** 63, 2 ** 63)
+
+
+class JSONCodec(object):
+    """
+    utf-8 encoded JSON.
+    """
+    def dumps(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def loads(self, value):
+        return json.loads(_as_bytes(value))
+
+    def to_json(self, value):
+        """
+        JSON text for a stored value, for passing records through to a response without decoding them.
+        """
+        return _as_bytes(value)
+
+
+class BinaryCodec(JSONCodec):
+    """
+    Compact binary records. Numeric record arrays of at least compress_min entries are zlib compressed at
+    compress_level; compress_level=None disables compression.
+    """
+    def __init__(self, compress_level=None, compress_min=32):
+        self.compress_level = compress_level
+        self.compress_min = compress_min
+
+    def dumps(self, obj):
+        out = [_VERSION_1]
+        try:
+            self._pack(obj, out)
+        except _Unsupported:    # Something JSON can hold but this format can't, eg. non-text keys
+            return super(BinaryCodec, self).dumps(obj)
+        return b''.join(out)
+
+    def loads(self, value):
+        value = _as_bytes(value)
+        if value[:1] != _VERSION_1:
+            return json.loads(value)
+        obj, position = _unpack(value, 1)
+        return obj
+
+    def to_json(self, value):
+        value = _as_bytes(value)
+        if value[:1] != _VERSION_1:
+            return value
+        return json.dumps(self.loads(value)).encode('utf-8')
+
+    def _pack(self, obj, out):
+        if obj is None:
+            out.append(b'N')
+        elif obj is True:
+            out.append(b'T')
+        elif obj is False:
+            out.append(b'F')
+        elif isinstance(obj, Integral):
+            if _INT64_RANGE[0] <= obj < _INT64_RANGE[1]:
+                out.extend((b'i', _INT64.pack(obj)))
+            else:
+                out.append(b'I')
+                _pack_text('{0:d}'.format(obj), out)
+        elif isinstance(obj, Real):
+            out.extend((b'd', _FLOAT64.pack(obj)))
+        elif isinstance(obj, (text_type, bytes)):
+            out.append(b's')
+            _pack_text(obj, out)
+        elif isinstance(obj, dict):
+            out.extend((b'm', _varint(len(obj))))
+            for key, value in obj.items():
+                if not isinstance(key, (text_type, bytes)):
+                    raise _Unsupported(key)
+                _pack_text(key, out)
+                self._pack(value, out)
+        elif isinstance(obj, (list, tuple)):
+            columns = _record_columns(obj)
+            if columns is None:
+                out.extend((b'l', _varint(len(obj))))
+                for item in obj:
+                    self._pack(item, out)
+            else:
+                columns = _pack_columns(obj, columns)
+                if self.compress_level is not None and len(obj) >= self.compress_min:
+                    columns = zlib.compress(columns, self.compress_level)
+                    out.extend((b'R', _varint(len(columns)), columns))
+                else:
+                    out.extend((b'r', columns))
+        else:
+            raise _Unsupported(obj)
+
+
+class _Unsupported(TypeError):
+    pass
+
+
+def _as_bytes(value):
+    """
+    bytes from a stored value, copying buffers out of the memory map: json, and slicing text out of binary records,
+    need bytes, so reads are not zero-copy.
+    """
+    if isinstance(value, bytes):
+        return value
+    return memoryview(value).tobytes()
+
+
+def _varint(number):
+    out = bytearray()
+    while True:
+        byte = number & 0x7f
+        number >>= 7
+        if number:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _read_varint(data, position):
+    number = shift = 0
+    while True:
+        byte = bytearray(data[position:position + 1])[0]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return number, position
+        shift += 7
+
+
+def _pack_text(text, out):
+    if isinstance(text, text_type):
+        text = text.encode('utf-8')
+    out.extend((_varint(len(text)), text))
+
+
+def _read_text(data, position):
+    length, position = _read_varint(data, position)
+    end = position + length
+    return data[position:end].decode('utf-8'), end
+
+
+def _record_columns(items):
+    """
+    [(field, b'q' or b'd', column), ...] if items is a non-empty list of dicts with identical keys, each field holding
+    only int64 or only float values. None otherwise.
+    """
+    if not items or not isinstance(items[0], dict):
+        return None
+    fields = sorted(items[0])
+    if any(not isinstance(item, dict) or len(item) != len(fields) for item in items):
+        return None
+    try:
+        columns = [[item[field] for item in items] for field in fields]
+    except KeyError:    # Differing keys
+        return None
+    packed = list()
+    for field, column in zip(fields, columns):
+        types = set(map(type, column))
+        if types <= _INT_TYPES and _INT64_RANGE[0] <= min(column) and max(column) < _INT64_RANGE[1]:
+            packed.append((field, b'q', column))
+        elif types == _FLOAT_TYPES:
+            packed.append((field, b'd', column))
+        else:
+            return None
+    return packed
+
+
+def _pack_columns(items, columns):
+    out = [_varint(len(items)), _varint(len(columns))]
+    for field, kind, _ in columns:
+        _pack_text(field, out)
+        out.append(kind)
+    for field, kind, column in columns:
+        out.append(struct.pack(str('<{0}{1}'.format(len(column), kind.decode('ascii'))), *column))
+    return b''.join(out)
+
+
+def _unpack_columns(data, position):
+    count, position = _read_varint(data, position)
+    nfields, position = _read_varint(data, position)
+    fields = list()
+    for _ in range(nfields):
+        field, position = _read_text(data, position)
+        fields.append((field, data[position:position + 1]))
+        position += 1
+    columns = list()
+    for field, kind in fields:
+        fmt = str('<{0}{1}'.format(count, kind.decode('ascii')))
+        columns.append(struct.unpack_from(fmt, data, position))
+        position += 8 * count
+    names = [field for field, _ in fields]
+    if not names:
+        return [dict() for _ in range(count)], position
+    return [dict(zip(names, row)) for row in zip(*columns)], position
+
+
+def _unpack(data, position):
+    tag = data[position:position + 1]
+    position += 1
+    if tag == b'N':
+        return None, position
+    if tag == b'T':
+        return True, position
+    if tag == b'F':
+        return False, position
+    if tag == b'i':
+        return _INT64.unpack_from(data, position)[0], position + 8
+    if tag == b'I':
+        text, position = _read_text(data, position)
+        return int(text), position
+    if tag == b'd':
+        return _FLOAT64.unpack_from(data, position)[0], position + 8
+    if tag == b's':
+        return _read_text(data, position)
+    if tag == b'l':
+        count, position = _read_varint(data, position)
+        items = list()
+        for _ in range(count):
+            item, position = _unpack(data, position)
+            items.append(item)
+        return items, position
+    if tag == b'm':
+        count, position = _read_varint(data, position)
+        obj = dict()
+        for _ in range(count):
+            key, position = _read_text(data, position)
+            obj[key], position = _unpack(data, position)
+        return obj, position
+    if tag == b'r':
+        return _unpack_columns(data, position)
+    if tag == b'R':
+        length, position = _read_varint(data, position)
+        items, _ = _unpack_columns(zlib.decompress(data[position:position + length]), 0)
+        return items, position + length
+    raise ValueError("Unknown record tag", tag, position - 1)
+
+
+CODECS = {'json': JSONCodec(),
+          'binary': BinaryCodec(),
+          'binary-zlib': BinaryCodec(compress_level=6)}
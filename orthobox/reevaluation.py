@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk re-evaluation: evaluate every stored upload again under new criteria, and correct results & grades to match.
+
+Sessions are decoded & judged in parallel by a pool of processes. LMDB environments must not be used or reopened
+across fork, so the workers never touch the store: the parent scans _DATA_DB in key order, _READ_CHUNK records per
+read transaction, copying out the stored bytes undecoded, and each chunk goes to a worker to decode & judge. Each
+session is judged under its context's criteria as stored (see evaluation.get_criteria) when the run started, with any
+overrides given on top. Grades depend on the order of sessions, so the parent replays each user's grade over their
+sessions at each activity in launch order, exactly as evaluate would have given them, then compares with what's
+stored. A session that fails to decode or evaluate is reported, and the grades of its user at its activity are left
+as they are rather than replayed past it.
+
+Changes are written in batches, one write transaction each. A session whose metadata changed since it was read, or
+a user whose grade changed, eg. by an upload meanwhile, is left alone and counted as a conflict; run again to pick
+them up. Corrected grades are not posted to the LMS, see orthobox.grade_resync.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import time
+import multiprocessing
+
+from itertools import islice
+
+from orthobox.data_store import (iter_sessions, iter_user_sessions, get_metadata_many, get_grades,
+                                 store_reevaluated_result, store_reevaluated_grade, iter_criteria, atomically,
+                                 _DATA_CODEC)
+from orthobox.evaluation import _merge_criteria, _compile, _next_grade
+
+_WORKERS = multiprocessing.cpu_count()
+_BATCH = 500    # Changes per write transaction
+_READ_CHUNK = 256   # Sessions read per transaction & handed to a worker at a time
+
+_worker = None  # Each worker's (stored criteria, overrides, codec, {(context_id, box_type): evaluator})
+
+
+def reevaluate(criteria=None, workers=_WORKERS, dry_run=False, batch=_BATCH):
+    """
+    Re-evaluate every uploaded session under its context's criteria, with criteria, {box_type: {criterion: value}},
+    overriding those of every context, and store changed results & grades unless dry_run.
+
+    Returns {'sessions': [{'session_id', 'context', 'uid', 'box_type', 'trial', 'revision', 'result': [old, new],
+                           'grade': [old, new], 'stored'}, ...],
+             'users': [{'context', 'uid', 'box_type', 'grade': [old, new], 'stored'}, ...],
+             'failed': [{'session_id', 'context', 'uid', 'box_type', 'error'}, ...],
+             'evaluated', 'conflicts', 'seconds'}
+    listing only what changed. 'stored' is False in a dry run or for conflicts. Grades of the users & activities of
+    failed sessions are not changed.
+    """
+    start = time.time()
+    stored = dict(((context_id, box_type), values) for context_id, box_type, values in iter_criteria())
+    results, failed = _judge_all(stored, criteria or {}, workers)
+    session_grades, user_grades = _replay(results, failed)
+    sessions, users = _diff(results, session_grades, user_grades)
+
+    report = {'sessions': sessions, 'users': users, 'evaluated': len(results),
+              'failed': [failed[session_id] for session_id in sorted(failed)], 'conflicts': 0}
+    if not dry_run:
+        for changes, store in ((sessions, _store_sessions), (users, _store_users)):
+            for i in range(0, len(changes), batch):
+                for change, stored in zip(changes[i:i + batch], atomically(store, changes[i:i + batch])):
+                    change['stored'] = stored
+        report['conflicts'] = sum(1 for change in sessions + users if not change['stored'])
+    report['seconds'] = time.time() - start
+    return report
+
+
+def _judge_all(stored, overrides, workers):
+    """
+    Returns ({session_id: (box_type, result)} for every uploaded session, {session_id: failure} for those that failed
+    to decode or evaluate, as listed in the report).
+    """
+    pool = multiprocessing.Pool(max(workers, 1), initializer=_init_worker, initargs=(stored, overrides, _DATA_CODEC))
+    try:
+        results, failed = dict(), dict()
+        for judged, chunk_failed in pool.imap_unordered(_judge_chunk, _read_uploads()):
+            results.update((session_id, (box_type, result)) for session_id, box_type, result in judged)
+            failed.update((session_id, {'session_id': session_id, 'context': context_id, 'uid': None,
+                                        'box_type': box_type, 'error': error})
+                          for session_id, context_id, box_type, error in chunk_failed)
+    finally:
+        pool.terminate()
+    return results, failed
+
+
+def _read_uploads():
+    """
+    Yields lists of (session_id, context_id, stored _DATA_DB bytes) for every session, _READ_CHUNK at a time. Runs in
+    the parent, the pool's task thread pulls chunks as workers take them.
+    """
+    sessions = ((session_id, session) for _, session_id, session in iter_sessions(raw=True))
+    while True:
+        chunk = list(islice(sessions, _READ_CHUNK))
+        if not chunk:
+            return
+        metadata = get_metadata_many([session_id for session_id, _ in chunk])
+        yield [(session_id, (record or {}).get('context'), session)
+               for (session_id, session), record in zip(chunk, metadata)]
+
+
+def _init_worker(stored, overrides, codec):
+    global _worker
+    _worker = (stored, overrides, codec, dict())
+
+
+def _judge_chunk(sessions):
+    """
+    In a worker: decode sessions & judge those uploaded. Returns ([(session_id, box_type, result), ...],
+    [(session_id, context_id, box_type, error), ...] for those that failed).
+    """
+    stored, overrides, codec, evaluators = _worker
+    judged, failed = list(), list()
+    for session_id, context_id, session in sessions:
+        box_type = None
+        try:
+            data = codec.loads(session).get('data')
+            if not data:    # Launched, never uploaded
+                continue
+            box_type = data.get('version_string')
+            if (context_id, box_type) not in evaluators:
+                evaluators[context_id, box_type] = _compile(box_type, _merge_criteria(
+                    box_type, stored.get((context_id, box_type)) or stored.get((None, box_type)),
+                    overrides.get(box_type)))
+            judged.append((session_id, box_type, evaluators[context_id, box_type](data)))
+        except Exception as e:  # Whatever is wrong with one record, report it & carry on
+            failed.append((session_id, context_id, box_type, repr(e)))
+    return judged, failed
+
+
+def _replay(results, failed):
+    """
+    Replays _next_grade over each user's sessions per activity in launch order, except for users & activities with a
+    failed session, whose grades would be replayed with a hole. Returns ({session_id: grade after it},
+    {(context_id, uid, box_type): final grade}). Fills in the uid of failed sessions.
+    """
+    session_grades, user_grades, session_keys, held = dict(), dict(), dict(), set()
+    for context_id, uid, launch_box_type, session_id in iter_user_sessions():
+        if session_id in failed:
+            failed[session_id]['uid'] = uid
+            held.update(((context_id, uid, launch_box_type), (context_id, uid, failed[session_id]['box_type'])))
+            continue
+        if session_id not in results:
+            continue
+        box_type, result = results[session_id]     # Grades follow the uploaded box type, as in evaluate
+        key = session_keys[session_id] = (context_id, uid, box_type)
+        user_grades[key] = session_grades[session_id] = _next_grade(user_grades.get(key, 0), result)
+    for session_id, key in session_keys.items():
+        if key in held:
+            del session_grades[session_id]
+            user_grades.pop(key, None)
+    return session_grades, user_grades
+
+
+def _diff(results, session_grades, user_grades):
+    """
+    Changed sessions & user grades. Sessions without a replayed grade keep the grade stored.
+    """
+    sessions = list()
+    session_ids = sorted(results)
+    for i in range(0, len(session_ids), _READ_CHUNK):
+        chunk = session_ids[i:i + _READ_CHUNK]
+        for session_id, metadata in zip(chunk, get_metadata_many(chunk)):
+            if not metadata or not metadata.get('evaluated'):
+                continue
+            result, grade = results[session_id][1], session_grades.get(session_id, metadata['grade'])
+            if result != metadata['result'] or grade != metadata['grade']:
+                sessions.append({'session_id': session_id, 'context': metadata['context'], 'uid': metadata['uid'],
+                                 'box_type': results[session_id][0], 'trial': metadata.get('trial'),
+                                 'result': [metadata['result'], result], 'grade': [metadata['grade'], grade],
+                                 'revision': metadata['revision'], 'stored': False})
+
+    users = list()
+    keys = sorted(user_grades)
+    for i in range(0, len(keys), _READ_CHUNK):
+        chunk = keys[i:i + _READ_CHUNK]
+        for (context_id, uid, box_type), previous in zip(chunk, get_grades(chunk)):
+            grade = user_grades[(context_id, uid, box_type)]
+            if previous is not None and grade != previous:
+                users.append({'context': context_id, 'uid': uid, 'box_type': box_type, 'grade': [previous, grade],
+                              'stored': False})
+    return sessions, users
+
+
+def _store_sessions(sessions):
+    return [store_reevaluated_result(session['session_id'], session['result'][1], session['grade'][1],
+                                     session['revision']) for session in sessions]
+
+
+def _store_users(users):
+    return [store_reevaluated_grade(user['uid'], user['context'], user['box_type'], user['grade'][1], user['grade'][0])
+            for user in users]
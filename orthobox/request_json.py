@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+JSON request bodies, optionally gzip or deflate compressed, parsed as they're read.
+
+The body is inflated a chunk at a time up to a maximum inflated size, guarding against zip bombs, and the JSON is
+decoded incrementally: the top level object or array and the containers directly in it are taken apart member by
+member, each member decoded with json's raw_decode once it's complete, so only the unparsed tail of the text is held
+alongside the parsed objects. Result uploads are an object of mostly arrays of small objects, so that tail stays a
+chunk or two.
+
+Configuration, by environment variable:
+UPLOAD_MAX_SIZE: Largest body accepted, in bytes after inflating. Default 32 MiB.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import re
+import json
+import zlib
+import codecs
+
+from os import environ
+from json.decoder import WHITESPACE
+
+_MAX_SIZE = int(environ.get('UPLOAD_MAX_SIZE', 32 * 1024 * 1024))
+_CHUNK_SIZE = 64 * 1024
+_STREAM_DEPTH = 2   # Levels of containers taken apart member by member, below that values are decoded whole
+
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')   # Text at the end of the buffer that might continue a number
+
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'x-gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+def load_request(request, max_size=_MAX_SIZE):
+    """
+    Parsed JSON body of a webob request, honouring Content-Encoding. Raises BodyTooLarge past max_size bytes,
+    UnsupportedEncoding for an encoding other than gzip or deflate, and ValueError (or zlib.error) if malformed.
+    """
+    if request.content_length is not None and request.content_length > max_size:
+        raise BodyTooLarge(request.content_length)
+    return load(request.body_file, request.headers.get('Content-Encoding'), max_size)
+
+
+def load(stream, encoding=None, max_size=_MAX_SIZE, chunk_size=_CHUNK_SIZE):
+    """
+    Parse JSON from the file-like stream, compressed with the Content-Encoding encoding if any.
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        chunks = _read(stream, max_size, chunk_size)
+    elif encoding in _WBITS:
+        chunks = _inflate(stream, zlib.decompressobj(_WBITS[encoding]), max_size, chunk_size)
+    else:
+        raise UnsupportedEncoding(encoding)
+    return _StreamDecoder(_decode_utf8(chunks)).parse()
+
+
+def _read(stream, max_size, chunk_size):
+    size = 0
+    for data in iter(lambda: stream.read(chunk_size), b''):
+        size += len(data)
+        if size > max_size:
+            raise BodyTooLarge(size)
+        yield data
+
+
+def _inflate(stream, decompressor, max_size, chunk_size):
+    size = 0
+    for compressed in iter(lambda: stream.read(chunk_size), b''):
+        while compressed:   # Inflate at most chunk_size at a time, so a bomb is caught before it's in memory
+            data = decompressor.decompress(compressed, chunk_size)
+            compressed = decompressor.unconsumed_tail
+            size += len(data)
+            if size > max_size:
+                raise BodyTooLarge(size)
+            if data:
+                yield data
+    data = decompressor.flush()
+    if len(data) + size > max_size:
+        raise BodyTooLarge(len(data) + size)
+    if data:
+        yield data
+
+
+def _decode_utf8(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for data in chunks:
+        text = decoder.decode(data)
+        if text:
+            yield text
+    decoder.decode(b'', final=True)     # Raises on a truncated character
+
+
+class _StreamDecoder(object):
+    """
+    Decodes JSON from an iterable of text chunks, keeping only the unparsed part of the text.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+        self._done = False
+        self._decoder = json.JSONDecoder()
+
+    def parse(self):
+        value = self._value(0)
+        if self._peek() is not None:
+            raise ValueError("Extra data after the JSON value")
+        return value
+
+    def _fill(self, grow=False):
+        """
+        Read another chunk, dropping the parsed text, or with grow enough chunks to double the unparsed text. False at
+        the end of input.
+        """
+        self._buffer, self._pos = self._buffer[self._pos:], 0
+        wanted = 2 * len(self._buffer) if grow else 1
+        read = False
+        while not self._done:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._done = True
+                break
+            self._buffer += chunk
+            read = True
+            if len(self._buffer) >= wanted:
+                break
+        return read
+
+    def _peek(self):
+        """
+        Next non-whitespace character, positioned on it, or None at the end of input.
+        """
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError("Expecting one of {0!r}, got {1!r}".format(chars, char))
+        self._pos += 1
+        return char
+
+    def _value(self, depth):
+        char = self._peek()
+        if depth < _STREAM_DEPTH:
+            if char == '{':
+                return self._object(depth + 1)
+            if char == '[':
+                return self._array(depth + 1)
+        return self._whole()
+
+    def _object(self, depth):
+        self._pos += 1
+        obj = dict()
+        if self._peek() == '}':
+            self._pos += 1
+            return obj
+        while True:
+            if self._peek() != '"':
+                raise ValueError("Expecting property name")
+            key = self._whole()
+            self._expect(':')
+            obj[key] = self._value(depth)
+            if self._expect(',}') == '}':
+                return obj
+
+    def _array(self, depth):
+        self._pos += 1
+        array = list()
+        if self._peek() == ']':
+            self._pos += 1
+            return array
+        while True:
+            array.append(self._value(depth))
+            if self._expect(',]') == ']':
+                return array
+
+    def _whole(self):
+        """
+        Decode the complete value at the current position, reading more until it is complete.
+        """
+        if self._peek() is None:
+            raise ValueError("Expecting value, got end of input")
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._fill(grow=True):
+                    raise
+                continue
+            # A number at the end of the text might continue in the next chunk, eg. '12' of '12.5'
+            if not _NUMBER_TAIL.match(self._buffer, end) or not self._fill(grow=True):
+                self._pos = end
+                return value
@@ -5,32 +5,64 @@ Cornice services.
 
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+import hmac
 import json
+import zlib
+import time
+import base64
+import binascii
+import tempfile
+
+from hashlib import sha1
+from itertools import islice
 from cornice import Service
 from pyramid.renderers import render_to_response
-from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
-from pyramid.response import FileResponse
+from pyramid.httpexceptions import (HTTPBadRequest, HTTPNotFound, HTTPForbidden, HTTPRequestEntityTooLarge,
+                                    HTTPUnsupportedMediaType, HTTPNotImplemented)
+from pyramid.response import FileResponse, FileIter, Response
 
 from orthobox.data_store import (get_upload_token, store_activity_data, delete_session_credentials, get_session_params,
                                  get_oauth_creds, get_result_data, get_metadata, new_oauth_creds, store_result,
-                                 dump_session_data, get_box_name, dump_raw_errors)
-from orthobox.evaluation import evaluate, _select_criteria, get_progress_count, _normalize_errors
-from orthobox.tool_provider import WebObToolProvider
+                                 iter_session_json, get_box_name, iter_raw_errors, atomically, store_progress,
+                                 enqueue_grade, get_graph_secret, get_users_by_context_id, get_ids_from_moodle_uids,
+                                 get_progress_summaries, get_progress_summary, unit_of_work, store_criteria,
+                                 store_cohort_stats, get_cohort_stats)
+from orthobox.cohort_stats import summarize
+from orthobox.evaluation import evaluate, get_criteria, _select_box_type, get_progress_count, _normalize_errors
+from orthobox.grade_outbox import OUTBOX, tool_provider_for
+from orthobox.page_cache import render_page, tag_response
+from orthobox.result_notify import ResultNotifier
+from orthobox.request_json import load_request, BodyTooLarge, UnsupportedEncoding
 
 
 _BASE_URL = "http://xlms.org"
+_PORT = ':8128'  # FIXME: Irrelevant under apache
 _CSS_PATH = "/pfi.css"
 _RESULTS_PATH = '/{session_id}/results'
 _WAITING_PATH = '/{session_id}/view_results'
+_WAIT_PATH = '/{session_id}/wait'     # On NOTIFIER's port
 _JNLP_PATH = '/{session_id}/launch.jnlp'
 _JAR_PATH = '/orthobox-signed-20140504.jar'
 _CONFIGURE_PATH = '/configure/{version_string}'
 
+_PAGE_LIMIT_DEFAULT = 100
+_PAGE_LIMIT_MAX = 1000
+_JSON = str('application/json')
+_NDJSON = str('application/x-ndjson')
+_NPZ = str('application/octet-stream')
+
+_GRAPH_TOKEN_TTL = 2 * 60 * 60
+_GRAPH_PAGE_DEFAULT = 20
+_GRAPH_PAGE_MAX = 100
+_GRAPH_SORTS = {'name': lambda user: ((user['username'] or '').lower(), user['uid']),
+                'attempts': lambda user: (user['attempts'], user['uid']),
+                'completion': lambda user: (user['grade'], user['uid'])}
+
 results = Service(name='results', path=_RESULTS_PATH)
 view_results = Service(name='view_results', path=_WAITING_PATH)
 jnlp = Service(name='jnlp', path=_JNLP_PATH, description='Generated jnlp file for session')
 configure = Service(name='configure', path=_CONFIGURE_PATH,
-                    description="SimPortal demo evaluation parameters")
+                    description="Evaluation parameters, of the course context given by ?context= or the default")
 jar = Service(name='jar', path=_JAR_PATH)  # FIXME: Irrelevant under apache
 
 # TODO: Some sort of security to limit credential generation
@@ -40,33 +72,182 @@ session_data = Service(name='session_data', path='/session_data')
 
 raw_errors = Service(name='raw_errors', path='/raw_errors')
 
+outbox = Service(name='outbox', path='/outbox')
+
+progress_graphs = Service(name='progress_graphs', path='/progress_graphs',
+                          description="Page of students for the instructor progress page")
+progress_graph = Service(name='progress_graph', path='/progress_graphs/{uid}',
+                         description="One student's progress graph data")
+cohort_stats = Service(name='cohort_stats', path='/cohort_stats',
+                       description="Class statistics for the instructor progress page")
+
+# Pushes results to the waiting page, see orthobox.result_notify
+NOTIFIER = ResultNotifier(lambda session_id: _url_params(session_id)['results_url'], _BASE_URL + _PORT)
+
 
 def _parse_json(request):
+    """
+    Request body as JSON, gzip or deflate compressed if Content-Encoding says so. See orthobox.request_json.
+    """
     try:
-        return json.loads(request.body)
+        return load_request(request)
+    except BodyTooLarge:
+        raise HTTPRequestEntityTooLarge('Request body too large')
+    except UnsupportedEncoding as e:
+        raise HTTPUnsupportedMediaType('Unsupported Content-Encoding: {0}'.format(e))
+    except zlib.error:
+        raise HTTPBadRequest('Malformed compressed body')
     except ValueError:
         raise HTTPBadRequest('Malformed JSON')
 
 
 def _url_params(session_id):
-    _PORT = ':8128'  # FIXME: Irrelevant under apache
-
     return {'css_url': ''.join([_BASE_URL, _CSS_PATH]),
             'jnlp_url': _PORT.join([_BASE_URL, _JNLP_PATH]).format(session_id=session_id),
             'jar_path': _JAR_PATH,
             'waiting_url': _PORT.join([_BASE_URL, _WAITING_PATH]).format(session_id=session_id),
             'results_url': _PORT.join([_BASE_URL, _RESULTS_PATH]).format(session_id=session_id),
+            'wait_url': (':{0}'.format(NOTIFIER.port).join([_BASE_URL, _WAIT_PATH]).format(session_id=session_id)
+                         if NOTIFIER.enabled else None),
             'relaunch_url': '/launch'}
 
 
 @session_data.get()
 def return_session_data(request):
-    return dump_session_data()
+    """
+    All session data as {session_id: record}, streamed, each record as a string of its JSON.
+
+    Query parameters, all optional:
+    records=object: Each record as a JSON object instead of a string.
+    context, box_type: Only sessions in this context_id and/or box type.
+    limit, cursor: One page of limit sessions, as {'sessions': {session_id: record}, 'next': cursor}. Pass 'next' back
+                   as cursor for the following page, it is null after the last.
+    format=ndjson: One {'cursor': cursor, 'session_id': session_id, 'session': record} per line instead, from cursor
+                   if given, up to limit if given.
+    format=npz: The sessions of one context (and box_type if given) as NumPy columns instead, see orthobox.columnar.
+                context is required: the archive is built before it's sent, so whole-database exports are left to
+                orthobox_export_columns.
+    """
+    if request.GET.get('format') == 'npz':
+        if not request.GET.get('context'):
+            raise HTTPBadRequest('format=npz needs a context, export everything with orthobox_export_columns')
+        return _session_columns(request.GET['context'], request.GET.get('box_type'))
+    after, limit, context_id, box_type, ndjson = _page_params(request)
+    sessions = iter_session_json(after, context_id, box_type)
+    # Stored records are already JSON, pass them through rather than decoding & re-encoding
+    if request.GET.get('records') != 'object':
+        sessions = ((key, session_id, _dumps(session.decode('utf-8'))) for key, session_id, session in sessions)
+    if ndjson:
+        lines = (b''.join([b'{"cursor": ', _dumps(_encode_cursor(key)), b', "session_id": ', _dumps(session_id),
+                           b', "session": ', session, b'}\n'])
+                 for key, session_id, session in islice(sessions, limit))
+        return Response(app_iter=lines, content_type=_NDJSON)
+    if limit is None:
+        return Response(app_iter=_json_object((session_id, session) for _, session_id, session in sessions),
+                        content_type=_JSON)
+    page, cursor = _next_page(sessions, limit)
+    body = [b'{"sessions": '] + list(_json_object((session_id, session) for _, session_id, session in page))
+    body.append(b', "next": ' + _dumps(cursor) + b'}')
+    return Response(app_iter=body, content_type=_JSON)
+
+
+def _session_columns(context_id, box_type):
+    """
+    Response of a columnar.write_npz archive, built in a temporary file.
+    """
+    try:
+        from orthobox.columnar import write_npz
+    except ImportError:
+        raise HTTPNotImplemented('format=npz needs numpy installed on the server')
+    archive = tempfile.TemporaryFile()
+    write_npz(archive, context_id, box_type)
+    length = archive.tell()
+    archive.seek(0)
+    return Response(app_iter=FileIter(archive), content_type=_NPZ, content_length=length,
+                    content_disposition=str('attachment; filename="sessions.npz"'))
 
 
 @raw_errors.get()
 def return_raw_errors(request):
-    return dump_raw_errors()
+    """
+    All drops & raw errors as [[session_id, uid, duration (-1 for drops), endtime], ...], streamed.
+
+    Query parameters as for /session_data, limit counting sessions: a page is {'rows': rows, 'next': cursor}, an
+    ndjson line is {'cursor': cursor, 'rows': rows} for one session.
+    """
+    after, limit, context_id, box_type, ndjson = _page_params(request)
+    sessions = iter_raw_errors(after, context_id, box_type)
+    if ndjson:
+        lines = (b''.join([b'{"cursor": ', _dumps(_encode_cursor(key)), b', "rows": ', _dumps(rows), b'}\n'])
+                 for key, rows in islice(sessions, limit))
+        return Response(app_iter=lines, content_type=_NDJSON)
+    if limit is None:
+        return Response(app_iter=_json_array(row for _, rows in sessions for row in rows), content_type=_JSON)
+    page, cursor = _next_page(sessions, limit)
+    body = [b'{"rows": '] + list(_json_array(row for _, rows in page for row in rows))
+    body.append(b', "next": ' + _dumps(cursor) + b'}')
+    return Response(app_iter=body, content_type=_JSON)
+
+
+def _page_params(request):
+    """
+    (after, limit, context_id, box_type, ndjson) from the query string. limit defaults to _PAGE_LIMIT_DEFAULT with a
+    cursor, else None (everything).
+    """
+    params = request.GET
+    after = None
+    if 'cursor' in params:
+        try:
+            after = base64.urlsafe_b64decode(params['cursor'].encode('ascii')).decode('utf-8')
+            assert after and _encode_cursor(after) == params['cursor']  # b64decode skips stray characters
+        except (TypeError, ValueError, AssertionError, binascii.Error):
+            raise HTTPBadRequest('Invalid cursor')
+    limit = params.get('limit', _PAGE_LIMIT_DEFAULT if after is not None else None)
+    if limit is not None:
+        try:
+            limit = int(limit)
+            assert 0 < limit <= _PAGE_LIMIT_MAX
+        except (ValueError, AssertionError):
+            raise HTTPBadRequest('limit must be between 1 and {0}'.format(_PAGE_LIMIT_MAX))
+    return after, limit, params.get('context'), params.get('box_type'), params.get('format') == 'ndjson'
+
+
+def _next_page(items, limit):
+    """
+    The first limit (key, ...) items, and the cursor continuing after them, None if there are no more.
+    """
+    page = list(islice(items, limit + 1))
+    if len(page) > limit:
+        return page[:limit], _encode_cursor(page[limit - 1][0])
+    return page, None
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def _dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _json_object(items):
+    """
+    Yields chunks of a JSON object from (key, JSON text) items.
+    """
+    yield b'{'
+    for i, (key, value) in enumerate(items):
+        yield b''.join([b', ' if i else b'', _dumps(key), b': ', value])
+    yield b'}'
+
+
+def _json_array(items):
+    """
+    Yields chunks of a JSON array of items.
+    """
+    yield b'['
+    for i, item in enumerate(items):
+        yield (b', ' if i else b'') + _dumps(item)
+    yield b']'
 
 
 @view_results.get()
@@ -75,13 +256,19 @@ def waiting_page(request):
     Display page while waiting for session to proceed.
     """
     session_id = request.matchdict['session_id']
-    return _render_waiting_page(session_id, request)
+    try:
+        metadata = get_metadata(session_id)
+    except KeyError:
+        raise HTTPNotFound('Unknown session')
+    return _render_waiting_page(session_id, metadata, request)
 
 
-def _render_waiting_page(session_id, request):
-    params = _url_params(session_id)
-    params.update(get_metadata(session_id))
-    return render_to_response("templates/view_results.pt", params, request)
+def _render_waiting_page(session_id, metadata, request):
+    def params():
+        page = _url_params(session_id)
+        page.update(metadata)
+        return page
+    return render_page("templates/view_results.pt", (session_id, metadata['revision']), params, request)
 
 
 @new_oauth.get()
@@ -102,21 +289,25 @@ def display_results(request):
     # TODO: Limit access to results
     session_id = request.matchdict['session_id']
     try:
-        data = get_result_data(session_id)
+        metadata = get_metadata(session_id)
     except KeyError:
-        try:
-            return _render_waiting_page(session_id, request)
-        except KeyError:
-            raise HTTPNotFound('Unknown session')
-    params = _url_params(session_id)
-    params.update({'duration': data['duration'],
-                   'error_number': len(data['errors']),
-                   'pokes': len(data.get('pokes', '')),
-                   'drops': len(data.get('drops', '')),
-                   'session_id': session_id})
-    params.update(get_metadata(session_id))
-    params['completion'] = "{0} of {1}".format(*get_progress_count(params['grade']))
-    return render_to_response('templates/{0}.pt'.format(params['result']), params, request)
+        raise HTTPNotFound('Unknown session')
+    if not metadata['evaluated']:
+        return _render_waiting_page(session_id, metadata, request)
+
+    def params():
+        data = get_result_data(session_id)
+        page = _url_params(session_id)
+        page.update({'duration': data['duration'],
+                     'error_number': len(data['errors']),
+                     'pokes': len(data.get('pokes', '')),
+                     'drops': len(data.get('drops', '')),
+                     'session_id': session_id})
+        page.update(metadata)
+        page['completion'] = "{0} of {1}".format(*get_progress_count(page['grade']))
+        return page
+    return render_page('templates/{0}.pt'.format(metadata['result']), (session_id, metadata['revision']),
+                       params, request)
 
 
 @results.post()
@@ -124,25 +315,44 @@ def generate_results(request):
     """
     Set the value.
     """
-    session_id = _validate_request(request)
-
     data = _parse_json(request)
     data['duration'] = int(data['duration']) // 1000
     data['version_string'] = get_box_name(data['version'])
     data['raw_errors'] = raw_errors = data.get('errors', [])
     data['errors'] = _normalize_errors(raw_errors)
 
+    session_id, result = atomically(_store_results, request, data)
+
+    OUTBOX.wake()   # Grade passback happens in the background, see orthobox.grade_outbox
+    NOTIFIER.notify(session_id)
+
+    return result, data
+
+
+def _store_results(request, data):
+    """
+    Store, evaluate & retire upload credentials as one unit of work. The grade is queued for passback if the tool was
+    launched as an outcome service; the upload is accepted either way.
+    """
+    session_id = _validate_request(request)
+
     store_activity_data(session_id, data)
 
     result, grade = evaluate(session_id, data)
 
     store_result(session_id, result, grade)
 
-    _post_grade(session_id, grade)
+    store_progress(session_id, data, result)
+
+    store_cohort_stats(session_id, data, result, grade)
+
+    params = get_session_params(session_id)
+    if tool_provider_for(params).is_outcome_service():
+        enqueue_grade(session_id, grade, params)
 
     delete_session_credentials(session_id)
 
-    return result, data
+    return session_id, result
 
 
 def _validate_request(request):
@@ -156,40 +366,120 @@ def _validate_request(request):
     return session_id
 
 
-def _post_grade(session_id, grade):
-    params = get_session_params(session_id)
-    key = params['oauth_consumer_key']
-    tool_provider = WebObToolProvider(key, get_oauth_creds(key), params)
+@outbox.get()
+def outbox_stats(request):
+    """
+    Grade passback outbox depth & delivery latency.
+    """
+    return OUTBOX.stats()
+
+
+@progress_graphs.get()
+def list_progress_graphs(request):
+    """
+    One page of the students in the token's course, without graph data:
+    {'users': [{'uid', 'username', 'attempts', 'grade', 'completion'}, ...], 'page', 'pages', 'total'}
+
+    Query parameters: token (from the instructor progress page), page (1-based), per_page, sort ('name', 'attempts'
+    or 'completion') & order ('asc' or 'desc').
+    """
+    context_id, activity = _verify_graph_token(request.GET.get('token'))
+    params = request.GET
+    try:
+        page = int(params.get('page', 1))
+        per_page = int(params.get('per_page', _GRAPH_PAGE_DEFAULT))
+        assert page > 0 and 0 < per_page <= _GRAPH_PAGE_MAX
+    except (ValueError, AssertionError):
+        raise HTTPBadRequest('page must be positive, per_page between 1 and {0}'.format(_GRAPH_PAGE_MAX))
+    sort = _GRAPH_SORTS.get(params.get('sort', 'name'))
+    if sort is None:
+        raise HTTPBadRequest('sort must be one of {0}'.format(', '.join(sorted(_GRAPH_SORTS))))
+
+    with unit_of_work():    # One read transaction for the whole course
+        users = list(get_users_by_context_id(context_id).items())
+        moodle_ids = get_ids_from_moodle_uids([user_data['moodle_uid'] for _, user_data in users])
+        summaries = get_progress_summaries([uid for uid, _ in users], context_id, activity)
+    students = list()
+    for (uid, user_data), ids, summary in zip(users, moodle_ids, summaries):
+        grade = user_data[activity]['grade']
+        students.append({'uid': uid, 'username': ids['username'], 'grade': grade,
+                         'attempts': len(summary['not_passing']) + len(summary['passing']),
+                         'completion': "{0} of {1}".format(*get_progress_count(grade))})
+    students.sort(key=sort, reverse=params.get('order') == 'desc')
+
+    start = (page - 1) * per_page
+    return {'users': students[start:start + per_page], 'page': page, 'total': len(students),
+            'pages': (len(students) + per_page - 1) // per_page}
+
+
+@progress_graph.get()
+def get_progress_graph(request):
+    """
+    Progress graph data of one student in the token's course, as get_progress_summary. Revalidated by ETag.
+    """
+    context_id, activity = _verify_graph_token(request.GET.get('token'))
+    summary = get_progress_summary(request.matchdict['uid'], context_id, activity)
+    tag_response(request.response, 'progress_graph', (request.matchdict['uid'], context_id, activity,
+                                                      summary['revision']))
+    return dict(summary, activity_string=activity)
+
+
+@cohort_stats.get()
+def get_class_stats(request):
+    """
+    Class statistics of the token's course at its activity, as cohort_stats.summarize, from one record.
+    """
+    context_id, activity = _verify_graph_token(request.GET.get('token'))
+    return dict(summarize(get_cohort_stats(context_id, activity)), activity_string=activity)
+
+
+def graph_token(context_id, activity, ttl=_GRAPH_TOKEN_TTL):
+    """
+    Token granting the bearer the progress graphs of everyone in context_id at activity, for ttl seconds.
+    """
+    payload = '{0}:{1}:{2}'.format(context_id, activity, int(time.time() + ttl))
+    return '{0}:{1}'.format(payload, _sign(payload))
 
-    if not tool_provider.is_outcome_service():
-        raise HTTPBadRequest("Tool wasn't launched as an outcome service")
 
-    outcome_request = tool_provider.new_request()
-    outcome_request.message_identifier = session_id
-    outcome_response = outcome_request.post_replace_result(round(grade, 2))    # Round to 2 digits for moodle
+def _verify_graph_token(token):
+    """
+    Returns (context_id, activity) from a valid graph_token, else HTTPForbidden.
+    """
+    try:
+        payload, signature = token.rsplit(':', 1)
+        assert hmac.compare_digest(_sign(payload).encode('ascii'), signature.encode('ascii'))
+        context_id, activity, expires = payload.split(':')
+        assert int(expires) > time.time()
+    except (AttributeError, ValueError, UnicodeError, AssertionError):
+        raise HTTPForbidden('Invalid or expired token')
+    return context_id, activity
 
-    # TODO: Verify HTTP response for success
 
-    return outcome_response
+def _sign(payload):
+    return hmac.new(get_graph_secret().encode('ascii'), payload.encode('utf-8'), sha1).hexdigest()
 
 
 @configure.get()
-def get_criteria(request):
+def return_criteria(request):
     """
     Returns the evaluation parameters.
     """
-    return _select_criteria(request)
+    return get_criteria(request.GET.get('context'), _select_box_type(request))
 
 
 @configure.post()
 def set_criteria(request):
     """
-    Set the evaluation parameters.
+    Set the evaluation parameters, stored for every process. Parameters not given keep their values.
     """
-    values = _select_criteria(request)
+    context_id, box_type = request.GET.get('context'), _select_box_type(request)
+    values = get_criteria(context_id, box_type)
     data = _parse_json(request)
     for key, value in values.iteritems():
         values[key] = data.get(key, value)
+        if not isinstance(values[key], (int, float)) or isinstance(values[key], bool):
+            raise HTTPBadRequest('{0} must be a number'.format(key))
+    store_criteria(context_id, box_type, values)
     return values
 
 
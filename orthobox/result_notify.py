@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Result notification for the waiting page: GET /{session_id}/wait blocks until the session's results are stored.
+
+Served on its own port by one asyncore thread, so waiting browsers hold a socket each rather than a waitress worker.
+With Accept: text/event-stream the answer is a Server-Sent Events stream sending 'result' with the results URL as
+data; otherwise a long poll answered with a 303 redirect to the results. Waits end after a timeout, with an empty
+event stream (EventSource reconnects) or 204 No Content, and new connections get 503 past a cap. Both count from
+when the connection is accepted, so connections that never finish their request are closed at the timeout and count
+towards the cap too. The loop uses poll(), not select(), so it isn't limited to descriptors below FD_SETSIZE.
+
+generate_results calls notify(session_id) once the upload is committed. Uploads handled by other processes are
+picked up by checking the waited-on sessions in LMDB every few seconds. If the port is taken, eg. by another worker
+process, that process's notifier serves the waiting pages.
+
+The waiting page is served from the app's own port, so responses allow cross-origin requests from origin only.
+
+Configuration, by environment variable:
+RESULT_NOTIFY_PORT: Port to listen on, 0 to disable. Default 8130.
+RESULT_WAIT_TIMEOUT: Seconds before a wait gives up. Default 55.
+RESULT_WAITERS_MAX: Concurrent connections, waiting or still sending their request. Default 1000.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import re
+import time
+import fcntl
+import socket
+import asyncore
+import asynchat
+import logging
+import threading
+
+from os import environ
+from collections import deque
+
+from orthobox.data_store import get_metadata, get_metadata_many
+
+log = logging.getLogger(__name__)
+
+_HOST = environ.get('RESULT_NOTIFY_HOST', '0.0.0.0')
+_PORT = int(environ.get('RESULT_NOTIFY_PORT', 8130))
+_TIMEOUT = float(environ.get('RESULT_WAIT_TIMEOUT', 55))
+_MAX_WAITERS = int(environ.get('RESULT_WAITERS_MAX', 1000))
+
+_POLL = 2   # Seconds between checks of waited-on sessions in LMDB, for uploads to other processes
+_TICK = 1   # Seconds the loop sleeps without events, the granularity of timeouts
+_RETRY = 3000   # Milliseconds before EventSource reconnects after a timeout
+_MAX_REQUEST = 8192
+
+_WAIT_PATH = re.compile(r'^/([0-9a-f]{32})/wait(?:\?.*)?$')
+
+_STATUS = {204: 'No Content', 303: 'See Other', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+
+
+class ResultNotifier(object):
+    """
+    Registry of connections waiting on sessions, and the thread serving them. results_url(session_id) is where waiters
+    are sent once results are stored; origin, eg. 'http://xlms.org:8128', is the one the waiting page is served from.
+    """
+    def __init__(self, results_url, origin, host=_HOST, port=_PORT, timeout=_TIMEOUT, max_waiters=_MAX_WAITERS,
+                 poll=_POLL):
+        self.results_url = results_url
+        self.origin = origin
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_waiters = max_waiters
+        self.poll = poll
+        self._map = dict()
+        self._connections = set()   # Every open _Waiter
+        self._waiters = dict()  # session_id: set of _Waiter waiting on it
+        self._count = 0
+        self._notified = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._trigger = None
+        self._next_poll = 0
+
+    @property
+    def enabled(self):
+        return bool(self.port)
+
+    def start(self):
+        """
+        Listen & start serving, once. Returns False if disabled or the port is in use.
+        """
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return self._thread is not None
+            try:
+                _Listener(self)
+            except socket.error as e:
+                log.warning("Result notification not served from this process, port %s: %r", self.port, e)
+                return False
+            self._trigger = _Trigger(self)
+            self._thread = threading.Thread(target=self._run, name='result-notify')
+            self._thread.daemon = True
+            self._thread.start()
+            return True
+
+    def notify(self, session_id):
+        """
+        Results for session_id are stored, release its waiters. Safe to call from any thread.
+        """
+        if self._trigger is None:
+            return
+        self._notified.append(session_id)
+        self._trigger.pull()
+
+    def stats(self):
+        return {'waiters': self._count, 'sessions': len(self._waiters), 'connections': len(self._connections),
+                'max_waiters': self.max_waiters}
+
+    def _run(self):
+        while True:
+            try:
+                self._step()
+            except Exception:   # Keep serving whatever went wrong
+                log.exception("Result notification loop failed")
+                time.sleep(_TICK)
+
+    def _step(self):
+        asyncore.loop(timeout=_TICK, map=self._map, use_poll=True, count=1)
+        now = time.time()
+        while self._notified:
+            self._release(self._notified.popleft())
+        for waiter in list(self._connections):
+            if waiter.deadline < now:
+                self._remove(waiter)
+                waiter.time_out()
+        if now >= self._next_poll:
+            self._next_poll = now + self.poll
+            self._poll()
+
+    def _poll(self):
+        if not self._waiters:
+            return
+        session_ids = list(self._waiters)
+        try:
+            metadata = get_metadata_many(session_ids)
+        except Exception:
+            log.exception("Checking waited-on sessions failed")
+            return
+        for session_id, record in zip(session_ids, metadata):
+            if record is not None and record['evaluated']:  # A session deleted meanwhile waits out its timeout
+                self._release(session_id)
+
+    def _accept(self, sock):
+        """
+        Called on the loop thread with each new connection.
+        """
+        waiter = _Waiter(sock, self)
+        if len(self._connections) >= 2 * self.max_waiters:  # Far past the cap, not even answered
+            return waiter.close()
+        waiter.refused = len(self._connections) >= self.max_waiters
+        waiter.deadline = time.time() + self.timeout
+        self._connections.add(waiter)
+
+    def _wait(self, waiter, session_id):
+        """
+        Called on the loop thread once waiter's request is read.
+        """
+        try:
+            evaluated = get_metadata(session_id)['evaluated']
+        except KeyError:
+            return waiter.respond(404)
+        if evaluated:
+            return waiter.release(self.results_url(session_id))
+        waiter.session_id = session_id
+        self._waiters.setdefault(session_id, set()).add(waiter)
+        self._count += 1
+        waiter.begin()
+
+    def _release(self, session_id):
+        waiters = self._waiters.pop(session_id, ())
+        self._count -= len(waiters)
+        for waiter in waiters:
+            waiter.release(self.results_url(session_id))
+
+    def _remove(self, waiter):
+        self._connections.discard(waiter)
+        waiters = self._waiters.get(waiter.session_id)
+        if waiters is not None and waiter in waiters:
+            waiters.discard(waiter)
+            self._count -= 1
+            if not waiters:
+                del self._waiters[waiter.session_id]
+
+
+class _Listener(asyncore.dispatcher):
+    def __init__(self, notifier):
+        asyncore.dispatcher.__init__(self, map=notifier._map)
+        self.notifier = notifier
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((notifier.host, notifier.port))
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.notifier._accept(pair[0])
+
+
+class _Trigger(asyncore.file_dispatcher):
+    """
+    Wakes the loop from other threads, through a pipe.
+    """
+    def __init__(self, notifier):
+        read, self._write = os.pipe()
+        fcntl.fcntl(self._write, fcntl.F_SETFL, os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read, map=notifier._map)
+        os.close(read)  # file_dispatcher keeps a duplicate
+
+    def pull(self):
+        try:
+            os.write(self._write, b'x')
+        except OSError:     # Pipe full, the loop is due to wake anyway
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(512)
+
+
+class _Waiter(asynchat.async_chat):
+    """
+    One waiting HTTP connection, closed once answered.
+    """
+    def __init__(self, sock, notifier):
+        asynchat.async_chat.__init__(self, sock, map=notifier._map)
+        self.notifier = notifier
+        self.session_id = None  # Set once waiting
+        self.deadline = None
+        self.stream = False
+        self.answered = False
+        self.refused = False    # Past the cap, answered 503 once the request is read
+        self._request = list()
+        self._size = 0
+        self.set_terminator(b'\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        if self.get_terminator() is None:   # Request already read, ignore anything after it
+            return
+        self._size += len(data)
+        if self._size > _MAX_REQUEST:
+            self.set_terminator(None)
+            self.respond(400)
+        else:
+            self._request.append(data)
+
+    def found_terminator(self):
+        self.set_terminator(None)
+        if self.refused:    # Answered once the request is read, so the client isn't reset before reading it
+            return self.respond(503, [('Retry-After', str(int(self.notifier.timeout)))])
+        lines = b''.join(self._request).decode('latin-1').split('\r\n')
+        request = lines[0].split()
+        headers = dict(line.lower().split(':', 1) for line in lines[1:] if ':' in line)
+        match = _WAIT_PATH.match(request[1]) if len(request) == 3 and request[0] == 'GET' else None
+        if match is None:
+            return self.respond(404)
+        self.stream = 'text/event-stream' in headers.get('accept', '')
+        self.notifier._wait(self, match.group(1))
+
+    def begin(self):
+        if self.stream:
+            self._send_head(200, [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')])
+            self.push('retry: {0}\n\n'.format(_RETRY).encode('utf-8'))
+
+    def release(self, results_url):
+        if self.stream:
+            if self.session_id is None:     # Results were in before the stream began
+                self.begin()
+            self.answered = True
+            self.push('event: result\ndata: {0}\n\n'.format(results_url).encode('utf-8'))
+            self.close_when_done()
+        else:
+            self.respond(303, [('Location', str(results_url))])
+
+    def time_out(self):
+        if self.answered or self.session_id is None:    # Still sending its request, or not reading the answer
+            self.close()
+        elif self.stream:
+            self.answered = True
+            self.close_when_done()
+        else:
+            self.respond(204)
+
+    def readable(self):
+        return not self.answered and asynchat.async_chat.readable(self)    # Stop reading once answered & closing
+
+    def respond(self, status, headers=()):
+        self.answered = True
+        self._send_head(status, list(headers) + [('Content-Length', '0')])
+        self.close_when_done()
+
+    def _send_head(self, status, headers):
+        head = ['HTTP/1.1 {0} {1}'.format(status, _STATUS.get(status, 'OK')), 'Connection: close',
+                'Access-Control-Allow-Origin: {0}'.format(self.notifier.origin)]
+        head.extend('{0}: {1}'.format(name, value) for name, value in headers)
+        self.push(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+
+    def handle_close(self):
+        self.notifier._remove(self)
+        self.close()
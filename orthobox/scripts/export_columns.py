@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Export uploaded sessions as NumPy columns. See orthobox.columnar.
+
+$ LMDB_DATADIR=... orthobox_export_columns sessions.npz [--format npz|npy] [--context ...] [--box-type pokey]
+
+--format npy writes a directory of .npy files to memory map, load either with orthobox.columnar.load_columns.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import sys
+import time
+import argparse
+
+from orthobox.columnar import export_columns, FORMATS, _CHUNK
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Export session data as NumPy columns")
+    parser.add_argument('path', help="Archive or directory to write")
+    parser.add_argument('--format', choices=FORMATS, default='npz', help="Compressed archive or .npy directory")
+    parser.add_argument('--context', help="Only sessions in this context_id")
+    parser.add_argument('--box-type', help="Only sessions of this box type")
+    parser.add_argument('--chunk', type=int, default=_CHUNK, help="Sessions per chunk of columns")
+    options = parser.parse_args(argv[1:])
+
+    start = time.time()
+    count = export_columns(options.path, options.format, options.context, options.box_type, options.chunk)
+    print("{0} sessions exported to {1} in {2:.2f}s".format(count, options.path, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Re-derive the normalized errors of every stored upload from its raw errors, with NumPy (see orthobox.error_batch).
+
+$ LMDB_DATADIR=... orthobox_normalize_errors [--cutoff 250] [--batch 2000] [--dry-run] [--verify]
+                                             [--sweep 100 --sweep 500 ...]
+
+Sessions whose stored errors differ from those at cutoff are rewritten, one write transaction per batch, along with
+their error counts, results pages & progress graphs, then class statistics are rebuilt; results & grades are not
+re-evaluated. --dry-run only reports what would change. --verify also runs evaluation._normalize_errors on every
+session and exits 1 on any difference. --sweep reports the total errors at other cutoffs, for tuning.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import sys
+import time
+import argparse
+
+from itertools import islice
+
+from orthobox.data_store import iter_sessions, atomically, store_normalized_errors, rebuild_cohort_stats
+from orthobox.evaluation import _ERROR_CUTOFF, _normalize_errors
+from orthobox.error_batch import RawErrors
+
+_BATCH = 2000
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Re-normalize stored raw errors")
+    parser.add_argument('--cutoff', type=float, default=_ERROR_CUTOFF, help="Error cutoff in ms")
+    parser.add_argument('--batch', type=int, default=_BATCH, help="Sessions normalized & written at a time")
+    parser.add_argument('--dry-run', action='store_true', help="Report changes without writing them")
+    parser.add_argument('--verify', action='store_true', help="Check against the scalar normalization")
+    parser.add_argument('--sweep', type=float, action='append', default=[], help="Also count errors at this cutoff")
+    options = parser.parse_args(argv[1:])
+    cutoff = int(options.cutoff) if options.cutoff == int(options.cutoff) else options.cutoff
+
+    report = {'sessions': 0, 'changed': 0, 'before': 0, 'after': 0, 'mismatched': 0}
+    swept = dict.fromkeys(options.sweep, 0)
+    start, normalizing = time.time(), 0
+    sessions = ((session_id, session['data']) for _, session_id, session in iter_sessions()
+                if 'raw_errors' in session.get('data', {}))
+    while True:
+        batch = list(islice(sessions, options.batch))
+        if not batch:
+            break
+        raw_errors_lists = [data['raw_errors'] for _, data in batch]
+        began = time.time()
+        raw_errors = RawErrors(raw_errors_lists)
+        normalized = raw_errors.normalize(cutoff)
+        normalizing += time.time() - began
+        for sweep_cutoff in swept:
+            swept[sweep_cutoff] += int(raw_errors.counts(sweep_cutoff).sum())
+
+        changed = list()
+        for (session_id, data), errors in zip(batch, normalized):
+            report['sessions'] += 1
+            report['before'] += len(data.get('errors', []))
+            report['after'] += len(errors)
+            if options.verify and errors != _normalize_errors(data['raw_errors'], cutoff):
+                report['mismatched'] += 1
+                print("Mismatch: {0}".format(session_id))
+            if errors != data.get('errors'):
+                changed.append((session_id, errors))
+        report['changed'] += len(changed)
+        if changed and not options.dry_run:
+            atomically(_store_all, changed)
+    if report['changed'] and not options.dry_run:
+        rebuild_cohort_stats()
+
+    report['seconds'] = time.time() - start
+    report['per_second'] = report['sessions'] / normalizing if normalizing else 0
+    print("{sessions} sessions, {changed} changed, {before} errors before, {after} after, {mismatched} mismatched "
+          "in {seconds:.2f}s; normalized {per_second:.0f} sessions/sec".format(**report))
+    for sweep_cutoff in sorted(swept):
+        print("cutoff {0:g}: {1} errors".format(sweep_cutoff, swept[sweep_cutoff]))
+    return 1 if report['mismatched'] else 0
+
+
+def _store_all(changed):
+    for session_id, errors in changed:
+        store_normalized_errors(session_id, errors)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
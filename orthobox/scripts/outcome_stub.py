@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in LTI outcome service for exercising grade passback without Moodle.
+
+$ orthobox_outcome_stub [--port 8129] [--latency 0.5] [--jitter 0.5] [--error-rate 0.2] [--error-kind failure]
+                        [--quiet]
+
+Answers every replaceResult POST with success after latency + uniform(0, jitter) seconds, except a fraction
+error-rate of them, which get one of the error kinds at random: an HTTP 500, a 'failure' outcome response or a
+dropped connection, all unless --error-kind is given. Launch with
+lis_outcome_service_url = http://localhost:<port>/outcome. OAuth signatures are not checked. Connections are kept
+alive between requests, as by most web servers in front of an LMS.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import re
+import sys
+import time
+import random
+import argparse
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/lis/oms1p0/pox">
+  <imsx_POXHeader>
+    <imsx_POXResponseHeaderInfo>
+      <imsx_version>V1.0</imsx_version>
+      <imsx_messageIdentifier>{count}</imsx_messageIdentifier>
+      <imsx_statusInfo>
+        <imsx_codeMajor>{code_major}</imsx_codeMajor>
+        <imsx_severity>status</imsx_severity>
+        <imsx_description>orthobox outcome stub</imsx_description>
+        <imsx_messageRefIdentifier>{message_id}</imsx_messageRefIdentifier>
+        <imsx_operationRefIdentifier>replaceResult</imsx_operationRefIdentifier>
+      </imsx_statusInfo>
+    </imsx_POXResponseHeaderInfo>
+  </imsx_POXHeader>
+  <imsx_POXBody><replaceResultResponse/></imsx_POXBody>
+</imsx_POXEnvelopeResponse>
+"""
+
+_ERROR_KINDS = ('http 500', 'failure', 'dropped')
+
+_MESSAGE_ID = re.compile(r'<imsx_messageIdentifier>([^<]*)</imsx_messageIdentifier>')
+_SCORE = re.compile(r'<textString>([^<]*)</textString>')
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = str('HTTP/1.1')
+    disable_nagle_algorithm = True  # As real web servers do, or small writes on a kept-alive connection stall
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        options = self.server.options
+        body = self.rfile.read(int(self.headers['Content-Length'] or 0)).decode('utf-8', 'replace')
+        with self.server.lock:
+            self.server.count += 1
+            count = self.server.count
+        message_id = (_MESSAGE_ID.findall(body) or [''])[0]
+        score = (_SCORE.findall(body) or [''])[0]
+        time.sleep(options.latency + random.uniform(0, options.jitter))
+
+        outcome = 'success'
+        if random.random() < options.error_rate:
+            outcome = random.choice(options.error_kind or _ERROR_KINDS)
+        with self.server.lock:
+            self.server.received.append((message_id, score, outcome))
+        if not options.quiet:
+            print("{0} {1} score={2} -> {3}".format(count, message_id, score, outcome))
+            sys.stdout.flush()
+        if outcome == 'dropped':
+            self.close_connection = True
+            return
+        if outcome == 'http 500':
+            self.send_error(500)
+            return
+        response = _RESPONSE.format(count=count, message_id=message_id,
+                                    code_major='failure' if outcome == 'failure' else 'success').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_server(options):
+    """
+    The stub server for parsed command line options, not yet serving. Counts requests & connections, and keeps
+    (message id, score, outcome) of every request in received.
+    """
+    server = _Server((options.host, options.port), _Handler)
+    server.options = options
+    server.lock = threading.Lock()
+    server.count = 0
+    server.connections = 0
+    server.received = list()
+    return server
+
+
+def parse_args(args):
+    """
+    Options for make_server from command line arguments, eg. ['--port', '0', '--quiet'].
+    """
+    parser = argparse.ArgumentParser(description="Stand-in LTI outcome service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8129)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds before every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many more seconds, at random")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument('--error-kind', action='append', choices=_ERROR_KINDS,
+                        help="Kind of failure, repeat for several. Default all")
+    parser.add_argument('--quiet', action='store_true', help="Don't log requests")
+    return parser.parse_args(args)
+
+
+def main(argv=sys.argv):
+    options = parse_args(argv[1:])
+
+    server = make_server(options)
+    print("Outcome service stub on http://{0}:{1}/outcome".format(options.host, server.server_port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
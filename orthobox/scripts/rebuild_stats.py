@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Recompute every course context's class statistics from the stored uploads. See orthobox.cohort_stats.
+
+$ LMDB_DATADIR=... orthobox_rebuild_stats [--json]
+
+Statistics are kept up to date as results are uploaded, rebuild after changing stored data by other means.
+--json prints every context's summarized statistics afterwards.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import sys
+import json
+import time
+import argparse
+
+from orthobox.data_store import rebuild_cohort_stats, iter_cohort_stats
+from orthobox.cohort_stats import summarize
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Recompute class statistics")
+    parser.add_argument('--json', action='store_true', help="Print the statistics as JSON")
+    options = parser.parse_args(argv[1:])
+
+    start = time.time()
+    counted = rebuild_cohort_stats()
+    seconds = time.time() - start
+    if options.json:
+        print(json.dumps([dict(summarize(stats), context=context_id, box_type=box_type)
+                          for context_id, box_type, stats in iter_cohort_stats()], indent=2, sort_keys=True))
+    else:
+        for context_id, box_type, stats in iter_cohort_stats():
+            print("{0} {1:<6} {2} sessions".format(context_id, box_type, stats['sessions']))
+        print("{0} sessions counted in {1:.2f}s".format(counted, seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Re-evaluate every stored upload under new criteria, correcting results & grades. See orthobox.reevaluation.
+
+$ LMDB_DATADIR=... orthobox_reevaluate [--criteria '{"pokey": {"timeout": 300}}'] [--workers 4] [--batch 500]
+                                       [--dry-run] [--json]
+
+--criteria overrides the criteria of every context per box type, criteria not given keep each context's current
+values. Class statistics are rebuilt once changes are stored. --dry-run prints the differences without storing them.
+Sessions that fail to evaluate are listed; their users' grades at that activity are left as stored.
+Exits 1 if any change conflicted with a concurrent write.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import sys
+import json
+import argparse
+
+from orthobox.data_store import rebuild_cohort_stats
+from orthobox.reevaluation import reevaluate, _WORKERS, _BATCH
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Re-evaluate stored sessions under new criteria")
+    parser.add_argument('--criteria', type=json.loads, default={}, help="JSON criteria by box type")
+    parser.add_argument('--workers', type=int, default=_WORKERS, help="Evaluating processes")
+    parser.add_argument('--batch', type=int, default=_BATCH, help="Changes stored per write transaction")
+    parser.add_argument('--dry-run', action='store_true', help="Report the differences without storing them")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    options = parser.parse_args(argv[1:])
+
+    report = reevaluate(options.criteria, options.workers, options.dry_run, options.batch)
+    if not options.dry_run and any(change['stored'] for change in report['sessions'] + report['users']):
+        rebuild_cohort_stats()
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        for session in report['sessions']:
+            print("{session_id} {uid} {box_type:<6} trial {trial:>3}: {result[0]:>10} -> {result[1]:<10} "
+                  "grade {grade[0]:.2f} -> {grade[1]:.2f}{conflict}".format(
+                      conflict=_conflict(session, options.dry_run), **session))
+        for user in report['users']:
+            print("{context} {uid} {box_type:<6} grade {grade[0]:.2f} -> {grade[1]:.2f}{conflict}".format(
+                conflict=_conflict(user, options.dry_run), **user))
+        for session in report['failed']:
+            print("{session_id} {uid} {box_type} FAILED, grades left as stored: {error}".format(**session))
+        print("{evaluated} sessions evaluated, {failed} failed, {sessions} sessions & {users} grades changed, "
+              "{conflicts} conflicts in {seconds:.2f}s{dry_run}".format(
+                  **dict(report, sessions=len(report['sessions']), users=len(report['users']),
+                         failed=len(report['failed']),
+                         dry_run=" (dry run, nothing stored)" if options.dry_run else "")))
+    return 1 if report['conflicts'] else 0
+
+
+def _conflict(change, dry_run):
+    return "" if dry_run or change['stored'] else " CONFLICT, not stored"
+
+
+if __name__ == '__main__':
+    sys.exit(main())
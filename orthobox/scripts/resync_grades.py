@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Re-post the current grade of every user in a course context to the LMS outcome service.
+
+$ LMDB_DATADIR=... orthobox_resync_grades <context_id> [--box pokey] [--workers 8] [--rate 10]
+                                                       [--outcome-url http://localhost:8129/outcome] [--json]
+
+context_id is the hashed context id, as in the database. --outcome-url sends every post to that URL instead of the
+launches' outcome service, eg. orthobox_outcome_stub. Prints per-user status & total throughput; exits 1 if any
+post failed.
+
+Posts directly, bypassing the grade outbox, so for offline use with the app stopped: while it runs, resync from the
+LTI grade_resync launch, which queues the grades in the outbox instead.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import sys
+import json
+import argparse
+
+from orthobox.grade_resync import resync_grades, _WORKERS, _RATE
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Re-post the grades of a course context")
+    parser.add_argument('context_id')
+    parser.add_argument('--box', action='append', dest='box_types', help="Activity to resync, default all")
+    parser.add_argument('--workers', type=int, default=_WORKERS, help="Concurrent posts")
+    parser.add_argument('--rate', type=float, default=_RATE, help="Posts per second at most, 0 for no limit")
+    parser.add_argument('--outcome-url', help="Post here instead of the launches' outcome service")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    options = parser.parse_args(argv[1:])
+
+    report = resync_grades(options.context_id, options.box_types, options.workers, options.rate,
+                           outcome_url=options.outcome_url)
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        for user in report['users']:
+            print("{uid} {box_type:<6} {grade:5.2f} {status:<7} {seconds:6.3f}s {username} {error}".format(
+                **dict(user, username=user['username'] or '', error=user['error'] or '')))
+        print("{posted} posted, {failed} failed, {skipped} skipped in {seconds:.2f}s: {per_second:.1f} posts/sec".format(
+            **report))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Tests, run from the project directory with:
+
+$ python -m unittest discover -s orthobox/tests -t .
+
+data_store opens its environment on import, so unless LMDB_DATADIR is set the tests get a scratch one of their own.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import os
+import atexit
+import logging
+import shutil
+import tempfile
+
+if 'LMDB_DATADIR' not in os.environ:
+    os.environ[str('LMDB_DATADIR')] = tempfile.mkdtemp(prefix='orthobox-tests-')
+    atexit.register(shutil.rmtree, os.environ['LMDB_DATADIR'], True)
+
+logging.getLogger('orthobox').addHandler(logging.NullHandler())   # Expected delivery failures log warnings
+logging.getLogger('cornice').addHandler(logging.NullHandler())    # Warns of /results answering a JSON array
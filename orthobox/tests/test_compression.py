@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+compression.CompressionMiddleware: negotiating an encoding, which responses are compressed, and ETags & conditional
+requests for compressed responses.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import zlib
+import unittest
+
+from webob import Request, Response
+
+from orthobox.compression import CompressionMiddleware, _negotiate
+
+_BODY = b'session,duration,errors\n' + b''.join(b'%d,100,3\n' % n for n in range(400))
+_ETAG = 'c5e2b1d6'
+
+
+def _page(environ, start_response):
+    """
+    A text response with an ETag, 304 when If-None-Match matches it, like views using page_cache.tag_response.
+    """
+    response = Response(_BODY, content_type='text/csv', conditional_response=True)
+    response.etag = _ETAG
+    return response(environ, start_response)
+
+
+class _Streamed(object):
+    """
+    app_iter yielding chunks without a Content-Length, recording whether it was closed.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def _decompress(body, encoding):
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+
+
+class CompressionTest(unittest.TestCase):
+    def get(self, app=_page, accept_encoding='gzip', **headers):
+        request = Request.blank('/', headers=dict(headers, Accept_Encoding=str(accept_encoding)))
+        return request.get_response(CompressionMiddleware(app, min_size=1024))
+
+    def stream(self, chunks, content_type=str('application/x-ndjson'), **headers):
+        app_iter = _Streamed(chunks)
+
+        def app(environ, start_response):
+            start_response(str('200 OK'), [(str('Content-Type'), content_type)])
+            return app_iter
+        return self.get(app, **headers), app_iter
+
+    def test_negotiate(self):
+        self.assertEqual(_negotiate(''), None)
+        self.assertEqual(_negotiate('identity'), None)
+        self.assertEqual(_negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(_negotiate('deflate, gzip'), 'gzip')
+        self.assertEqual(_negotiate('deflate'), 'deflate')
+        self.assertEqual(_negotiate('gzip;q=0.5, deflate;q=0.8'), 'deflate')
+        self.assertEqual(_negotiate('GZIP;q=0, deflate'), 'deflate')
+        self.assertEqual(_negotiate('*'), 'gzip')
+        self.assertEqual(_negotiate('*;q=0, deflate;q=0.1'), 'deflate')
+        self.assertEqual(_negotiate('gzip;q=bogus'), None)
+
+    def test_compressed(self):
+        for encoding in ('gzip', 'deflate'):
+            response = self.get(accept_encoding=encoding)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.headers['Content-Encoding'], encoding)
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.headers['ETag'], '"{0}-{1}"'.format(_ETAG, encoding))
+            self.assertNotIn('Content-Length', response.headers)
+            self.assertEqual(_decompress(response.body, encoding), _BODY)
+
+    def test_uncompressed(self):
+        response = self.get(accept_encoding='identity')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['ETag'], '"{0}"'.format(_ETAG))
+        self.assertEqual(response.body, _BODY)
+        head = Request.blank('/', method=str('HEAD'), headers={'Accept-Encoding': str('gzip')})
+        self.assertNotIn('Content-Encoding', head.get_response(CompressionMiddleware(_page)).headers)
+
+    def test_if_none_match_tagged(self):
+        for encoding in ('gzip', 'deflate'):
+            etag = self.get(accept_encoding=encoding).headers['ETag']
+            response = self.get(accept_encoding=encoding, If_None_Match=str(etag))
+            self.assertEqual(response.status_int, 304)
+            self.assertEqual(response.headers['ETag'], etag)    # Same as the compressed copy being validated
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.body, b'')
+
+    def test_if_none_match_untagged(self):
+        etag = '"{0}"'.format(_ETAG)
+        response = self.get(accept_encoding='gzip', If_None_Match=str(etag))    # Cached from an uncompressed response
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        response = self.get(accept_encoding='identity', If_None_Match=str(etag))
+        self.assertEqual(response.status_int, 304)
+
+    def test_if_none_match_stale(self):
+        response = self.get(If_None_Match=str('"0ld-gzip", W/"older-deflate"'))
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(_decompress(response.body, 'gzip'), _BODY)
+
+    def test_streamed(self):
+        chunks = [b'{"session": %d}\n' % n for n in range(200)]
+        response, app_iter = self.stream(chunks)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(_decompress(response.body, 'gzip'), b''.join(chunks))
+        self.assertTrue(app_iter.closed)
+
+    def test_small_streamed_not_compressed(self):
+        response, app_iter = self.stream([b'{"session": 1}\n', b'{"session": 2}\n'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, b'{"session": 1}\n{"session": 2}\n')
+        self.assertTrue(app_iter.closed)
+
+    def test_incompressible_type(self):
+        response, app_iter = self.stream([b'\x89PNG' * 1000], content_type=str('image/png'))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, b'\x89PNG' * 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+error_batch.normalize_errors_batch against evaluation._normalize_errors, on random sessions.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import random
+import unittest
+
+from orthobox.evaluation import _ERROR_CUTOFF, _normalize_errors
+try:
+    from orthobox.error_batch import normalize_errors_batch, RawErrors
+except ImportError:     # numpy is optional
+    RawErrors = None
+
+_CASES = 3000
+_CUTOFFS = (_ERROR_CUTOFF, 0, 1, 100, 250.5, 1000)
+
+
+def _raw_error(rng, endtime, length, floats):
+    """
+    A raw error ending at endtime, its length given as 'len', 'duration', neither, or zero.
+    """
+    error = {'endtime': endtime + rng.random() if floats else endtime}
+    style = rng.randrange(5)
+    if style == 0:
+        error['len'] = length
+    elif style == 1:
+        error['duration'] = length
+    elif style == 2:
+        error['len'] = 0    # Falls through to 'duration', then a minimum of 1
+        if rng.random() < 0.5:
+            error['duration'] = length
+    elif style == 3:
+        error['len'], error['duration'] = length, rng.randint(0, 1000)
+    return error
+
+
+def _session(rng, cutoff, floats=False):
+    """
+    Raw errors in endtime order, with some gaps exactly at the merge boundary: the next error starts cutoff after the
+    previous one's end.
+    """
+    errors, endtime = list(), rng.randint(0, 5000)
+    for _ in range(rng.choice((0, 1, 2, rng.randint(3, 40)))):
+        length = rng.choice((0, 1, rng.randint(1, 2 * int(cutoff) + 2)))
+        errors.append(_raw_error(rng, endtime, length, floats))
+        gap = rng.choice((int(cutoff), int(cutoff) + 1, int(cutoff) - 1, rng.randint(0, 3 * int(cutoff) + 3)))
+        endtime += max(length, 1) + gap
+    return errors
+
+
+@unittest.skipIf(RawErrors is None, "needs numpy: pip install orthobox[numpy]")
+class NormalizeErrorsBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(20140504)
+
+    def assertMatchesScalar(self, sessions, cutoff):
+        expected = [_normalize_errors(raw_errors, cutoff) for raw_errors in sessions]
+        self.assertEqual(normalize_errors_batch(sessions, cutoff), expected)
+        self.assertEqual(RawErrors(sessions).counts(cutoff).tolist(), [len(errors) for errors in expected])
+
+    def test_empty(self):
+        self.assertEqual(normalize_errors_batch([]), [])
+        self.assertMatchesScalar([[], [], []], _ERROR_CUTOFF)
+
+    def test_single_error(self):
+        for error in ({'endtime': 1000, 'len': 300}, {'endtime': 1000, 'duration': 300}, {'endtime': 1000},
+                      {'endtime': 1000, 'len': 0}, {'endtime': 1000.5, 'len': 250}, {'endtime': 1000, 'len': 249}):
+            self.assertMatchesScalar([[error]], _ERROR_CUTOFF)
+
+    def test_gap_at_cutoff(self):
+        cutoff = _ERROR_CUTOFF
+        merged = [{'endtime': 1000, 'len': 300}, {'endtime': 1000 + cutoff + 10, 'len': 10}]
+        apart = [{'endtime': 1000, 'len': 300}, {'endtime': 1000 + cutoff + 11, 'len': 10}]
+        self.assertEqual(len(normalize_errors_batch([merged], cutoff)[0]), 1)
+        self.assertEqual(len(normalize_errors_batch([apart], cutoff)[0]), 1)     # The second is too short to keep
+        self.assertMatchesScalar([merged, apart], cutoff)
+
+    def test_random_integer_sessions(self):
+        for _ in range(_CASES // 10):
+            cutoff = self.rng.choice(_CUTOFFS)
+            self.assertMatchesScalar([_session(self.rng, cutoff) for _ in range(10)], cutoff)
+
+    def test_random_float_sessions(self):
+        for _ in range(_CASES // 10):
+            cutoff = self.rng.choice(_CUTOFFS)
+            sessions = [_session(self.rng, cutoff, floats=self.rng.random() < 0.5) for _ in range(10)]
+            self.assertMatchesScalar(sessions, cutoff)
+
+    def test_float_lengths(self):
+        sessions = [[{'endtime': 1000, 'len': 250.5}, {'endtime': 1600, 'duration': 0.5}],
+                    [{'endtime': 10, 'len': 300}]]
+        for cutoff in _CUTOFFS:
+            self.assertMatchesScalar(sessions, cutoff)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Grade passback through GradeOutbox and the data_store outbox, against scripts.outcome_stub.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import time
+import threading
+import unittest
+
+from uuid import uuid4
+
+from orthobox.data_store import (_OUTBOX_DB, _OUTBOX_SCHEDULE_DB, _key, atomically, enqueue_grade, claim_grades,
+                                 settle_grade, outbox_depth, new_oauth_creds)
+from orthobox.grade_outbox import GradeOutbox, DeliveryError, post_grade
+from orthobox.outcome_request import SESSION_POOL
+from orthobox.scripts.outcome_stub import make_server, parse_args
+
+_WAIT = 10  # Seconds to wait for background delivery
+
+
+def _clear_outbox():
+    for db in (_OUTBOX_DB, _OUTBOX_SCHEDULE_DB):
+        for key, _ in list(db.iterprefix('', raw=True)):
+            del db[key]
+
+
+class OutcomeStubTest(unittest.TestCase):
+    """
+    Runs an outcome stub with stub_args, and gives launch params posting to it.
+    """
+    stub_args = ()
+
+    def setUp(self):
+        atomically(_clear_outbox)
+        SESSION_POOL.close()    # Connections to an earlier test's stub
+        self.stub = make_server(parse_args(['--port', '0', '--quiet'] + list(self.stub_args)))
+        thread = threading.Thread(target=self.stub.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.key, _ = new_oauth_creds()
+
+    def tearDown(self):
+        SESSION_POOL.close()
+        self.stub.shutdown()
+        self.stub.server_close()
+
+    def params(self, sourcedid='student-1'):
+        return {'oauth_consumer_key': self.key, 'lis_result_sourcedid': sourcedid,
+                'lis_outcome_service_url': 'http://127.0.0.1:{0}/outcome'.format(self.stub.server_port)}
+
+    def enqueue(self, grade, sourcedid='student-1'):
+        session_id = uuid4().hex
+        atomically(enqueue_grade, session_id, grade, self.params(sourcedid))
+        return session_id
+
+    def wait_for(self, condition):
+        deadline = time.time() + _WAIT
+        while not condition():
+            self.assertLess(time.time(), deadline, "Timed out")
+            time.sleep(0.01)
+
+    def claim(self):
+        claimed = list()
+        self.wait_for(lambda: claimed.extend(claim_grades(1, 60)) or claimed)
+        return claimed
+
+    def deliver(self, outbox, target, record):
+        """
+        outbox._deliver a grade that fails, returning the bounds of the retry delay it was given.
+        """
+        before = time.time()
+        outbox._deliver(target, record)
+        after = time.time()
+        due = int(_OUTBOX_DB.load(target)['due'].split(':')[0]) / 1000
+        return due - after, due - before + 0.001    # Due times are kept to the ms, rounded down
+
+
+class DeliveryTest(OutcomeStubTest):
+    stub_args = ('--latency', '0.1', '--jitter', '0.05')
+
+    def test_delivers_in_background(self):
+        outbox = GradeOutbox(workers=2, poll=0.05)
+        outbox.start()
+        try:
+            session_ids = [self.enqueue(1 / 3, sourcedid='student-{0}'.format(i)) for i in range(4)]
+            outbox.wake()
+            self.wait_for(lambda: outbox.stats()['process']['delivered'] == 4)
+        finally:
+            outbox.stop(_WAIT)
+        self.assertEqual(outbox_depth(), (0, 0))
+        self.assertEqual(sorted(message_id for message_id, _, _ in self.stub.received), sorted(session_ids))
+        self.assertEqual(set(score for _, score, _ in self.stub.received), {'0.33'})
+        self.assertGreaterEqual(outbox.stats()['latency']['p50'], 0.1)     # Includes the stub's latency
+
+    def test_connections_reused(self):
+        for grade in (0, 1 / 3, 2 / 3):
+            post_grade(uuid4().hex, grade, self.params())
+        self.assertEqual(self.stub.count, 3)
+        self.assertEqual(self.stub.connections, 1)
+
+    def test_newer_grade_replaces_pending(self):
+        self.enqueue(1 / 3)
+        latest = self.enqueue(2 / 3)
+        self.assertEqual(outbox_depth(), (1, 0))
+        (target, record), = claim_grades(10, 60)
+        self.assertEqual((record['session_id'], record['grade']), (latest, 2 / 3))
+
+    def test_newer_grade_waits_for_delivery_in_flight(self):
+        self.enqueue(1 / 3)
+        (target, record), = claim_grades(10, 60)
+        latest = self.enqueue(2 / 3)
+        self.assertEqual(claim_grades(10, 60), [])    # Held back until the delivery in flight settles
+        settle_grade(target, record['token'])
+        (_, newer), = claim_grades(10, 60)
+        self.assertEqual((newer['session_id'], newer['attempts']), (latest, 1))
+
+    def test_lease_expiry(self):
+        self.enqueue(1)
+        (target, first), = claim_grades(1, 0.2)
+        self.assertEqual(claim_grades(1, 0.2), [])    # Leased
+        time.sleep(0.25)
+        (_, second), = claim_grades(1, 60)            # Never settled, so claimed again
+        self.assertEqual((second['attempts'], second['session_id']), (2, first['session_id']))
+        self.assertNotEqual(second['token'], first['token'])
+
+        settle_grade(target, first['token'])    # The abandoned delivery settling late changes nothing
+        self.assertEqual(outbox_depth(), (1, 0))
+        self.assertEqual(_OUTBOX_DB.load(target)['token'], second['token'])
+        settle_grade(target, second['token'])
+        self.assertEqual(outbox_depth(), (0, 0))
+
+
+class FailureTest(OutcomeStubTest):
+    stub_args = ('--error-rate', '1', '--error-kind', 'failure')
+
+    def test_failure_response_raises_delivery_error(self):
+        with self.assertRaises(DeliveryError):
+            post_grade(uuid4().hex, 1, self.params())
+
+    def test_retry_backoff_with_jitter(self):
+        backoff = 0.2
+        outbox = GradeOutbox(workers=0, backoff=backoff, max_attempts=5)
+        self.enqueue(1)
+        for attempts in (1, 2, 3):
+            (target, record), = self.claim()
+            self.assertEqual(record['attempts'], attempts)
+            retry_in = self.deliver(outbox, target, record)
+            nominal = backoff * 2 ** (attempts - 1)
+            self.assertTrue(nominal * 0.5 <= retry_in[1] and retry_in[0] <= nominal, (attempts, retry_in))
+            self.assertIn('DeliveryError', _OUTBOX_DB.load(target)['error'])
+
+        for i in range(5):
+            self.enqueue(1, sourcedid='student-{0}'.format(i + 2))
+        jittered = set(round(self.deliver(outbox, target, record)[0], 3) for target, record in claim_grades(5, 60))
+        self.assertGreater(len(jittered), 1)
+
+    def test_gives_up_after_max_attempts(self):
+        outbox = GradeOutbox(workers=0, max_attempts=2, backoff=0.01)
+        self.enqueue(1)
+        for attempts in (1, 2):
+            (target, record), = self.claim()
+            self.assertEqual(record['attempts'], attempts)
+            outbox._deliver(target, record)
+        self.assertEqual(outbox_depth(), (0, 1))
+        failed = _OUTBOX_DB.load(_key('failed', target))
+        self.assertIn('DeliveryError', failed['error'])
+        self.assertEqual(outbox.stats()['process'], {'delivered': 0, 'retried': 1, 'failed': 1})
+
+
+class DroppedConnectionTest(OutcomeStubTest):
+    stub_args = ('--error-rate', '1', '--error-kind', 'dropped')
+
+    def test_dropped_connection_retried(self):
+        outbox = GradeOutbox(workers=0, backoff=60)
+        self.enqueue(1)
+        (target, record), = claim_grades(1, 60)
+        outbox._deliver(target, record)
+        pending = _OUTBOX_DB.load(target)
+        self.assertEqual((pending['token'], pending['attempts']), (None, 1))
+        self.assertTrue(pending['error'])
+        self.assertEqual(outbox.stats()['process']['retried'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
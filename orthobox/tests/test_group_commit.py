@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+lmdb_wrapper.GroupCommitWriter: jobs from several threads sharing one write transaction, one of them failing.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import shutil
+import threading
+import unittest
+
+import lmdb
+from tempfile import mkdtemp
+
+from orthobox.lmdb_wrapper import GroupCommitWriter, LMDB_Dict, transaction
+
+_JOBS = 3
+
+
+class GroupCommitTest(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp(prefix='orthobox-group-commit-')
+        self.env = lmdb.open(self.path, max_dbs=2)
+        self.writer = GroupCommitWriter(self.env, window=5, max_batch=_JOBS)   # The batch closes once all arrive
+        self.table = LMDB_Dict(self.env, 'table', writer=self.writer)
+
+    def tearDown(self):
+        self.env.close()
+        shutil.rmtree(self.path, True)
+
+    def batch(self, *functions):
+        """
+        Call each function through the writer from its own thread, returns [(result, error)] in the same order.
+        """
+        outcomes = [None] * len(functions)
+
+        def call(index, function):
+            try:
+                outcomes[index] = (self.writer.call(function), None)
+            except Exception as e:
+                outcomes[index] = (None, e)
+        threads = [threading.Thread(target=call, args=item) for item in enumerate(functions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return outcomes
+
+    def write(self, key, fail=False):
+        def job():
+            self.table[key] = 'written'
+            self.table.append(key + ':', 'appended')
+            if fail:
+                raise ValueError(key)
+            return key
+        return job
+
+    def test_failed_job_rolled_back_alone(self):
+        last_txnid = self.env.info()['last_txnid']
+        outcomes = self.batch(self.write('a'), self.write('b', fail=True), self.write('c'))
+        self.assertEqual(self.env.info()['last_txnid'], last_txnid + 1)    # One commit for the batch
+        self.assertEqual([result for result, _ in outcomes], ['a', None, 'c'])
+        self.assertEqual(outcomes[0][1], None)
+        self.assertIsInstance(outcomes[1][1], ValueError)
+        self.assertEqual(sorted(self.table.keys()), ['a', 'a:00000000', 'c', 'c:00000000'])
+
+    def test_dict_writes_join_the_batch(self):
+        def store(key):
+            self.table[key] = 'direct'    # Called from a request thread, routed through the writer
+        threads = [threading.Thread(target=store, args=(key,)) for key in ('d', 'e', 'f')]
+        last_txnid = self.env.info()['last_txnid']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(self.env.info()['last_txnid'], last_txnid + 1)
+        self.assertEqual(self.table.values(), ('direct',) * _JOBS)
+
+    def test_call_inside_unit_of_work_runs_inline(self):
+        with self.assertRaises(ValueError):
+            with transaction(self.env, write=True):
+                self.assertEqual(self.writer.call(self.write('g')), 'g')
+                self.assertEqual(self.table['g'], 'written')
+                raise ValueError('g')
+        self.assertNotIn('g', self.table)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+nonce_store: remembering nonces across the bucket ring, forgetting them as it comes round, refusing when full.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import shutil
+import unittest
+
+import lmdb
+from tempfile import mkdtemp
+
+from orthobox.lmdb_wrapper import GroupCommitWriter, transaction
+from orthobox.nonce_store import LMDBNonceStore, MemoryNonceStore, NonceStoreFull
+
+_WINDOW = 100
+_BUCKETS = 3
+_START = 1400000000     # A whole number of windows
+
+
+class NonceStoreTests(object):
+    """
+    Cases for any nonce store, mixed into a TestCase that provides store(max_nonces).
+    """
+    def test_replay_returns_first_seen(self):
+        nonces = self.store()
+        self.assertEqual(nonces.first_seen('a', _START + 10), _START + 10)
+        self.assertEqual(nonces.first_seen('a', _START + 20), _START + 10)
+        self.assertEqual(nonces.first_seen('b', _START + 20), _START + 20)
+
+    def test_remembered_until_the_ring_comes_round(self):
+        nonces = self.store()
+        nonces.first_seen('a', _START)
+        nonces.first_seen('b', _START + _WINDOW)
+        last = _START + _BUCKETS * _WINDOW - 1     # Last moment of the newest window the first bucket is live for
+        self.assertEqual(nonces.first_seen('a', last), _START)
+        self.assertEqual(nonces.first_seen('a', last + 1), last + 1)   # Its bucket emptied for the new window
+        self.assertEqual(nonces.first_seen('b', last + 1), _START + _WINDOW)
+
+    def test_stale_buckets_skipped_after_a_gap(self):
+        nonces = self.store()
+        nonces.first_seen('a', _START)
+        nonces.first_seen('b', _START + _WINDOW)
+        later = _START + (_BUCKETS + 1) * _WINDOW   # Lands on b's slot, a's bucket was never reused
+        self.assertEqual(nonces.first_seen('a', later), later)
+        self.assertEqual(nonces.first_seen('b', later), later)
+
+    def test_full(self):
+        nonces = self.store(max_nonces=2)
+        nonces.first_seen('a', _START)
+        nonces.first_seen('b', _START + _WINDOW)
+        with self.assertRaises(NonceStoreFull):
+            nonces.first_seen('c', _START + _WINDOW)
+        self.assertEqual(nonces.first_seen('a', _START + 2 * _WINDOW), _START)    # Known nonces still answered
+        with self.assertRaises(NonceStoreFull):
+            nonces.first_seen('c', _START + 2 * _WINDOW)
+        later = _START + _BUCKETS * _WINDOW     # a's bucket rotated out, making room
+        self.assertEqual(nonces.first_seen('c', later), later)
+        self.assertEqual(nonces.first_seen('b', later), _START + _WINDOW)
+        with self.assertRaises(NonceStoreFull):
+            nonces.first_seen('d', later)
+
+
+class MemoryNonceStoreTest(NonceStoreTests, unittest.TestCase):
+    def store(self, max_nonces=100):
+        return MemoryNonceStore(window=_WINDOW, buckets=_BUCKETS, max_nonces=max_nonces)
+
+
+class LMDBNonceStoreTest(NonceStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp(prefix='orthobox-nonces-')
+        self.env = lmdb.open(self.path, max_dbs=_BUCKETS + 1)
+
+    def tearDown(self):
+        self.env.close()
+        shutil.rmtree(self.path, True)
+
+    def store(self, max_nonces=100, writer=None):
+        return LMDBNonceStore(self.env, window=_WINDOW, buckets=_BUCKETS, max_nonces=max_nonces, writer=writer)
+
+    def test_shared_between_stores(self):
+        self.store().first_seen('a', _START)
+        self.assertEqual(self.store().first_seen('a', _START + 1), _START)
+
+    def test_rolled_back_with_the_unit_of_work(self):
+        nonces = self.store()
+        with self.assertRaises(ValueError):
+            with transaction(self.env, write=True):
+                nonces.first_seen('a', _START)
+                raise ValueError('a')
+        self.assertEqual(nonces.first_seen('a', _START + 1), _START + 1)
+
+    def test_through_writer(self):
+        nonces = self.store(writer=GroupCommitWriter(self.env, window=0))
+        self.assertEqual(nonces.first_seen('a', _START), _START)
+        self.assertEqual(nonces.first_seen('a', _START + 1), _START)
+
+
+if __name__ == '__main__':
+    unittest.main()
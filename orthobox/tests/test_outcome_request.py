@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+outcome_request.SessionPool checkout, reuse, eviction & closing.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import time
+import unittest
+
+from orthobox import outcome_request
+from orthobox.outcome_request import SessionPool
+
+_URL = 'https://lms.example.edu/outcome'
+
+
+class _Session(object):
+    """
+    Stands in for BodyHashOAuth1Session, recording whether it was closed.
+    """
+    def __init__(self, consumer_key, consumer_secret):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.session_class = outcome_request.BodyHashOAuth1Session
+        outcome_request.BodyHashOAuth1Session = _Session
+
+    def tearDown(self):
+        outcome_request.BodyHashOAuth1Session = self.session_class
+
+    def use(self, pool, url=_URL, key='key', secret='secret'):
+        with pool.session(url, key, secret) as session:
+            return session
+
+    def test_reused_per_host_and_credentials(self):
+        pool = SessionPool()
+        session = self.use(pool)
+        self.assertIs(self.use(pool, url=_URL + '?other=path'), session)    # Same scheme & host
+        self.assertIsNot(self.use(pool, key='other'), session)
+        self.assertIsNot(self.use(pool, secret='changed'), session)
+        self.assertIsNot(self.use(pool, url='http://lms.example.edu/outcome'), session)
+        self.assertFalse(session.closed)
+
+    def test_sessions_in_use_not_shared(self):
+        pool = SessionPool()
+        with pool.session(_URL, 'key', 'secret') as first:
+            with pool.session(_URL, 'key', 'secret') as second:
+                self.assertIsNot(first, second)
+        self.assertIn(self.use(pool), (first, second))
+
+    def test_closed_when_block_raises(self):
+        pool = SessionPool()
+        with self.assertRaises(ValueError):
+            with pool.session(_URL, 'key', 'secret') as session:
+                raise ValueError()
+        self.assertTrue(session.closed)
+        self.assertIsNot(self.use(pool), session)
+
+    def test_least_recently_used_evicted(self):
+        pool = SessionPool(max_idle=2)
+        with pool.session(_URL, 'a', 'secret') as a:
+            with pool.session(_URL, 'b', 'secret') as b:
+                with pool.session(_URL, 'c', 'secret') as c:
+                    pass
+        # Returned c, b then a: c is the least recently used and goes when the third is returned
+        self.assertEqual([a.closed, b.closed, c.closed], [False, False, True])
+        self.assertIs(self.use(pool, key='a'), a)
+        self.assertIs(self.use(pool, key='b'), b)
+
+    def test_idle_timeout(self):
+        pool = SessionPool(idle_timeout=0.05)
+        stale = self.use(pool)
+        time.sleep(0.1)
+        fresh = self.use(pool)
+        self.assertTrue(stale.closed)
+        self.assertIsNot(fresh, stale)
+        self.assertFalse(fresh.closed)
+
+    def test_close(self):
+        pool = SessionPool()
+        sessions = [self.use(pool, key=key) for key in ('a', 'b', 'c')]
+        pool.close()
+        self.assertTrue(all(session.closed for session in sessions))
+        self.assertNotIn(self.use(pool, key='a'), sessions)
+
+
+if __name__ == '__main__':
+    unittest.main()
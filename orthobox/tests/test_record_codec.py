@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+record_codec: BinaryCodec round trips, its column-wise event arrays and falling back to or reading JSON.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import json
+import unittest
+
+from orthobox.record_codec import CODECS, BinaryCodec, JSONCodec
+
+_SESSION = {'uid': 'c5e2b1d6', 'video_url': 'https://example.com/v.mp4', 'evaluated': True, 'trial': None,
+            'data': {'version_string': 'pokey', 'duration': 100000, 'starttime': 1400000000000, 'scale': 0.5,
+                     'name': 'Ünïcødé ✓', 'tags': [], 'meta': {},
+                     'errors': [{'endtime': 5000 + n, 'duration': 400 - n} for n in range(40)],
+                     'drops': [{'endtime': n / 4} for n in range(3)],
+                     'pokes': [{}] * 9}}
+_INT64_MAX = 2 ** 63 - 1
+_INT64_MIN = -2 ** 63
+
+
+def _types(obj):
+    """
+    obj with every scalar replaced by its type name, so round trips can be checked for int/float/bool drift.
+    """
+    if isinstance(obj, dict):
+        return dict((key, _types(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_types(item) for item in obj]
+    return 'int' if type(obj).__name__ == 'long' else type(obj).__name__
+
+
+class BinaryCodecTest(unittest.TestCase):
+    def assertRoundTrip(self, obj, codec):
+        loaded = codec.loads(codec.dumps(obj))
+        self.assertEqual(loaded, obj)
+        self.assertEqual(_types(loaded), _types(obj))
+        return loaded
+
+    def test_round_trip(self):
+        for codec in CODECS.values():
+            self.assertRoundTrip(_SESSION, codec)
+            self.assertRoundTrip([], codec)
+            self.assertRoundTrip('text', codec)
+            self.assertRoundTrip(None, codec)
+
+    def test_reads_buffers(self):
+        for codec in CODECS.values():
+            self.assertEqual(codec.loads(memoryview(codec.dumps(_SESSION))), _SESSION)
+
+    def test_event_arrays_stored_by_column(self):
+        errors = _SESSION['data']['errors']
+        self.assertEqual(BinaryCodec().dumps(errors)[:2], b'\x01r')
+        compressed = BinaryCodec(compress_level=6).dumps(errors)
+        self.assertEqual(compressed[:2], b'\x01R')
+        self.assertLess(len(compressed), len(BinaryCodec().dumps(errors)))
+        self.assertEqual(BinaryCodec(compress_level=6).dumps(errors[:3])[:2], b'\x01r')    # Under compress_min
+        self.assertLess(len(BinaryCodec().dumps(errors)), len(JSONCodec().dumps(errors)))
+
+    def test_int64_overflow(self):
+        codec = BinaryCodec()
+        for number in (_INT64_MAX, _INT64_MIN, _INT64_MAX + 1, _INT64_MIN - 1, 10 ** 30, -10 ** 30):
+            self.assertRoundTrip(number, codec)
+        self.assertEqual(codec.dumps(_INT64_MAX)[:2], b'\x01i')
+        self.assertEqual(codec.dumps(_INT64_MAX + 1)[:2], b'\x01I')
+        self.assertEqual(codec.dumps(_INT64_MIN - 1)[:2], b'\x01I')
+        column = [{'endtime': 1}, {'endtime': _INT64_MAX + 1}]     # Doesn't fit a packed int64 column
+        self.assertEqual(codec.dumps(column)[:2], b'\x01l')
+        self.assertRoundTrip(column, codec)
+        self.assertEqual(codec.dumps([{'endtime': _INT64_MIN}, {'endtime': _INT64_MAX}])[:2], b'\x01r')
+
+    def test_mixed_type_columns(self):
+        codec = BinaryCodec(compress_level=6, compress_min=1)
+        for column in ([{'endtime': 1}, {'endtime': 1.5}],          # int & float
+                       [{'endtime': True}, {'endtime': False}],     # bool, not packed as int
+                       [{'endtime': 1}, {'endtime': None}],
+                       [{'endtime': 1}, {'endtime': '2'}],
+                       [{'endtime': 1}, {'duration': 2}],           # Differing keys
+                       [{'endtime': 1}, {'endtime': 2, 'duration': 3}],
+                       [{'endtime': 1}, [2]],
+                       [{'endtime': {'nested': 1}}]):
+            self.assertEqual(codec.dumps(column)[:2], b'\x01l')
+            self.assertRoundTrip(column, codec)
+        self.assertRoundTrip([{'endtime': 1.0, 'duration': 2}] * 3, codec)    # float & int fields, each one type
+
+    def test_json_fallback(self):
+        record = {1: 'integer key'}
+        self.assertEqual(BinaryCodec().dumps(record), JSONCodec().dumps(record))
+        self.assertEqual(BinaryCodec().loads(BinaryCodec().dumps(record)), {'1': 'integer key'})
+
+    def test_reads_json_records(self):
+        stored = JSONCodec().dumps(_SESSION)
+        for codec in CODECS.values():
+            self.assertEqual(codec.loads(stored), _SESSION)
+            self.assertEqual(codec.to_json(stored), stored)     # Passed through as is
+
+    def test_to_json(self):
+        for codec in CODECS.values():
+            self.assertEqual(json.loads(codec.to_json(codec.dumps(_SESSION))), _SESSION)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+request_json: streamed decoding against json.loads with the body split at every chunk boundary, compressed bodies and
+the max_size limit on inflated bodies.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import io
+import json
+import zlib
+import unittest
+
+from webob import Request
+
+from orthobox.request_json import BodyTooLarge, UnsupportedEncoding, load, load_request
+
+_UPLOAD = {'version': 1, 'duration': 100000, 'starttime': 1400000000000, 'name': 'Ünïcødé ✓   "quoted"\\',
+           'errors': [{'endtime': 5000, 'duration': 400.25}, {'endtime': -12, 'duration': 1.5e-3}],
+           'drops': [], 'pokes': [{}, {'nested': [[1, 2], {'deep': [3e10]}]}], 'flags': [True, False, None],
+           'empty': {}, 'number': 123456789012345678901234567890}
+
+
+def _compress(data, encoding):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _Stream(io.BytesIO):
+    """
+    BytesIO counting the bytes read from it.
+    """
+    consumed = 0
+
+    def read(self, size=-1):
+        data = io.BytesIO.read(self, size)
+        self.consumed += len(data)
+        return data
+
+
+class StreamDecoderTest(unittest.TestCase):
+    def assertLoads(self, data, encoding=None, chunk_sizes=None, compressed_as=None):
+        expected = json.loads(data.decode('utf-8'))
+        body = _compress(data, compressed_as or encoding) if encoding else data
+        for chunk_size in chunk_sizes or range(1, len(body) + 1):
+            self.assertEqual(load(io.BytesIO(body), encoding, chunk_size=chunk_size), expected, chunk_size)
+
+    def test_every_chunk_boundary(self):
+        for data in (json.dumps(_UPLOAD).encode('utf-8'),
+                     json.dumps(_UPLOAD, ensure_ascii=False, indent=2).encode('utf-8'),    # Split characters
+                     b'[1, 22, 333, -4.5e+6, 7E-8, 0]',
+                     b'{"a": 12345, "b": [true, false, null, "x"]}',
+                     b'  "text"  ', b'12345', b'-0.5e10', b'null', b'[]', b'{}', b'[[]]'):
+            self.assertLoads(data)
+
+    def test_compressed(self):
+        data = json.dumps([_UPLOAD] * 20).encode('utf-8')
+        for encoding, compressed_as in (('gzip', None), ('deflate', None), ('x-gzip', 'gzip'), (' GZIP ', 'gzip')):
+            self.assertLoads(data, encoding, chunk_sizes=(1, 7, 64, 4096), compressed_as=compressed_as)
+
+    def test_malformed(self):
+        for data in (b'', b'   ', b'{"a": 1', b'{"a": 1,}', b'[1, 2', b'[1 2]', b'{"a" 1}', b'{1: 2}', b'[1]]',
+                     b'"\xc3', b'tru', b'"unterminated', b'{"a": 1} {"b": 2}'):
+            for chunk_size in (1, 3, 1024):
+                with self.assertRaises(ValueError, msg=(data, chunk_size)):
+                    load(io.BytesIO(data), chunk_size=chunk_size)
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(UnsupportedEncoding):
+            load(io.BytesIO(b'[]'), 'br')
+
+    def test_max_size(self):
+        data = json.dumps(_UPLOAD).encode('utf-8')
+        for encoding in (None, 'gzip', 'deflate'):
+            body = _compress(data, encoding) if encoding else data
+            for chunk_size in (1, 10, 4096):
+                self.assertEqual(load(io.BytesIO(body), encoding, len(data), chunk_size), _UPLOAD)
+                with self.assertRaises(BodyTooLarge):
+                    load(io.BytesIO(body), encoding, len(data) - 1, chunk_size)
+
+    def test_inflate_bomb(self):
+        bomb = _Stream(_compress(b'[' + b' ' * (64 * 1024 * 1024) + b']', 'gzip'))
+        with self.assertRaises(BodyTooLarge):
+            load(bomb, 'gzip', max_size=1024 * 1024, chunk_size=1024)
+        self.assertLess(bomb.consumed, len(bomb.getvalue()))     # Refused before the rest was read
+
+    def test_load_request(self):
+        data = json.dumps(_UPLOAD).encode('utf-8')
+        request = Request.blank('/', method=str('POST'), body=_compress(data, 'gzip'),
+                                headers={'Content-Encoding': str('gzip')})
+        self.assertEqual(load_request(request), _UPLOAD)
+        body = _Stream(data)
+        request = Request.blank('/', method=str('POST'), environ={'wsgi.input': body,
+                                                                  'CONTENT_LENGTH': str(len(data))})
+        with self.assertRaises(BodyTooLarge):
+            load_request(request, max_size=len(data) - 1)
+        self.assertEqual(body.consumed, 0)  # Refused from Content-Length
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+LTI launch & results upload through the application, with & without an outcome service to pass the grade back to.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import re
+import json
+import unittest
+
+from pyramid.config import Configurator
+from webtest import TestApp
+from ims_lti_py.tool_consumer import ToolConsumer
+
+from orthobox import _custom_config
+from orthobox.data_store import (_OUTBOX_DB, _OUTBOX_SCHEDULE_DB, atomically, new_oauth_creds, get_metadata,
+                                 get_session_data, outbox_depth)
+
+_SESSION_ID = re.compile(r'/([0-9a-f]{32})/launch\.jnlp')
+_UPLOAD = {'errors': [{'endtime': 5000, 'duration': 400}], 'duration': 100000, 'version': 1, 'pokes': [{}] * 9,
+           'drops': [], 'starttime': 1400000000000}
+
+
+def _clear_outbox():
+    for db in (_OUTBOX_DB, _OUTBOX_SCHEDULE_DB):
+        for key, _ in list(db.iterprefix('', raw=True)):
+            del db[key]
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        atomically(_clear_outbox)
+        self.app = TestApp(_custom_config(Configurator()).make_wsgi_app())     # No outbox workers or notifier
+        self.key, self.secret = new_oauth_creds()
+
+    def launch(self, **params):
+        params = dict({'resource_link_id': self.key, 'user_id': 'student-1', 'roles': 'Learner',
+                       'context_id': 'course-1', 'tool_consumer_instance_guid': 'lms.example.edu',
+                       'custom_box_version': 'pokey', 'lis_person_name_full': 'Student One',
+                       'launch_presentation_return_url': 'http://lms.example.edu/return',
+                       'launch_url': 'http://localhost/launch'}, **params)
+        data = ToolConsumer(self.key, self.secret, params=params).generate_launch_data()
+        response = self.app.post('/launch', data, extra_environ={'HTTP_HOST': str('localhost')})
+        return _SESSION_ID.search(response.text).group(1)
+
+    def upload(self, session_id, status=200):
+        return self.app.post('/{0}/results'.format(session_id), json.dumps(_UPLOAD), status=status)
+
+    def test_outcome_service_grade_queued(self):
+        session_id = self.launch(lis_result_sourcedid='student-1',
+                                 lis_outcome_service_url='http://lms.example.edu/outcome')
+        self.upload(session_id)
+        self.assertEqual(outbox_depth(), (1, 0))
+        self.upload(session_id, status=404)     # Upload credentials are retired
+
+    def test_without_outcome_service_accepted(self):
+        session_id = self.launch()
+        result, data = self.upload(session_id).json
+        self.assertEqual(result, get_metadata(session_id)['result'])
+        self.assertTrue(get_metadata(session_id)['evaluated'])
+        self.assertEqual(get_session_data(session_id)['duration'], 100)
+        self.assertEqual(outbox_depth(), (0, 0))    # Nothing to pass back to
+        self.upload(session_id, status=404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Schema upgrade of a context stored as one users record with session lists, the layout before schema version 2.
+"""
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import re
+import json
+import unittest
+
+from pyramid.config import Configurator
+from webtest import TestApp
+from ims_lti_py.tool_consumer import ToolConsumer
+
+from orthobox import _custom_config
+from orthobox.data_store import (_COHORT_STATS_DB, _META_DB, _METADATA_DB, _PROGRESS_DB, _USER_SESSIONS_DB, _USERS_DB,
+                                 _SCHEMA_VERSION, _key, _load, _prefix, _store, _upgrade_schema, atomically,
+                                 get_cohort_stats, get_metadata, get_progress_summary, get_user_data_by_context_id,
+                                 new_oauth_creds)
+
+_SESSION_ID = re.compile(r'/([0-9a-f]{32})/launch\.jnlp')
+_UPLOAD = {'errors': [{'endtime': 5000, 'duration': 400}], 'duration': 100000, 'version': 1, 'pokes': [{}] * 9,
+           'drops': [], 'starttime': 1400000000000}
+
+
+def _downgrade(context_id):
+    """
+    Rewrite context_id as schema version 1 stored it: one users record, no trials, progress or class statistics.
+    """
+    users = get_user_data_by_context_id(context_id)
+    for key, _ in list(_USERS_DB.iterprefix(_prefix(context_id))):
+        del _USERS_DB[key]
+    for key, session_id in list(_USER_SESSIONS_DB.iterprefix(_prefix(context_id))):
+        del _USER_SESSIONS_DB[key]
+        metadata = _load(_METADATA_DB, session_id)
+        del metadata['trial'], metadata['evaluated'], metadata['revision']
+        _store(_METADATA_DB, session_id, metadata)
+    for db in (_PROGRESS_DB, _COHORT_STATS_DB):
+        for key, _ in list(db.iterprefix(_prefix(context_id))):
+            del db[key]
+    for user in users.values():
+        for box_type in ('pokey', 'peggy'):
+            user[box_type].pop('mastered', None)
+    _store(_USERS_DB, context_id, users)
+    _META_DB['schema_version'] = '1'
+
+
+class SchemaUpgradeTest(unittest.TestCase):
+    def setUp(self):
+        self.app = TestApp(_custom_config(Configurator()).make_wsgi_app())     # No outbox workers or notifier
+        self.key, self.secret = new_oauth_creds()
+
+    def launch(self, user_id):
+        params = {'resource_link_id': self.key, 'user_id': user_id, 'roles': 'Learner', 'context_id': 'course-upgrade',
+                  'tool_consumer_instance_guid': 'lms.example.edu', 'custom_box_version': 'pokey',
+                  'lis_person_name_full': user_id, 'launch_presentation_return_url': 'http://lms.example.edu/return',
+                  'launch_url': 'http://localhost/launch'}
+        data = ToolConsumer(self.key, self.secret, params=params).generate_launch_data()
+        response = self.app.post('/launch', data, extra_environ={'HTTP_HOST': str('localhost')})
+        return _SESSION_ID.search(response.text).group(1)
+
+    def test_users_split_per_context_and_uid(self):
+        session_ids = [self.launch('student-1'), self.launch('student-1'), self.launch('student-2')]
+        for session_id in session_ids[1:]:
+            self.app.post('/{0}/results'.format(session_id), json.dumps(_UPLOAD))
+        context_id, uid = get_metadata(session_ids[0])['context'], get_metadata(session_ids[0])['uid']
+        users = get_user_data_by_context_id(context_id)
+        summary = get_progress_summary(uid, context_id, 'pokey')
+        stats = get_cohort_stats(context_id, 'pokey')
+
+        atomically(_downgrade, context_id)
+        self.assertIsNone(_USER_SESSIONS_DB.get(_key(context_id, uid, 'pokey', '00000000')))
+        _upgrade_schema()
+
+        self.assertEqual(_META_DB['schema_version'], str(_SCHEMA_VERSION))
+        self.assertNotIn(context_id, _USERS_DB)
+        self.assertEqual(get_user_data_by_context_id(context_id), users)
+        self.assertEqual(users[uid]['pokey']['sessions'], session_ids[:2])
+        self.assertEqual([get_metadata(session_id)['trial'] for session_id in session_ids], [1, 2, 1])
+        self.assertEqual([get_metadata(session_id)['evaluated'] for session_id in session_ids], [False, True, True])
+        upgraded = get_progress_summary(uid, context_id, 'pokey')
+        self.assertEqual(dict(upgraded, revision=0), dict(summary, revision=0))
+        self.assertEqual(get_cohort_stats(context_id, 'pokey'), stats)
+
+    def test_current_schema_untouched(self):
+        session_id = self.launch('student-3')
+        metadata = get_metadata(session_id)
+        _upgrade_schema()
+        self.assertEqual(_META_DB['schema_version'], str(_SCHEMA_VERSION))
+        self.assertEqual(get_metadata(session_id), metadata)     # Not stamped with another revision
+
+
+if __name__ == '__main__':
+    unittest.main()
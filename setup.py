@@ -27,9 +27,19 @@ setup(name='orthobox',
     include_package_data=True,
     zip_safe=False,
     install_requires=['cornice', 'waitress'],
+    extras_require={'numpy': ['numpy']},
     entry_points = """\
     [paste.app_factory]
     main = orthobox:main
+    [paste.filter_app_factory]
+    compress = orthobox.compression:filter_app_factory
+    [console_scripts]
+    orthobox_outcome_stub = orthobox.scripts.outcome_stub:main
+    orthobox_resync_grades = orthobox.scripts.resync_grades:main
+    orthobox_normalize_errors = orthobox.scripts.normalize_errors:main
+    orthobox_reevaluate = orthobox.scripts.reevaluate:main
+    orthobox_rebuild_stats = orthobox.scripts.rebuild_stats:main
+    orthobox_export_columns = orthobox.scripts.export_columns:main
     """,
     paster_plugins=['pyramid'],
 )